@@ -0,0 +1,245 @@
+"""allowlist.py
+
+Общий allowlist (users.json) для app.py, cashflow_* и роутера бота.
+
+Дизайн:
+- Снимок (AllowlistSnapshot) неизменяем: словари завёрнуты в MappingProxyType,
+  при изменении файла строится новый снимок и подменяется одной операцией
+  присваивания — читатели без блокировок видят либо старый, либо новый.
+- Файл проверяется не чаще раза в ALLOWLIST_STAT_TTL_SEC (os.stat: mtime,
+  размер, inode); перечитывается и парсится только если подпись изменилась.
+  inotify в stdlib нет, а TTL в пару секунд достаточно для ручных правок.
+- users (вход в app.py) разбирается строго, как раньше: только список
+  записей с telegram_id. raw (cashflow) — как раньше в cashflow: ещё и
+  {"id": ...} и словарь {"<tid>": {...}}.
+- Битый users.json не роняет запросы: остаётся предыдущий снимок, ошибка
+  считается в stats (при самой первой загрузке исключение пробрасывается).
+- Слушатели (add_listener) вызываются на каждый новый снимок уже после его
+  установки и вне _LOCK (под своей блокировкой, по порядку версий): app
+  синхронизирует таблицу users. Ошибка слушателя считается в stats и не
+  мешает ни установке снимка, ни вызывающему current().
+- Ошибки только считаются (errors, listener_errors, last_error в
+  allowlist_stats) — модуль не пишет в БД и в stdout.
+
+Интеграция:
+- app.lifespan: allowlist.configure(CFG.USERS_JSON_PATH), add_listener(...), reload().
+- app.refresh_allowlist_if_needed(), cashflow_models.create_cash_request,
+  cashflow_routes._user_can_view_withdraw_act — allowlist.current().
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+
+ALLOWLIST_STAT_TTL_SEC = float(os.getenv("ALLOWLIST_STAT_TTL_SEC", "2") or 2)
+
+# (st_mtime_ns, st_size, st_ino); None — файла нет
+Signature = Optional[Tuple[int, int, int]]
+UserMap = Mapping[int, Mapping[str, Any]]
+
+
+@dataclass(frozen=True)
+class AllowlistSnapshot:
+    # нормализованные записи: telegram_id, name, role, active (bool)
+    users: UserMap
+    # записи как в файле (cash_ops, cash_scopes и т.п.) — для cashflow
+    raw: UserMap
+    signature: Signature
+    version: int
+    loaded_at: float
+
+
+_PATH: Optional[str] = None
+_SNAPSHOT: Optional[AllowlistSnapshot] = None
+_NEXT_CHECK = 0.0
+_LOCK = threading.Lock()
+_LISTENER_LOCK = threading.Lock()
+_LISTENERS: List[Callable[[AllowlistSnapshot], None]] = []
+_STATS: Dict[str, int] = {"checks": 0, "reloads": 0, "errors": 0, "listener_errors": 0}
+_LAST_ERROR: Optional[str] = None
+
+
+def parse_users(data: Any) -> Dict[int, Dict[str, Any]]:
+    """
+    Разбор users.json: список [{"telegram_id": 123, ...}] или словарь
+    {"123": {...}}. Возвращает telegram_id -> запись как в файле.
+    """
+    out: Dict[int, Dict[str, Any]] = {}
+    if isinstance(data, dict):
+        for k, v in data.items():
+            try:
+                tid = int(k)
+            except Exception:
+                continue
+            if isinstance(v, dict):
+                out[tid] = v
+        return out
+    if not isinstance(data, list):
+        raise ValueError("users.json must be list or dict")
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        try:
+            tid = int(item.get("telegram_id") or item.get("id") or 0)
+        except Exception:
+            continue
+        if tid:
+            out[tid] = item
+    return out
+
+
+def parse_app_users(data: Any) -> Dict[int, Dict[str, Any]]:
+    """
+    Строгий разбор для входа в app.py: только список записей с ключом
+    telegram_id (прочие записи и формат-словарь пропускаются).
+    """
+    out: Dict[int, Dict[str, Any]] = {}
+    if not isinstance(data, list):
+        return out
+    for item in data:
+        if not isinstance(item, dict) or "telegram_id" not in item:
+            continue
+        try:
+            tid = int(item["telegram_id"])
+        except Exception:
+            continue
+        out[tid] = item
+    return out
+
+
+def normalize_user(tid: int, item: Mapping[str, Any]) -> Dict[str, Any]:
+    return {
+        "telegram_id": int(tid),
+        "name": str(item.get("name", "")).strip(),
+        "role": str(item.get("role", "viewer")).strip(),
+        "active": bool(item.get("active", True)),
+    }
+
+
+def _stat(path: str) -> Signature:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _load(path: str, signature: Signature, version: int) -> AllowlistSnapshot:
+    if signature is None:
+        # нет файла = пустой allowlist, никого не пускаем
+        raw: Dict[int, Dict[str, Any]] = {}
+        app_users: Dict[int, Dict[str, Any]] = {}
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        raw = parse_users(data)
+        app_users = parse_app_users(data)
+    return AllowlistSnapshot(
+        users=MappingProxyType({tid: MappingProxyType(normalize_user(tid, item)) for tid, item in app_users.items()}),
+        raw=MappingProxyType({tid: MappingProxyType(dict(item)) for tid, item in raw.items()}),
+        signature=signature,
+        version=version,
+        loaded_at=time.time(),
+    )
+
+
+def configure(path: Any) -> None:
+    global _PATH, _SNAPSHOT, _NEXT_CHECK
+    new_path = os.fspath(path)
+    with _LOCK:
+        if new_path != _PATH:
+            _PATH = new_path
+            _SNAPSHOT = None
+            _NEXT_CHECK = 0.0
+
+
+def add_listener(callback: Callable[[AllowlistSnapshot], None]) -> None:
+    with _LOCK:
+        if callback not in _LISTENERS:
+            _LISTENERS.append(callback)
+
+
+def _refresh_locked(force: bool) -> Tuple[AllowlistSnapshot, bool]:
+    global _SNAPSHOT, _NEXT_CHECK, _LAST_ERROR
+    if _PATH is None:
+        raise RuntimeError("Allowlist is not configured. Call allowlist.configure(path) from app.py")
+    _STATS["checks"] += 1
+    signature = _stat(_PATH)
+    _NEXT_CHECK = time.monotonic() + ALLOWLIST_STAT_TTL_SEC
+    prev = _SNAPSHOT
+    if prev is not None and not force and signature == prev.signature:
+        return prev, False
+    try:
+        snap = _load(_PATH, signature, (prev.version if prev else 0) + 1)
+    except Exception as exc:
+        _STATS["errors"] += 1
+        _LAST_ERROR = f"reload: {exc}"
+        if prev is None:
+            raise
+        # не парсим тот же битый файл на каждой проверке
+        _SNAPSHOT = AllowlistSnapshot(prev.users, prev.raw, signature, prev.version, prev.loaded_at)
+        return _SNAPSHOT, False
+    _SNAPSHOT = snap
+    _STATS["reloads"] += 1
+    return snap, True
+
+
+def _notify(snap: AllowlistSnapshot) -> None:
+    global _LAST_ERROR
+    with _LISTENER_LOCK:
+        latest = _SNAPSHOT
+        if latest is not None and latest.version > snap.version:
+            # пока ждали, поставили снимок новее — его слушатели и получат
+            return
+        for callback in list(_LISTENERS):
+            try:
+                callback(snap)
+            except Exception as exc:
+                with _LOCK:
+                    _STATS["listener_errors"] += 1
+                    _LAST_ERROR = f"listener: {exc}"
+
+
+def current() -> AllowlistSnapshot:
+    """Актуальный снимок; файл проверяется не чаще раза в TTL."""
+    snap = _SNAPSHOT
+    if snap is not None and time.monotonic() < _NEXT_CHECK:
+        return snap
+    with _LOCK:
+        snap = _SNAPSHOT
+        if snap is not None and time.monotonic() < _NEXT_CHECK:
+            return snap
+        snap, changed = _refresh_locked(force=False)
+    if changed:
+        _notify(snap)
+    return snap
+
+
+def reload() -> AllowlistSnapshot:
+    """Перечитать файл сейчас (старт приложения, ручной сброс)."""
+    with _LOCK:
+        snap, changed = _refresh_locked(force=True)
+    if changed:
+        _notify(snap)
+    return snap
+
+
+def allowlist_stats() -> Dict[str, Any]:
+    snap = _SNAPSHOT
+    stats: Dict[str, Any] = dict(_STATS)
+    stats.update({
+        "path": _PATH,
+        "ttl_sec": ALLOWLIST_STAT_TTL_SEC,
+        "version": snap.version if snap else 0,
+        "users": len(snap.users) if snap else 0,
+        "loaded_at": snap.loaded_at if snap else None,
+        "last_error": _LAST_ERROR,
+    })
+    return stats
@@ -5,6 +5,7 @@
 from __future__ import annotations
 
 import asyncio
+import bisect
 import calendar
 import dataclasses
 import datetime as dt
@@ -14,18 +15,24 @@ import importlib.util
 import io
 import json
 import math
+import multiprocessing
 import os
 import re
 import secrets
 import sqlite3
+import threading
 import time
 import traceback
 import urllib.parse
+import uuid
 import shutil
 import tempfile
 import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from contextlib import asynccontextmanager
-from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from typing import Any, Awaitable, Callable, ContextManager, Dict, List, Optional, Set, Tuple
 
 from fastapi import (
     BackgroundTasks,
@@ -41,7 +48,7 @@ from fastapi import (
 )
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
-from pydantic import BaseModel, ConfigDict, Field
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
@@ -72,12 +79,24 @@ except Exception:  # pragma: no cover
 from pathlib import Path
 from dotenv import load_dotenv
 
+import allowlist
+import cashflow_models
+import db_pool
+import db_writer
+import outbox
+import tg_delivery
+
 BASE_DIR = Path(__file__).resolve().parent
 load_dotenv(BASE_DIR / ".env")
 
 ATTACHMENTS_DIR = BASE_DIR / "uploads" / "receipts"
 UPLOADS_DIR = BASE_DIR / "uploads"
 BACKUPS_DIR = BASE_DIR / "backups"
+# Кэш отрендеренных PNG; относительный путь — от каталога приложения, как DB_PATH
+PNG_CACHE_DIR = Path(os.getenv("PNG_CACHE_DIR", "").strip() or "cache/png")
+if not PNG_CACHE_DIR.is_absolute():
+    PNG_CACHE_DIR = BASE_DIR / PNG_CACHE_DIR
+PNG_CACHE_MAX_BYTES = int(os.getenv("PNG_CACHE_MAX_BYTES", str(256 * 1024 * 1024)) or 0)
 ALLOWED_ATTACHMENT_MIME_TYPES = {
     "image/jpeg",
     "image/png",
@@ -87,6 +106,8 @@ ALLOWED_ATTACHMENT_MIME_TYPES = {
 MAX_ATTACHMENT_BYTES = 10 * 1024 * 1024
 MAX_ATTACHMENTS_PER_EXPENSE = 10
 MAX_BACKUP_UPLOAD_BYTES = 200 * 1024 * 1024
+MAX_EXPENSE_BATCH_ROWS = 2000
+MAX_EXPENSE_BATCH_BYTES = 5 * 1024 * 1024
 ACCOUNTS = ("main", "praise", "alpha")
 
 # ---------------------------
@@ -165,23 +186,25 @@ def cashapp_webapp_url() -> Optional[str]:
 # DB helpers (sqlite3)
 # ---------------------------
 
-def db_connect() -> sqlite3.Connection:
-    conn = sqlite3.connect(CFG.DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys=ON;")
-    return conn
+def db_connect() -> ContextManager[sqlite3.Connection]:
+    # Единица работы на пуловом соединении потока (WAL, см. db_pool.py).
+    # Вложенные `with db_connect()` разделяют одну транзакцию.
+    return db_pool.unit_of_work(CFG.DB_PATH)
+
+
+def db_checkpoint() -> None:
+    # Перед копированием файла БД: переносим WAL в основной файл.
+    db_pool.checkpoint(CFG.DB_PATH)
 
 
 def db_exec(sql: str, params: Tuple[Any, ...] = ()) -> None:
     with db_connect() as conn:
         conn.execute(sql, params)
-        conn.commit()
 
 
 def db_exec_returning_id(sql: str, params: Tuple[Any, ...] = ()) -> int:
     with db_connect() as conn:
         cur = conn.execute(sql, params)
-        conn.commit()
         return int(cur.lastrowid)
 
 
@@ -197,10 +220,39 @@ def db_fetchall(sql: str, params: Tuple[Any, ...] = ()) -> List[sqlite3.Row]:
         return cur.fetchall()
 
 
-def table_has_column(table: str, col: str) -> bool:
+def probe_table_column(table: str, col: str) -> bool:
+    # Прямой PRAGMA без кэша: для миграций, где схема меняется по ходу.
     rows = db_fetchall(f"PRAGMA table_info({table});")
     return any(r["name"] == col for r in rows)
 
+
+# Реестр возможностей схемы: колонки таблиц читаются один раз после миграций
+# (init_db) и дальше проверяются по словарю. Сбрасывается в init_db (в т.ч. после restore).
+SCHEMA_COLUMNS: Dict[str, frozenset] = {}
+
+
+def invalidate_schema_capabilities(table: Optional[str] = None) -> None:
+    if table is None:
+        SCHEMA_COLUMNS.clear()
+    else:
+        SCHEMA_COLUMNS.pop(table, None)
+
+
+def refresh_schema_capabilities() -> None:
+    invalidate_schema_capabilities()
+    tables = db_fetchall("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';")
+    for t in tables:
+        name = str(t["name"])
+        SCHEMA_COLUMNS[name] = frozenset(r["name"] for r in db_fetchall(f"PRAGMA table_info({name});"))
+
+
+def table_has_column(table: str, col: str) -> bool:
+    cols = SCHEMA_COLUMNS.get(table)
+    if cols is None:
+        cols = frozenset(r["name"] for r in db_fetchall(f"PRAGMA table_info({table});"))
+        SCHEMA_COLUMNS[table] = cols
+    return col in cols
+
 def services_unique_has_account() -> bool:
     if not db_fetchone("SELECT name FROM sqlite_master WHERE type='table' AND name='services';"):
         return False
@@ -215,7 +267,19 @@ def services_unique_has_account() -> bool:
     return False
 
 
-def init_db() -> None:
+# ---------------------------
+# Schema migrations (PRAGMA user_version)
+# ---------------------------
+# Каждая миграция выполняется один раз; после неё user_version = её номер.
+# На актуальной схеме init_db() ограничивается одним PRAGMA.
+
+def db_user_version() -> int:
+    row = db_fetchone("PRAGMA user_version;")
+    return int(row[0]) if row else 0
+
+
+def _migration_001_base_schema() -> None:
+    # Исходная схема: идемпотентна, поэтому безопасна и для старых БД без user_version.
     # users
     db_exec(
         """
@@ -568,12 +632,12 @@ def init_db() -> None:
             (None, "18:00", "21:00", CFG.TZ, "auto", 0, now, now),
         )
 
-    if not table_has_column("services", "income_type"):
+    if not probe_table_column("services", "income_type"):
         db_exec("ALTER TABLE services ADD COLUMN income_type TEXT NOT NULL DEFAULT 'donation';")
     db_exec("UPDATE services SET income_type='donation' WHERE income_type IS NULL OR income_type='';")
 
-    if not table_has_column("services", "account") or not services_unique_has_account():
-        has_account = table_has_column("services", "account")
+    if not probe_table_column("services", "account") or not services_unique_has_account():
+        has_account = probe_table_column("services", "account")
         db_exec(
             """
             CREATE TABLE services_new (
@@ -615,23 +679,113 @@ def init_db() -> None:
         )
         db_exec("DROP TABLE services;")
         db_exec("ALTER TABLE services_new RENAME TO services;")
-    if table_has_column("services", "account"):
+    if probe_table_column("services", "account"):
         db_exec("UPDATE services SET account='main' WHERE account IS NULL OR account='';")
 
-    if not table_has_column("expenses", "account"):
+    if not probe_table_column("expenses", "account"):
         db_exec("ALTER TABLE expenses ADD COLUMN account TEXT NOT NULL DEFAULT 'main';")
-    if table_has_column("expenses", "account"):
+    if probe_table_column("expenses", "account"):
         db_exec("UPDATE expenses SET account='main' WHERE account IS NULL OR account='';")
 
-    if not table_has_column("months", "closed_at"):
+    if not probe_table_column("months", "closed_at"):
         db_exec("ALTER TABLE months ADD COLUMN closed_at TEXT NULL;")
-    if not table_has_column("months", "closed_by_user_id"):
+    if not probe_table_column("months", "closed_by_user_id"):
         db_exec("ALTER TABLE months ADD COLUMN closed_by_user_id INTEGER NULL;")
-    if not table_has_column("months", "is_closed"):
+    if not probe_table_column("months", "is_closed"):
         db_exec("ALTER TABLE months ADD COLUMN is_closed INTEGER NOT NULL DEFAULT 0;")
         db_exec("UPDATE months SET is_closed=1 WHERE closed_at IS NOT NULL;")
 
     ensure_categories_from_expenses()
+    init_month_rollups()
+
+
+def _migration_002_hot_query_indexes() -> None:
+    with db_connect() as conn:
+        conn.executescript(
+            """
+            -- list_expenses: WHERE month_id=? ORDER BY expense_date DESC, id DESC
+            CREATE INDEX IF NOT EXISTS idx_expenses_month_date ON expenses(month_id, expense_date, id);
+            -- compute_period_totals / analytics по датам (покрывающие)
+            CREATE INDEX IF NOT EXISTS idx_expenses_date_account ON expenses(expense_date, account, category, total);
+            CREATE INDEX IF NOT EXISTS idx_services_date_account ON services(service_date, account, total);
+            CREATE INDEX IF NOT EXISTS idx_services_month_date ON services(month_id, service_date);
+            -- audit / monitoring
+            CREATE INDEX IF NOT EXISTS idx_audit_entity ON audit_log(entity_type, entity_id);
+            CREATE INDEX IF NOT EXISTS idx_deliveries_created ON message_deliveries(created_at);
+            CREATE INDEX IF NOT EXISTS idx_deliveries_status_created ON message_deliveries(status, created_at);
+            CREATE INDEX IF NOT EXISTS idx_deliveries_kind_created ON message_deliveries(kind, created_at);
+            CREATE INDEX IF NOT EXISTS idx_job_runs_job ON job_runs(job_id, id);
+            CREATE INDEX IF NOT EXISTS idx_job_runs_started ON job_runs(started_at);
+            -- list_withdraw_act_rows: диапазон/сортировка по created_at, участники по заявке
+            CREATE INDEX IF NOT EXISTS idx_cash_requests_created ON cash_requests(created_at, id);
+            CREATE INDEX IF NOT EXISTS idx_cash_participants_req ON cash_request_participants(request_id, is_admin, id);
+            """
+        )
+        conn.execute("ANALYZE;")
+
+
+def _migration_003_signature_thumbnails() -> None:
+    # cash_signatures.thumb_*: колонки добавляет init_cashflow_db, здесь — миниатюры для старых подписей
+    import cashflow_models as cf
+
+    cfg = build_cashflow_config()
+    with db_connect() as conn:
+        cf.init_cashflow_db(conn)
+        created = cf.backfill_signature_thumbnails(conn, cfg)
+    if created:
+        log_system_log("INFO", "db.migration", "Созданы миниатюры подписей", {"count": created})
+
+
+def _migration_004_cash_act_indexes() -> None:
+    with db_connect() as conn:
+        conn.executescript(
+            """
+            -- акт наличных по счёту: WHERE account=? AND created_at BETWEEN ... ORDER BY created_at DESC, id DESC
+            CREATE INDEX IF NOT EXISTS idx_cash_requests_account_created ON cash_requests(account, created_at, id);
+            """
+        )
+        conn.execute("ANALYZE cash_requests;")
+
+
+def _migration_005_report_file_ids() -> None:
+    db_exec(
+        """
+        CREATE TABLE IF NOT EXISTS report_file_ids (
+            cache_key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT NULL,
+            created_at TEXT NOT NULL
+        );
+        """
+    )
+
+
+def _migration_006_outbox() -> None:
+    with db_connect() as conn:
+        outbox.init_outbox_db(conn)
+
+
+MIGRATIONS: List[Tuple[int, Callable[[], None]]] = [
+    (1, _migration_001_base_schema),
+    (2, _migration_002_hot_query_indexes),
+    (3, _migration_003_signature_thumbnails),
+    (4, _migration_004_cash_act_indexes),
+    (5, _migration_005_report_file_ids),
+    (6, _migration_006_outbox),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def init_db() -> None:
+    invalidate_schema_capabilities()
+    current = db_user_version()
+    for version, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        migrate()
+        db_exec(f"PRAGMA user_version={int(version)};")
+        log_system_log("INFO", "db.migration", f"Schema migrated to version {version}", {"name": migrate.__name__})
+    refresh_schema_capabilities()
 
 
 def iso_now(tz: ZoneInfo) -> str:
@@ -827,6 +981,123 @@ def set_expense_tags(
     return tags
 
 
+def resolve_categories_bulk(
+    conn: sqlite3.Connection,
+    names: List[str],
+    role: str,
+    user_id: Optional[int],
+) -> Dict[str, str]:
+    """
+    resolve_category для набора имён: алиасы и категории одним запросом,
+    недостающие категории создаются executemany (если роль позволяет).
+    Возвращает {исходное имя: имя категории}. Аудит созданных — пакетом.
+    """
+    raws = {name: (str(name or "").strip() or "Прочее") for name in names}
+    result: Dict[str, str] = {}
+    unique_raws = sorted(set(raws.values()))
+    if not unique_raws:
+        return result
+
+    alias_norms = sorted({normalize_alias(r) for r in unique_raws} - {""})
+    alias_map: Dict[str, str] = {}
+    if alias_norms:
+        placeholders = ",".join("?" for _ in alias_norms)
+        for row in conn.execute(
+            f"""
+            SELECT a.alias_norm, c.name
+            FROM category_aliases a
+            JOIN categories c ON c.id=a.category_id
+            WHERE a.alias_norm IN ({placeholders});
+            """,
+            tuple(alias_norms),
+        ):
+            alias_map[str(row["alias_norm"])] = str(row["name"])
+
+    placeholders = ",".join("?" for _ in unique_raws)
+    existing = {
+        str(row["name"])
+        for row in conn.execute(
+            f"SELECT name FROM categories WHERE name IN ({placeholders});",
+            tuple(unique_raws),
+        )
+    }
+
+    resolved: Dict[str, str] = {}
+    missing: List[str] = []
+    for raw in unique_raws:
+        alias_norm = normalize_alias(raw)
+        if alias_norm and alias_norm in alias_map:
+            resolved[raw] = alias_map[alias_norm]
+        elif raw in existing:
+            resolved[raw] = raw
+        else:
+            resolved[raw] = raw
+            missing.append(raw)
+
+    if missing and role in ("admin", "accountant"):
+        now = iso_now(CFG.tzinfo())
+        conn.executemany(
+            """
+            INSERT INTO categories (name, is_active, sort_order, created_at, updated_at)
+            VALUES (?, 1, 0, ?, ?);
+            """,
+            [(raw, now, now) for raw in missing],
+        )
+        placeholders = ",".join("?" for _ in missing)
+        created = conn.execute(
+            f"SELECT * FROM categories WHERE name IN ({placeholders});",
+            tuple(missing),
+        ).fetchall()
+        log_audit_many([(user_id, "CREATE", "category", int(r["id"]), None, dict(r)) for r in created])
+
+    for name, raw in raws.items():
+        result[name] = resolved[raw]
+    return result
+
+
+def resolve_tags_bulk(
+    conn: sqlite3.Connection,
+    tag_names: List[str],
+    role: str,
+    user_id: Optional[int],
+) -> Dict[str, int]:
+    """Теги по name_norm одним запросом, недостающие создаются пакетом. {name_norm: tag_id}"""
+    by_norm: Dict[str, str] = {}
+    for name in normalize_tag_list(tag_names):
+        by_norm.setdefault(normalize_tag_name(name), name)
+    if not by_norm:
+        return {}
+
+    def fetch() -> Dict[str, int]:
+        placeholders = ",".join("?" for _ in by_norm)
+        return {
+            str(r["name_norm"]): int(r["id"])
+            for r in conn.execute(
+                f"SELECT id, name_norm FROM tags WHERE name_norm IN ({placeholders});",
+                tuple(by_norm),
+            )
+        }
+
+    ids = fetch()
+    missing = [norm for norm in by_norm if norm not in ids]
+    if missing:
+        if role not in ("admin", "accountant"):
+            raise HTTPException(status_code=403, detail="Insufficient role for tag creation")
+        now = iso_now(CFG.tzinfo())
+        conn.executemany(
+            "INSERT INTO tags (name, name_norm, created_at, updated_at) VALUES (?, ?, ?, ?);",
+            [(by_norm[norm], norm, now, now) for norm in missing],
+        )
+        ids = fetch()
+        placeholders = ",".join("?" for _ in missing)
+        created = conn.execute(
+            f"SELECT * FROM tags WHERE name_norm IN ({placeholders});",
+            tuple(missing),
+        ).fetchall()
+        log_audit_many([(user_id, "CREATE", "tag", int(r["id"]), None, dict(r)) for r in created])
+    return ids
+
+
 
 def get_categories_payload() -> List[Dict[str, Any]]:
     categories = db_fetchall(
@@ -864,8 +1135,8 @@ def get_budget_fact(month_id: int, category_name: str, include_system: bool) ->
     row = db_fetchone(
         """
         SELECT COALESCE(SUM(total), 0) AS s
-        FROM expenses
-        WHERE month_id=? AND category=? AND account='main' AND (?=1 OR is_system=0);
+        FROM month_rollups
+        WHERE kind='expense' AND month_id=? AND category=? AND account='main' AND (?=1 OR is_system=0);
         """,
         (month_id, category_name, 1 if include_system else 0),
     )
@@ -1061,75 +1332,74 @@ def attachment_extension(orig_filename: str, mime: str) -> str:
 # Allowlist (users.json) + sync to DB
 # ---------------------------
 
-ALLOWLIST_CACHE: Dict[int, Dict[str, Any]] = {}
-ALLOWLIST_MTIME: Optional[float] = None
-
-
-def load_allowlist() -> Dict[int, Dict[str, Any]]:
+def load_allowlist() -> allowlist.UserMap:
     """
     users.json:
     [
       {"telegram_id": 123, "name": "Иван", "role": "admin", "active": true},
       ...
     ]
+    Возвращает текущий (неизменяемый) снимок из allowlist.py.
     """
-    path = CFG.USERS_JSON_PATH
-    if not os.path.exists(path):
-        # пустой allowlist = никого не пускаем
-        return {}
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    out: Dict[int, Dict[str, Any]] = {}
-    for item in data:
-        try:
-            tid = int(item["telegram_id"])
-            out[tid] = {
-                "telegram_id": tid,
-                "name": str(item.get("name", "")).strip(),
-                "role": str(item.get("role", "viewer")).strip(),
-                "active": bool(item.get("active", True)),
-            }
-        except Exception:
-            continue
-    return out
+    return allowlist.current().users
 
 
-def sync_allowlist_to_db(allow: Dict[int, Dict[str, Any]]) -> None:
+def sync_allowlist_to_db(allow: allowlist.UserMap) -> None:
+    """Один executemany-upsert; строки без изменений не переписываются."""
+    if not allow:
+        return
     now = iso_now(CFG.tzinfo())
-    for tid, u in allow.items():
-        existing = db_fetchone("SELECT * FROM users WHERE telegram_id=?;", (tid,))
-        if not existing:
-            db_exec(
-                """
-                INSERT INTO users (telegram_id, name, role, active, created_at)
-                VALUES (?, ?, ?, ?, ?);
-                """,
-                (tid, u.get("name"), u.get("role", "viewer"), 1 if u.get("active", True) else 0, now),
-            )
-        else:
-            db_exec(
-                """
-                UPDATE users SET name=?, role=?, active=?
-                WHERE telegram_id=?;
-                """,
-                (u.get("name"), u.get("role", existing["role"]), 1 if u.get("active", True) else 0, tid),
-            )
+    with db_connect() as conn:
+        conn.executemany(
+            """
+            INSERT INTO users (telegram_id, name, role, active, created_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(telegram_id) DO UPDATE SET
+                name=excluded.name,
+                role=excluded.role,
+                active=excluded.active
+            WHERE users.name IS NOT excluded.name
+               OR users.role IS NOT excluded.role
+               OR users.active IS NOT excluded.active;
+            """,
+            [
+                (int(tid), u.get("name"), u.get("role", "viewer"), 1 if u.get("active", True) else 0, now)
+                for tid, u in allow.items()
+            ],
+        )
+    invalidate_principal_cache(allow.keys())
+
+
+def _on_allowlist_changed(snap: allowlist.AllowlistSnapshot) -> None:
+    # роли в БД не должны отставать от users.json
+    sync_allowlist_to_db(snap.users)
+    invalidate_principal_cache()
+
+
+def refresh_allowlist_if_needed() -> allowlist.UserMap:
+    return allowlist.current().users
+
+
+allowlist.configure(CFG.USERS_JSON_PATH)
+allowlist.add_listener(_on_allowlist_changed)
+
+
+def build_cashflow_config() -> cashflow_models.CashflowConfig:
+    """CashflowConfig с путями app.py (DB_PATH, USERS_JSON)."""
+    cfg_base = cashflow_models.load_cashflow_config(BASE_DIR)
+    return cashflow_models.CashflowConfig(
+        base_dir=cfg_base.base_dir,
+        db_path=Path(CFG.DB_PATH),
+        users_json_path=Path(CFG.USERS_JSON_PATH),
+        uploads_dir=cfg_base.uploads_dir,
+        timezone=cfg_base.timezone,
+    )
+
+
+def bootstrap_cashflow() -> None:
+    """Один раз при старте (и после restore): таблицы cashflow + общий конфиг модуля."""
+    cashflow_models.bootstrap(build_cashflow_config())
 
-def refresh_allowlist_if_needed() -> Dict[int, Dict[str, Any]]:
-    global ALLOWLIST_CACHE, ALLOWLIST_MTIME
-    path = CFG.USERS_JSON_PATH
-    try:
-        mtime = os.path.getmtime(path)
-    except FileNotFoundError:
-        mtime = None
-    if mtime != ALLOWLIST_MTIME:
-        allow = load_allowlist()
-        sync_allowlist_to_db(allow)
-        ALLOWLIST_CACHE = allow
-        ALLOWLIST_MTIME = mtime
-        return ALLOWLIST_CACHE
-    return ALLOWLIST_CACHE
 
 def create_cashflow_collect_request_if_needed(
     *,
@@ -1158,16 +1428,8 @@ def create_cashflow_collect_request_if_needed(
     }
     payload_json = json.dumps(payload, ensure_ascii=False, sort_keys=True)
 
-    cfg_base = cf.load_cashflow_config(BASE_DIR)
-    cfg = cf.CashflowConfig(
-        base_dir=cfg_base.base_dir,
-        db_path=Path(CFG.DB_PATH),
-        users_json_path=Path(CFG.USERS_JSON_PATH),
-        uploads_dir=cfg_base.uploads_dir,
-        timezone=cfg_base.timezone,
-    )
+    cfg = cf.get_config()
     with db_connect() as conn:
-        cf.init_cashflow_db(conn)
         existing = conn.execute(
             """
             SELECT id
@@ -1383,6 +1645,70 @@ def verify_session_token(token: str, secret: str) -> Dict[str, Any]:
 # Telegram WebApp initData validation
 # ---------------------------
 
+# secret_key зависит только от токена бота — считаем один раз на токен
+WEBAPP_SECRET_KEYS: Dict[str, bytes] = {}
+
+# Уже проверенные initData: digest(secret_key, initData) -> (user, срок по auth_date).
+# Ключ — от всей строки, а не от поля hash: подделка с чужим hash не попадёт в кэш,
+# а запись не переживает auth_date + max_age, как и сама проверка.
+INIT_DATA_CACHE_MAX = 2048
+INIT_DATA_LOCK = threading.Lock()
+INIT_DATA_CACHE: "OrderedDict[bytes, Tuple[Dict[str, Any], int]]" = OrderedDict()
+INIT_DATA_CACHE_STATS: Dict[str, int] = {"hits": 0, "misses": 0}
+
+
+def webapp_secret_key(bot_token: str) -> bytes:
+    key = WEBAPP_SECRET_KEYS.get(bot_token)
+    if key is None:
+        key = hmac.new(b"WebAppData", bot_token.encode("utf-8"), hashlib.sha256).digest()
+        WEBAPP_SECRET_KEYS[bot_token] = key
+    return key
+
+
+def init_data_cache_stats() -> Dict[str, Any]:
+    with INIT_DATA_LOCK:
+        stats: Dict[str, Any] = dict(INIT_DATA_CACHE_STATS)
+        stats["size"] = len(INIT_DATA_CACHE)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / total, 4) if total else None
+    return stats
+
+
+def verify_telegram_init_data_cached(
+    init_data: str,
+    bot_token: str,
+    max_age_sec: int = 7 * 24 * 3600,
+) -> Tuple[Dict[str, Any], bool]:
+    """validate_telegram_init_data с LRU; второе значение — True, если initData уже проверяли."""
+    if not init_data:
+        raise HTTPException(status_code=400, detail="initData is required")
+    key = hmac.new(webapp_secret_key(bot_token), init_data.encode("utf-8"), hashlib.sha256).digest()
+    now = int(time.time())
+    with INIT_DATA_LOCK:
+        entry = INIT_DATA_CACHE.get(key)
+        if entry is not None and now <= entry[1]:
+            INIT_DATA_CACHE.move_to_end(key)
+            INIT_DATA_CACHE_STATS["hits"] += 1
+            return dict(entry[0]), True
+        if entry is not None:
+            del INIT_DATA_CACHE[key]
+        INIT_DATA_CACHE_STATS["misses"] += 1
+
+    user_obj = validate_telegram_init_data(init_data, bot_token, max_age_sec)
+    try:
+        auth_date = int(dict(urllib.parse.parse_qsl(init_data)).get("auth_date", "0"))
+    except ValueError:
+        auth_date = 0
+    # без auth_date срок проверки не ограничен — такие initData не кэшируем
+    if auth_date and isinstance(user_obj, dict):
+        with INIT_DATA_LOCK:
+            INIT_DATA_CACHE[key] = (dict(user_obj), auth_date + int(max_age_sec))
+            INIT_DATA_CACHE.move_to_end(key)
+            while len(INIT_DATA_CACHE) > INIT_DATA_CACHE_MAX:
+                INIT_DATA_CACHE.popitem(last=False)
+    return user_obj, False
+
+
 def validate_telegram_init_data(init_data: str, bot_token: str, max_age_sec: int = 7 * 24 * 3600) -> Dict[str, Any]:
     """
     Telegram WebApp initData verification:
@@ -1416,7 +1742,7 @@ def validate_telegram_init_data(init_data: str, bot_token: str, max_age_sec: int
     data_pairs.sort()
     data_check_string = "\n".join(data_pairs)
 
-    secret_key = hmac.new(b"WebAppData", bot_token.encode("utf-8"), hashlib.sha256).digest()
+    secret_key = webapp_secret_key(bot_token)
     computed_hash = hmac.new(secret_key, data_check_string.encode("utf-8"), hashlib.sha256).hexdigest()
 
     if not hmac.compare_digest(computed_hash, received_hash):
@@ -1494,6 +1820,7 @@ def get_or_create_month(year: int, month: int) -> sqlite3.Row:
         """,
         (year, month, 0.0, float(start_balance), None, now, now),
     )
+    ensure_tithe_expense(new_id, user_id=None)
     m2 = db_fetchone("SELECT * FROM months WHERE id=?;", (new_id,))
     assert m2 is not None
     return m2
@@ -1509,61 +1836,90 @@ def calc_weekly_min_needed(month_row: sqlite3.Row) -> float:
     return round(monthly_min_needed / n, 2) if monthly_min_needed else 0.0
 
 
+def derive_service_fields(service: Any, weekly_min: float) -> Dict[str, Any]:
+    """Вычисляемые поля строки services (total, МНСП, статус, ПВС) без записи в БД."""
+    cashless = float(service["cashless"] or 0.0)
+    cash = float(service["cash"] or 0.0)
+    total = round(cashless + cash, 2)
+    income_type = str(service["income_type"] or "donation")
+    account = str(service["account"] or "main")
+    if account != "main":
+        status = "Доп. счет"
+        pvs = 0.0
+        weekly_min_for_row = 0.0
+    elif income_type == "donation":
+        status = "Собрана" if (weekly_min and total >= weekly_min) else "Не собрана"
+        pvs = (total / weekly_min) if weekly_min else 0.0
+        weekly_min_for_row = weekly_min
+    else:
+        status = "Иной доход"
+        pvs = 0.0
+        weekly_min_for_row = 0.0
+    return {
+        "total": total,
+        "weekly_min_needed": weekly_min_for_row,
+        "mnsps_status": status,
+        "pvs_ratio": pvs,
+    }
+
+
+def derive_month_services(month_row: sqlite3.Row, services: List[sqlite3.Row]) -> List[Dict[str, Any]]:
+    """
+    Строки services месяца с пересчитанными полями (как после recalc_services_for_month).
+    services должны быть отсортированы по service_date, id.
+    """
+    weekly_min = calc_weekly_min_needed(month_row)
+    items: List[Dict[str, Any]] = []
+    seq = 0
+    for s in services:
+        item = dict(s)
+        item.update(derive_service_fields(s, weekly_min))
+        if str(s["account"] or "main") == "main" and s["income_type"] == "donation":
+            seq += 1
+            item["idx"] = seq
+        else:
+            item["idx"] = 0
+        items.append(item)
+    return items
+
+
+def calc_tithe_amount(donation_income: float) -> float:
+    return round(float(donation_income) * 0.10, 2)
+
+
 def recalc_services_for_month(month_id: int) -> None:
     m = get_month_by_id(month_id)
-    weekly_min = calc_weekly_min_needed(m)
     tz = CFG.tzinfo()
     now = iso_now(tz)
 
-    services = db_fetchall("SELECT * FROM services WHERE month_id=? ORDER BY service_date ASC;", (month_id,))
-    for s in services:
-        cashless = float(s["cashless"] or 0.0)
-        cash = float(s["cash"] or 0.0)
-        total = round(cashless + cash, 2)
-        income_type = str(s["income_type"] or "donation")
-        account = str(s["account"] or "main")
-        if account != "main":
-            status = "Доп. счет"
-            pvs = 0.0
-            weekly_min_for_row = 0.0
-        elif income_type == "donation":
-            status = "Собрана" if (weekly_min and total >= weekly_min) else "Не собрана"
-            pvs = (total / weekly_min) if weekly_min else 0.0
-            weekly_min_for_row = weekly_min
-        else:
-            status = "Иной доход"
-            pvs = 0.0
-            weekly_min_for_row = 0.0
-        db_exec(
+    services = db_fetchall(
+        "SELECT * FROM services WHERE month_id=? ORDER BY service_date ASC, id ASC;",
+        (month_id,),
+    )
+    fields = ("total", "weekly_min_needed", "mnsps_status", "pvs_ratio", "idx")
+    changed = []
+    for s, item in zip(services, derive_month_services(m, services)):
+        if all(s[f] == item[f] for f in fields):
+            continue
+        changed.append(
+            (
+                item["total"], item["weekly_min_needed"], item["mnsps_status"], item["pvs_ratio"],
+                item["idx"], now, s["id"],
+            )
+        )
+    if not changed:
+        return
+
+    with db_connect() as conn:
+        conn.executemany(
             """
             UPDATE services
-            SET total=?, weekly_min_needed=?, mnsps_status=?, pvs_ratio=?, updated_at=?
+            SET total=?, weekly_min_needed=?, mnsps_status=?, pvs_ratio=?, idx=?, updated_at=?
             WHERE id=?;
             """,
-            (total, weekly_min_for_row, status, pvs, now, s["id"]),
+            changed,
         )
 
-    # Update idx sequentially by date
-    services2 = db_fetchall(
-        """
-        SELECT id FROM services
-        WHERE month_id=? AND account='main' AND income_type='donation'
-        ORDER BY service_date ASC;
-        """,
-        (month_id,),
-    )
-    for i, row in enumerate(services2, start=1):
-        db_exec("UPDATE services SET idx=? WHERE id=?;", (i, row["id"]))
-    db_exec(
-        """
-        UPDATE services
-        SET idx=0
-        WHERE month_id=?
-          AND (account!='main' OR income_type!='donation' OR income_type IS NULL);
-        """,
-        (month_id,),
-    )
-
 
 def ensure_tithe_expense(month_id: int, user_id: Optional[int] = None) -> None:
     """
@@ -1575,6 +1931,7 @@ def ensure_tithe_expense(month_id: int, user_id: Optional[int] = None) -> None:
       total=tithe_amount
       is_system=true
       date=last day of month
+    Пишет в БД только если сумма/дата/категория изменились.
     """
     m = get_month_by_id(month_id)
     year, month = int(m["year"]), int(m["month"])
@@ -1591,7 +1948,7 @@ def ensure_tithe_expense(month_id: int, user_id: Optional[int] = None) -> None:
             (month_id,),
         )["s"]
     )
-    tithe_amount = round(income_sum * 0.10, 2)
+    tithe_amount = calc_tithe_amount(income_sum)
 
     existing = db_fetchone(
         """
@@ -1606,6 +1963,15 @@ def ensure_tithe_expense(month_id: int, user_id: Optional[int] = None) -> None:
     category = resolve_category("Десятина", "admin", user_id)
 
     if existing:
+        if (
+            existing["expense_date"] == iso_date(tithe_date)
+            and existing["category"] == category
+            and float(existing["unit_amount"] or 0.0) == tithe_amount
+            and float(existing["total"] or 0.0) == tithe_amount
+            and float(existing["qty"] or 0.0) == 1
+            and (existing["account"] or "main") == "main"
+        ):
+            return
         before = dict(existing)
         db_exec(
             """
@@ -1631,82 +1997,320 @@ def ensure_tithe_expense(month_id: int, user_id: Optional[int] = None) -> None:
         log_audit(user_id, "CREATE_SYSTEM_TITHE", "expense", int(new_id), None, after)
 
 
-def compute_month_summary(month_id: int, ensure_tithe: bool = True) -> Dict[str, Any]:
-    m = get_month_by_id(month_id)
-    # Services should be recalculated in case weekly_min_needed changed
-    recalc_services_for_month(month_id)
+# ---------------------------
+# Month rollups (materialized sums by month)
+# ---------------------------
+# month_rollups хранит суммы доходов/расходов по (month_id, ym, account,
+# income_type, category, is_system). ym — календарный месяц даты операции
+# (для периодной аналитики). Таблица поддерживается триггерами в той же
+# транзакции, что и изменение services/expenses, поэтому покрывает все пути
+# записи (API, бот, черновики, cashflow, десятина, переименование категорий).
+
+_ROLLUP_KEY = "month_id, ym, kind, account, income_type, category, is_system"
+
+_ROLLUP_SOURCES = {
+    # kind: (table, date column, amount expr, income_type expr, category expr, is_system expr)
+    "income": (
+        "services",
+        "service_date",
+        "ROUND(COALESCE({r}.cashless,0)+COALESCE({r}.cash,0), 2)",
+        "COALESCE({r}.income_type,'donation')",
+        "''",
+        "0",
+    ),
+    "expense": (
+        "expenses",
+        "expense_date",
+        "COALESCE({r}.total,0)",
+        "''",
+        "COALESCE({r}.category,'')",
+        "COALESCE({r}.is_system,0)",
+    ),
+}
 
-    if ensure_tithe:
-        ensure_tithe_expense(month_id, user_id=None)
 
-    income_sum = float(
-        db_fetchone(
-            "SELECT COALESCE(SUM(total),0) AS s FROM services WHERE month_id=? AND account='main';",
-            (month_id,),
-        )["s"]
-    )
-    expenses_sum = float(
-        db_fetchone(
-            "SELECT COALESCE(SUM(total),0) AS s FROM expenses WHERE month_id=? AND account='main';",
-            (month_id,),
-        )["s"]
-    )
+def _rollup_apply_sql(kind: str, r: str, sign: str) -> str:
+    table, date_col, amount, income_type, category, is_system = _ROLLUP_SOURCES[kind]
+    t = amount.format(r=r)
+    return f"""
+        INSERT INTO month_rollups ({_ROLLUP_KEY}, total, rows_count, pos_total, pos_count)
+        VALUES (
+            {r}.month_id, substr({r}.{date_col},1,7), '{kind}', COALESCE({r}.account,'main'),
+            {income_type.format(r=r)}, {category.format(r=r)}, {is_system.format(r=r)},
+            {sign}({t}), {sign}1,
+            {sign}(CASE WHEN {t}>0 THEN {t} ELSE 0 END), {sign}(CASE WHEN {t}>0 THEN 1 ELSE 0 END)
+        )
+        ON CONFLICT({_ROLLUP_KEY}) DO UPDATE SET
+            total=total+excluded.total,
+            rows_count=rows_count+excluded.rows_count,
+            pos_total=pos_total+excluded.pos_total,
+            pos_count=pos_count+excluded.pos_count;
+    """
 
-    month_balance = round(income_sum - expenses_sum, 2)
-    start_balance = float(m["start_balance"] or 0.0)
-    fact_balance = round(start_balance + income_sum - expenses_sum, 2)
 
-    monthly_min_needed = float(m["monthly_min_needed"] or 0.0)
-    if income_sum > monthly_min_needed:
-        sddr = round(income_sum - monthly_min_needed, 2)
-    else:
-        sddr = 0.0
+def _rollup_triggers_sql() -> str:
+    parts: List[str] = []
+    watched = {
+        "income": "month_id, service_date, cashless, cash, account, income_type",
+        "expense": "month_id, expense_date, category, total, account, is_system",
+    }
+    for kind, (table, *_rest) in _ROLLUP_SOURCES.items():
+        cleanup = "DELETE FROM month_rollups WHERE month_id=OLD.month_id AND rows_count<=0;"
+        parts.append(
+            f"CREATE TRIGGER IF NOT EXISTS trg_{table}_rollup_ins AFTER INSERT ON {table} BEGIN"
+            f"{_rollup_apply_sql(kind, 'NEW', '')} END;"
+        )
+        parts.append(
+            f"CREATE TRIGGER IF NOT EXISTS trg_{table}_rollup_upd AFTER UPDATE OF {watched[kind]} ON {table} BEGIN"
+            f"{_rollup_apply_sql(kind, 'OLD', '-')}{_rollup_apply_sql(kind, 'NEW', '')} {cleanup} END;"
+        )
+        parts.append(
+            f"CREATE TRIGGER IF NOT EXISTS trg_{table}_rollup_del AFTER DELETE ON {table} BEGIN"
+            f"{_rollup_apply_sql(kind, 'OLD', '-')} {cleanup} END;"
+        )
+    return "\n".join(parts)
 
-    monthly_completion = 0.0
-    if monthly_min_needed > 0:
-        monthly_completion = min(income_sum / monthly_min_needed, 1.0)
 
-    # psdpm
-    year, month = int(m["year"]), int(m["month"])
-    prev_y, prev_m = year, month - 1
-    if prev_m == 0:
-        prev_m = 12
-        prev_y -= 1
-    prev = db_fetchone("SELECT id FROM months WHERE year=? AND month=?;", (prev_y, prev_m))
-    psdpm = None
-    if prev:
-        prev_income = float(
-            db_fetchone(
-                "SELECT COALESCE(SUM(total),0) AS s FROM services WHERE month_id=? AND account='main';",
-                (prev["id"],),
-            )["s"]
+def _rollup_expected_sql() -> str:
+    selects: List[str] = []
+    for kind, (table, date_col, amount, income_type, category, is_system) in _ROLLUP_SOURCES.items():
+        t = amount.format(r=table)
+        selects.append(
+            f"""
+            SELECT
+                month_id, substr({date_col},1,7) AS ym, '{kind}' AS kind,
+                COALESCE(account,'main') AS account,
+                {income_type.format(r=table)} AS income_type,
+                {category.format(r=table)} AS category,
+                {is_system.format(r=table)} AS is_system,
+                SUM({t}) AS total,
+                COUNT(*) AS rows_count,
+                SUM(CASE WHEN {t}>0 THEN {t} ELSE 0 END) AS pos_total,
+                SUM(CASE WHEN {t}>0 THEN 1 ELSE 0 END) AS pos_count
+            FROM {table}
+            GROUP BY 1, 2, 3, 4, 5, 6, 7
+            """
         )
-        if prev_income > 0:
-            psdpm = (income_sum - prev_income) / prev_income
-        else:
-            psdpm = None
-
-    # avg_sunday: avg services.total where total>0
-    row = db_fetchone(
-        """
-        SELECT AVG(total) AS a
-        FROM services
-        WHERE month_id=?
-          AND account='main'
-          AND total>0
-          AND (income_type='donation' OR income_type IS NULL);
-        """,
-        (month_id,),
-    )
-    avg_sunday = float(row["a"]) if row and row["a"] is not None else 0.0
+    return " UNION ALL ".join(selects)
 
-    # counts / weekly min
-    override = m["sundays_override"]
-    sundays_count = int(override) if override else count_sundays_in_month(year, month)
-    weekly_min = calc_weekly_min_needed(m)
 
-    is_closed = bool(int(m["is_closed"] or 0) == 1) if table_has_column("months", "is_closed") else bool(
-        m["closed_at"] if table_has_column("months", "closed_at") else False
+def init_month_rollups() -> None:
+    with db_connect() as conn:
+        conn.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS month_rollups (
+                month_id INTEGER NOT NULL,
+                ym TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                account TEXT NOT NULL,
+                income_type TEXT NOT NULL DEFAULT '',
+                category TEXT NOT NULL DEFAULT '',
+                is_system INTEGER NOT NULL DEFAULT 0,
+                total REAL NOT NULL DEFAULT 0,
+                rows_count INTEGER NOT NULL DEFAULT 0,
+                pos_total REAL NOT NULL DEFAULT 0,
+                pos_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ({_ROLLUP_KEY})
+            );
+            CREATE INDEX IF NOT EXISTS idx_month_rollups_ym ON month_rollups(ym, kind, account);
+            {_rollup_triggers_sql()}
+            """
+        )
+        populated = conn.execute("SELECT 1 FROM month_rollups LIMIT 1;").fetchone()
+        has_data = conn.execute(
+            "SELECT 1 FROM services UNION ALL SELECT 1 FROM expenses LIMIT 1;"
+        ).fetchone()
+    if has_data and not populated:
+        rebuild_month_rollups()
+
+
+def rebuild_month_rollups() -> Dict[str, Any]:
+    with db_connect() as conn:
+        conn.execute("DELETE FROM month_rollups;")
+        conn.execute(
+            f"""
+            INSERT INTO month_rollups ({_ROLLUP_KEY}, total, rows_count, pos_total, pos_count)
+            {_rollup_expected_sql()};
+            """
+        )
+        count = conn.execute("SELECT COUNT(*) AS c FROM month_rollups;").fetchone()["c"]
+    return {"ok": True, "rows": int(count)}
+
+
+def verify_month_rollups(tolerance: float = 0.005) -> Dict[str, Any]:
+    def key(r: sqlite3.Row) -> Tuple[Any, ...]:
+        return tuple(r[k] for k in ("month_id", "ym", "kind", "account", "income_type", "category", "is_system"))
+
+    expected = {key(r): r for r in db_fetchall(_rollup_expected_sql())}
+    actual = {key(r): r for r in db_fetchall("SELECT * FROM month_rollups;")}
+    drift: List[Dict[str, Any]] = []
+    for k in sorted(set(expected) | set(actual), key=lambda x: tuple(str(v) for v in x)):
+        e, a = expected.get(k), actual.get(k)
+        e_total = float(e["total"]) if e else 0.0
+        a_total = float(a["total"]) if a else 0.0
+        e_count = int(e["rows_count"]) if e else 0
+        a_count = int(a["rows_count"]) if a else 0
+        if abs(e_total - a_total) > tolerance or e_count != a_count:
+            drift.append(
+                {
+                    "month_id": k[0],
+                    "ym": k[1],
+                    "kind": k[2],
+                    "account": k[3],
+                    "income_type": k[4],
+                    "category": k[5],
+                    "is_system": k[6],
+                    "expected_total": round(e_total, 2),
+                    "actual_total": round(a_total, 2),
+                    "expected_rows": e_count,
+                    "actual_rows": a_count,
+                }
+            )
+    return {"ok": not drift, "checked": len(expected), "drift": drift}
+
+
+def _prev_year_month(year: int, month: int) -> Tuple[int, int]:
+    if month == 1:
+        return year - 1, 12
+    return year, month - 1
+
+
+def compute_months_aggregates(
+    month_rows: List[sqlite3.Row],
+    ensure_tithe: bool = True,
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Агрегаты по набору месяцев из month_rollups (без записи в БД):
+    income, expenses, balance, completion, psdpm, avg_sunday (счёт main).
+    Итоги services считаются как cashless+cash (как в recalc_services_for_month),
+    десятина — 10% пожертвований (ensure_tithe=False — сохранённая строка).
+    """
+    result: Dict[int, Dict[str, Any]] = {}
+    if not month_rows:
+        return result
+
+    # Предыдущие месяцы (для psdpm) одним запросом.
+    prev_keys = {
+        int(m["id"]): _prev_year_month(int(m["year"]), int(m["month"]))
+        for m in month_rows
+    }
+    wanted = sorted({y * 12 + mm for (y, mm) in prev_keys.values()})
+    prev_ids: Dict[Tuple[int, int], int] = {}
+    if wanted:
+        placeholders = ",".join("?" for _ in wanted)
+        for r in db_fetchall(
+            f"SELECT id, year, month FROM months WHERE year*12+month IN ({placeholders});",
+            tuple(wanted),
+        ):
+            prev_ids[(int(r["year"]), int(r["month"]))] = int(r["id"])
+
+    all_ids = sorted({int(m["id"]) for m in month_rows} | set(prev_ids.values()))
+    placeholders = ",".join("?" for _ in all_ids)
+
+    income_map: Dict[int, sqlite3.Row] = {
+        int(r["month_id"]): r
+        for r in db_fetchall(
+            f"""
+            SELECT
+                month_id,
+                COALESCE(SUM(total),0) AS income,
+                COALESCE(SUM(CASE WHEN income_type='donation' THEN total ELSE 0 END),0) AS donations,
+                SUM(CASE WHEN income_type='donation' THEN pos_total ELSE 0 END)
+                    / NULLIF(SUM(CASE WHEN income_type='donation' THEN pos_count ELSE 0 END), 0) AS avg_sunday
+            FROM month_rollups
+            WHERE kind='income' AND account='main' AND month_id IN ({placeholders})
+            GROUP BY month_id;
+            """,
+            tuple(all_ids),
+        )
+    }
+    expense_map: Dict[int, sqlite3.Row] = {
+        int(r["month_id"]): r
+        for r in db_fetchall(
+            f"""
+            SELECT
+                month_id,
+                COALESCE(SUM(CASE WHEN is_system=1 THEN 0 ELSE total END),0) AS s,
+                COALESCE(SUM(CASE WHEN is_system=1 THEN total ELSE 0 END),0) AS tithe
+            FROM month_rollups
+            WHERE kind='expense' AND account='main' AND month_id IN ({placeholders})
+            GROUP BY month_id;
+            """,
+            tuple(all_ids),
+        )
+    }
+
+    for m in month_rows:
+        month_id = int(m["id"])
+        inc = income_map.get(month_id)
+        exp = expense_map.get(month_id)
+        income_sum = float(inc["income"]) if inc else 0.0
+        donations = float(inc["donations"]) if inc else 0.0
+        avg_sunday = float(inc["avg_sunday"]) if inc and inc["avg_sunday"] is not None else 0.0
+
+        expenses_sum = float(exp["s"]) if exp else 0.0
+        if ensure_tithe:
+            expenses_sum += calc_tithe_amount(donations)
+        else:
+            expenses_sum += float(exp["tithe"]) if exp else 0.0
+
+        monthly_min_needed = float(m["monthly_min_needed"] or 0.0)
+        completion = min(income_sum / monthly_min_needed, 1.0) if monthly_min_needed > 0 else 0.0
+
+        psdpm = None
+        prev_id = prev_ids.get(prev_keys[month_id])
+        if prev_id is not None:
+            prev_inc = income_map.get(prev_id)
+            prev_income = float(prev_inc["income"]) if prev_inc else 0.0
+            if prev_income > 0:
+                psdpm = (income_sum - prev_income) / prev_income
+
+        result[month_id] = {
+            "income": income_sum,
+            "expenses": expenses_sum,
+            "balance": income_sum - expenses_sum,
+            "min_needed": monthly_min_needed,
+            "completion": float(completion),
+            "psdpm": psdpm,
+            "avg_sunday": avg_sunday,
+        }
+    return result
+
+
+def compute_month_summary(month_id: int, ensure_tithe: bool = True) -> Dict[str, Any]:
+    """
+    Сводка месяца. Только чтение: поля services и десятина выводятся в памяти
+    (как их записали бы recalc_services_for_month/ensure_tithe_expense),
+    запись в БД происходит только при изменении данных.
+    ensure_tithe=False — брать сохранённую строку десятины как есть.
+    """
+    m = get_month_by_id(month_id)
+    agg = compute_months_aggregates([m], ensure_tithe=ensure_tithe)[int(m["id"])]
+    income_sum = agg["income"]
+    expenses_sum = agg["expenses"]
+
+    month_balance = round(income_sum - expenses_sum, 2)
+    start_balance = float(m["start_balance"] or 0.0)
+    fact_balance = round(start_balance + income_sum - expenses_sum, 2)
+
+    monthly_min_needed = float(m["monthly_min_needed"] or 0.0)
+    if income_sum > monthly_min_needed:
+        sddr = round(income_sum - monthly_min_needed, 2)
+    else:
+        sddr = 0.0
+
+    monthly_completion = agg["completion"]
+    psdpm = agg["psdpm"]
+    avg_sunday = agg["avg_sunday"]
+    year, month = int(m["year"]), int(m["month"])
+
+    # counts / weekly min
+    override = m["sundays_override"]
+    sundays_count = int(override) if override else count_sundays_in_month(year, month)
+    weekly_min = calc_weekly_min_needed(m)
+
+    is_closed = bool(int(m["is_closed"] or 0) == 1) if table_has_column("months", "is_closed") else bool(
+        m["closed_at"] if table_has_column("months", "closed_at") else False
     )
     closed_at = m["closed_at"] if table_has_column("months", "closed_at") else None
     closed_by = None
@@ -1728,7 +2332,7 @@ def compute_month_summary(month_id: int, ensure_tithe: bool = True) -> Dict[str,
     for account in ("praise", "alpha"):
         income = float(
             db_fetchone(
-                "SELECT COALESCE(SUM(total),0) AS s FROM services WHERE account=?;",
+                "SELECT COALESCE(SUM(ROUND(COALESCE(cashless,0)+COALESCE(cash,0), 2)),0) AS s FROM services WHERE account=?;",
                 (account,),
             )["s"]
         )
@@ -1771,7 +2375,12 @@ def compute_month_summary(month_id: int, ensure_tithe: bool = True) -> Dict[str,
 
 
 def compute_year_analytics(year: int) -> Dict[str, Any]:
-    months = db_fetchall("SELECT * FROM months WHERE year=? ORDER BY month ASC;", (year,))
+    all_months = db_fetchall(
+        "SELECT * FROM months WHERE year IN (?, ?) ORDER BY year ASC, month ASC;",
+        (year - 1, year),
+    )
+    aggregates = compute_months_aggregates(all_months, ensure_tithe=True)
+    months = [m for m in all_months if int(m["year"]) == year]
     month_map = {int(m["month"]): m for m in months}
 
     month_items: List[Dict[str, Any]] = []
@@ -1801,12 +2410,12 @@ def compute_year_analytics(year: int) -> Dict[str, Any]:
             )
             continue
 
-        summary = compute_month_summary(int(row["id"]), ensure_tithe=True)
-        income = float(summary["month_income_sum"])
-        expenses = float(summary["month_expenses_sum"])
-        balance = float(summary["month_balance"])
-        min_needed = float(summary["monthly_min_needed"])
-        completion = float(summary["monthly_completion"])
+        agg = aggregates[int(row["id"])]
+        income = round(agg["income"], 2)
+        expenses = round(agg["expenses"], 2)
+        balance = round(agg["balance"], 2)
+        min_needed = round(agg["min_needed"], 2)
+        completion = float(agg["completion"])
 
         totals["income"] += income
         totals["expenses"] += expenses
@@ -1864,13 +2473,13 @@ def compute_year_analytics(year: int) -> Dict[str, Any]:
         "min_needed": 0.0,
         "months_count": 0,
     }
-    prev_months = db_fetchall("SELECT id FROM months WHERE year=?;", (prev_year,))
+    prev_months = [m for m in all_months if int(m["year"]) == prev_year]
     for row in prev_months:
-        summary = compute_month_summary(int(row["id"]), ensure_tithe=True)
-        prev_totals["income"] += float(summary["month_income_sum"])
-        prev_totals["expenses"] += float(summary["month_expenses_sum"])
-        prev_totals["balance"] += float(summary["month_balance"])
-        prev_totals["min_needed"] += float(summary["monthly_min_needed"])
+        agg = aggregates[int(row["id"])]
+        prev_totals["income"] += round(agg["income"], 2)
+        prev_totals["expenses"] += round(agg["expenses"], 2)
+        prev_totals["balance"] += round(agg["balance"], 2)
+        prev_totals["min_needed"] += round(agg["min_needed"], 2)
         prev_totals["months_count"] += 1
 
     prev_totals["income"] = round(prev_totals["income"], 2)
@@ -1960,26 +2569,41 @@ def previous_period(period_type: str, year: int, month: Optional[int], quarter:
 
 
 def compute_period_totals(start: dt.date, end: dt.date) -> Dict[str, float]:
-    income = float(
-        db_fetchone(
-            """
-            SELECT COALESCE(SUM(total),0) AS s
-            FROM services
-            WHERE service_date BETWEEN ? AND ? AND account='main';
-            """,
-            (iso_date(start), iso_date(end)),
-        )["s"]
-    )
-    expenses = float(
-        db_fetchone(
+    whole_months = start.day == 1 and end == last_day_of_month(end.year, end.month)
+    if whole_months:
+        row = db_fetchone(
             """
-            SELECT COALESCE(SUM(total),0) AS s
-            FROM expenses
-            WHERE expense_date BETWEEN ? AND ? AND account='main';
+            SELECT
+                COALESCE(SUM(CASE WHEN kind='income' THEN total ELSE 0 END),0) AS income,
+                COALESCE(SUM(CASE WHEN kind='expense' THEN total ELSE 0 END),0) AS expenses
+            FROM month_rollups
+            WHERE ym BETWEEN ? AND ? AND account='main';
             """,
-            (iso_date(start), iso_date(end)),
-        )["s"]
-    )
+            (iso_date(start)[:7], iso_date(end)[:7]),
+        )
+        income = float(row["income"])
+        expenses = float(row["expenses"])
+    else:
+        income = float(
+            db_fetchone(
+                """
+                SELECT COALESCE(SUM(total),0) AS s
+                FROM services
+                WHERE service_date BETWEEN ? AND ? AND account='main';
+                """,
+                (iso_date(start), iso_date(end)),
+            )["s"]
+        )
+        expenses = float(
+            db_fetchone(
+                """
+                SELECT COALESCE(SUM(total),0) AS s
+                FROM expenses
+                WHERE expense_date BETWEEN ? AND ? AND account='main';
+                """,
+                (iso_date(start), iso_date(end)),
+            )["s"]
+        )
     net = income - expenses
     return {
         "income": round(income, 2),
@@ -2054,6 +2678,12 @@ def compute_period_analytics(
 # Audit
 # ---------------------------
 
+_AUDIT_INSERT_SQL = """
+    INSERT INTO audit_log (user_id, action, entity_type, entity_id, before_json, after_json, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?);
+"""
+
+
 def log_audit(
     user_id: Optional[int],
     action: str,
@@ -2062,26 +2692,38 @@ def log_audit(
     before: Optional[Dict[str, Any]],
     after: Optional[Dict[str, Any]],
 ) -> None:
+    log_audit_many([(user_id, action, entity_type, entity_id, before, after)])
+
+
+def log_audit_many(
+    entries: List[Tuple[Optional[int], str, str, Optional[int], Optional[Dict[str, Any]], Optional[Dict[str, Any]]]],
+) -> None:
+    """Пакетная запись аудита: (user_id, action, entity_type, entity_id, before, after)."""
+    if not entries:
+        return
     now = iso_now(CFG.tzinfo())
-    db_exec(
-        """
-        INSERT INTO audit_log (user_id, action, entity_type, entity_id, before_json, after_json, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?);
-        """,
-        (
-            user_id,
-            action,
-            entity_type,
-            entity_id,
-            json.dumps(before, ensure_ascii=False) if before is not None else None,
-            json.dumps(after, ensure_ascii=False) if after is not None else None,
-            now,
-        ),
+    # внутри db_connect() строки пишутся в ту же транзакцию, иначе — через db_writer
+    db_writer.submit_many(
+        CFG.DB_PATH,
+        _AUDIT_INSERT_SQL,
+        [
+            (
+                user_id,
+                action,
+                entity_type,
+                entity_id,
+                json.dumps(before, ensure_ascii=False) if before is not None else None,
+                json.dumps(after, ensure_ascii=False) if after is not None else None,
+                now,
+            )
+            for (user_id, action, entity_type, entity_id, before, after) in entries
+        ],
     )
 
 # ---------------------------
 # Monitoring logs
 # ---------------------------
+# Всё ниже — append-only строки: пишет db_writer (одна транзакция на пачку).
 
 def log_system_log(
     level: str,
@@ -2091,7 +2733,8 @@ def log_system_log(
     trace: Optional[str] = None,
 ) -> None:
     now = iso_now(CFG.tzinfo())
-    db_exec(
+    db_writer.submit(
+        CFG.DB_PATH,
         """
         INSERT INTO system_logs (level, source, message, details_json, trace, created_at)
         VALUES (?, ?, ?, ?, ?, ?);
@@ -2107,6 +2750,14 @@ def log_system_log(
     )
 
 
+def log_db_writer_error(message: str, details: Dict[str, Any]) -> None:
+    log_system_log("ERROR", "db_writer", message, details)
+
+
+def log_outbox_error(message: str, details: Dict[str, Any]) -> None:
+    log_system_log("ERROR", "outbox", message, details)
+
+
 def log_job_run(
     job_id: str,
     status: str,
@@ -2115,7 +2766,8 @@ def log_job_run(
     duration_ms: int,
     error: Optional[str],
 ) -> None:
-    db_exec(
+    db_writer.submit(
+        CFG.DB_PATH,
         """
         INSERT INTO job_runs (job_id, status, started_at, finished_at, duration_ms, error)
         VALUES (?, ?, ?, ?, ?, ?);
@@ -2124,19 +2776,30 @@ def log_job_run(
     )
 
 
+_DELIVERY_INSERT_SQL = """
+    INSERT INTO message_deliveries (kind, recipient_id, status, error, created_at)
+    VALUES (?, ?, ?, ?, ?);
+"""
+
+
 def log_message_delivery(
     kind: str,
     recipient_id: int,
     status: str,
     error: Optional[str],
 ) -> None:
+    log_message_deliveries([(kind, recipient_id, status, error)])
+
+
+def log_message_deliveries(entries: List[Tuple[str, int, str, Optional[str]]]) -> None:
+    """Пакетная запись доставок (kind, recipient_id, status, error) одним executemany."""
+    if not entries:
+        return
     now = iso_now(CFG.tzinfo())
-    db_exec(
-        """
-        INSERT INTO message_deliveries (kind, recipient_id, status, error, created_at)
-        VALUES (?, ?, ?, ?, ?);
-        """,
-        (kind, int(recipient_id), status, error, now),
+    db_writer.submit_many(
+        CFG.DB_PATH,
+        _DELIVERY_INSERT_SQL,
+        [(kind, int(recipient_id), status, error, now) for kind, recipient_id, status, error in entries],
     )
 
 
@@ -2163,18 +2826,82 @@ def get_bearer_token(request: Request) -> str:
     return h.split(" ", 1)[1].strip()
 
 
+# Кэш принципалов: sha256(token) -> (payload, строка users). Запись живёт
+# PRINCIPAL_CACHE_TTL_SEC и сбрасывается при новом снимке allowlist
+# (роль/active в users меняются только через sync_allowlist_to_db).
+PRINCIPAL_CACHE_TTL_SEC = float(os.getenv("PRINCIPAL_CACHE_TTL_SEC", "30") or 30)
+PRINCIPAL_CACHE_MAX = 1024
+PRINCIPAL_LOCK = threading.Lock()
+# digest -> (payload, user row, версия allowlist, monotonic deadline)
+PRINCIPAL_CACHE: "OrderedDict[bytes, Tuple[Dict[str, Any], sqlite3.Row, int, float]]" = OrderedDict()
+PRINCIPAL_CACHE_STATS: Dict[str, int] = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def invalidate_principal_cache(telegram_ids: Optional[Any] = None) -> None:
+    """Сбросить кэш целиком или только для указанных telegram_id."""
+    with PRINCIPAL_LOCK:
+        if telegram_ids is None:
+            PRINCIPAL_CACHE.clear()
+        else:
+            ids = {int(t) for t in telegram_ids}
+            for key in [k for k, v in PRINCIPAL_CACHE.items() if int(v[1]["telegram_id"]) in ids]:
+                del PRINCIPAL_CACHE[key]
+        PRINCIPAL_CACHE_STATS["invalidations"] += 1
+
+
+def principal_cache_stats() -> Dict[str, Any]:
+    with PRINCIPAL_LOCK:
+        stats: Dict[str, Any] = dict(PRINCIPAL_CACHE_STATS)
+        stats["size"] = len(PRINCIPAL_CACHE)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / total, 4) if total else None
+    stats["ttl_sec"] = PRINCIPAL_CACHE_TTL_SEC
+    return stats
+
+
+def _principal_cache_get(key: bytes, version: int) -> Optional[sqlite3.Row]:
+    with PRINCIPAL_LOCK:
+        entry = PRINCIPAL_CACHE.get(key)
+        if entry is None:
+            PRINCIPAL_CACHE_STATS["misses"] += 1
+            return None
+        payload, u, entry_version, deadline = entry
+        exp = int(payload.get("exp", 0))
+        if entry_version != version or time.monotonic() > deadline or (exp and int(time.time()) > exp):
+            del PRINCIPAL_CACHE[key]
+            PRINCIPAL_CACHE_STATS["misses"] += 1
+            return None
+        PRINCIPAL_CACHE.move_to_end(key)
+        PRINCIPAL_CACHE_STATS["hits"] += 1
+        return u
+
+
+def _principal_cache_put(key: bytes, payload: Dict[str, Any], u: sqlite3.Row, version: int) -> None:
+    with PRINCIPAL_LOCK:
+        PRINCIPAL_CACHE[key] = (payload, u, version, time.monotonic() + PRINCIPAL_CACHE_TTL_SEC)
+        PRINCIPAL_CACHE.move_to_end(key)
+        while len(PRINCIPAL_CACHE) > PRINCIPAL_CACHE_MAX:
+            PRINCIPAL_CACHE.popitem(last=False)
+
+
 def get_current_user(request: Request) -> sqlite3.Row:
     token = get_bearer_token(request)
+    # обновляем allowlist, чтобы роли в БД не отставали от users.json
+    version = allowlist.current().version
+    key = hashlib.sha256(token.encode("utf-8")).digest()
+    cached = _principal_cache_get(key, version)
+    if cached is not None:
+        return cached
+
     payload = verify_session_token(token, CFG.SESSION_SECRET)
     telegram_id = int(payload.get("telegram_id", 0))
     if not telegram_id:
         raise HTTPException(status_code=401, detail="Invalid token payload")
 
-    # обновляем allowlist, чтобы роли в БД не отставали от users.json
-    refresh_allowlist_if_needed()
     u = db_fetchone("SELECT * FROM users WHERE telegram_id=?;", (telegram_id,))
     if not u or int(u["active"]) != 1:
         raise HTTPException(status_code=403, detail="User not allowed / inactive")
+    _principal_cache_put(key, payload, u, version)
     return u
 
 
@@ -2421,23 +3148,6 @@ def format_telegram_exception(exc: Exception) -> str:
     return f"{msg}. {hint}".strip()
 
 
-async def bot_send_safe(
-    chat_id: int,
-    text: str,
-    reply_markup: Optional[InlineKeyboardMarkup] = None,
-) -> Tuple[bool, Optional[str]]:
-    if not bot:
-        return False, "Bot is not initialized"
-    try:
-        await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-        return True, None
-    except Exception as exc:
-        # avoid crashing scheduler/bot
-        msg = format_telegram_exception(exc)
-        print("Failed to send message:", msg)
-        return False, msg
-
-
 async def bot_send_or_http_error(
     chat_id: int,
     text: str,
@@ -2446,7 +3156,9 @@ async def bot_send_or_http_error(
     if not bot:
         raise HTTPException(status_code=503, detail="Bot is not initialized")
     try:
-        await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+        await tg_delivery.send_with_limits(
+            chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+        )
     except TelegramForbiddenError as exc:
         raise HTTPException(status_code=403, detail=format_telegram_exception(exc))
     except TelegramBadRequest as exc:
@@ -2479,26 +3191,74 @@ async def send_report_to_recipients(
         if raise_on_error:
             raise HTTPException(status_code=400, detail="No report recipients configured")
         return
+
+    # allowlist читаем один раз на рассылку
+    allow = refresh_allowlist_if_needed()
+
+    def _markup_for(chat_id: int) -> Optional[InlineKeyboardMarkup]:
+        u = allow.get(int(chat_id))
+        return reply_markup if (u and u.get("active") is True) else None
+
+    if not raise_on_error:
+        # фоновые рассылки — через outbox: переживают рестарт и ошибки сети,
+        # повтор того же отчёта тому же получателю в тот же день не дублируется
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+        day = dt.datetime.now(CFG.tzinfo()).date().isoformat()
+        await asyncio.to_thread(
+            outbox.enqueue_many,
+            [
+                (kind, int(chat_id), text, _markup_for(chat_id), f"{kind}:{int(chat_id)}:{day}:{digest}")
+                for chat_id in dict.fromkeys(int(c) for c in recipients)
+            ],
+            priority=outbox.PRIORITY_REPORT,
+        )
+        return
+
+    if not bot:
+        log_message_deliveries([(kind, chat_id, "fail", "Bot is not initialized") for chat_id in recipients])
+        raise HTTPException(status_code=502, detail="; ".join(f"{c}: Bot is not initialized" for c in recipients))
+
+    results = await tg_delivery.fan_out(
+        recipients,
+        lambda chat_id: bot.send_message(chat_id=chat_id, text=text, reply_markup=_markup_for(chat_id)),
+    )
+    _finish_fan_out(kind, results, raise_on_error)
+
+
+def _finish_fan_out(kind: str, results: List[tg_delivery.DeliveryResult], raise_on_error: bool) -> None:
+    entries: List[Tuple[str, int, str, Optional[str]]] = []
     errors: List[str] = []
-    for chat_id in recipients:
-        safe_markup = reply_markup if is_allowed_telegram_user(chat_id) else None
-        try:
-            if raise_on_error:
-                await bot_send_or_http_error(chat_id, text, safe_markup)
-                log_message_delivery(kind, chat_id, "success", None)
-            else:
-                ok, err = await bot_send_safe(chat_id, text, safe_markup)
-                if ok:
-                    log_message_delivery(kind, chat_id, "success", None)
-                else:
-                    log_message_delivery(kind, chat_id, "fail", err)
-        except HTTPException as exc:
-            log_message_delivery(kind, chat_id, "fail", str(exc.detail))
-            errors.append(f"{chat_id}: {exc.detail}")
+    for res in results:
+        if res.ok:
+            entries.append((kind, res.chat_id, "success", None))
+            continue
+        msg = format_telegram_exception(res.error) if isinstance(res.error, Exception) else str(res.error)
+        entries.append((kind, res.chat_id, "fail", msg))
+        errors.append(f"{res.chat_id}: {msg}")
+    log_message_deliveries(entries)
+    if errors:
+        # по строке на получателя уже есть в message_deliveries — здесь одна сводка
+        log_system_log(
+            "WARN",
+            "telegram.send",
+            f"Не доставлено {len(errors)} из {len(results)} ({kind})",
+            {"kind": kind, "failed": len(errors), "total": len(results), "errors": errors[:20]},
+        )
     if errors and raise_on_error:
         raise HTTPException(status_code=502, detail="; ".join(errors))
 
 
+# Ответы Telegram на file_id, который этому боту больше не годится
+STALE_FILE_ID_MARKERS = ("wrong file identifier", "wrong remote file identifier", "file reference", "file_reference")
+
+
+def is_stale_file_id_error(exc: Any) -> bool:
+    if not isinstance(exc, TelegramBadRequest):
+        return False
+    text = str(getattr(exc, "message", "") or exc).lower()
+    return any(marker in text for marker in STALE_FILE_ID_MARKERS)
+
+
 async def send_report_png_to_recipients(
         png_bytes: bytes,
         filename: str,
@@ -2506,7 +3266,13 @@ async def send_report_png_to_recipients(
         recipients: List[int],
         raise_on_error: bool,
         kind: str = "report_png",
+        cache_key: Optional[str] = None,
 ) -> None:
+    """
+    PNG загружается в Telegram один раз: остальным получателям уходит file_id
+    первого успешного send_document. С cache_key (ключ кэша PNG) file_id
+    сохраняется в report_file_ids, и повторная отправка того же отчёта идёт без upload.
+    """
     if not recipients:
         if raise_on_error:
             raise HTTPException(status_code=400, detail="No report recipients configured")
@@ -2516,19 +3282,50 @@ async def send_report_png_to_recipients(
             raise HTTPException(status_code=503, detail="Bot is not initialized")
         return
 
-    errors: List[str] = []
-    for chat_id in recipients:
-        try:
-            payload = BufferedInputFile(png_bytes, filename=filename)
-            await bot.send_document(chat_id=chat_id, document=payload, caption=caption)
-            log_message_delivery(kind, chat_id, "success", None)
-        except Exception as exc:
-            msg = format_telegram_exception(exc)
-            log_message_delivery(kind, chat_id, "fail", msg)
-            if raise_on_error:
-                errors.append(f"{chat_id}: {msg}")
-    if errors and raise_on_error:
-        raise HTTPException(status_code=502, detail="; ".join(errors))
+    def _upload(chat_id: int) -> Awaitable[Any]:
+        return bot.send_document(
+            chat_id=chat_id,
+            document=BufferedInputFile(png_bytes, filename=filename),
+            caption=caption,
+        )
+
+    file_id = await asyncio.to_thread(get_report_file_id, cache_key) if cache_key else None
+    # file_id из report_file_ids проверяем на первом получателе, прежде чем слать остальным
+    verified = file_id is None
+    pending = list(dict.fromkeys(int(c) for c in recipients))
+    results: List[tg_delivery.DeliveryResult] = []
+
+    def _send_by_file_id(chat_id: int) -> Awaitable[Any]:
+        return bot.send_document(chat_id=chat_id, document=file_id, caption=caption)
+
+    while pending:
+        if file_id is None:
+            # первая успешная загрузка даёт file_id для остальных
+            res = (await tg_delivery.fan_out([pending.pop(0)], _upload))[0]
+            results.append(res)
+            document = getattr(res.value, "document", None) if res.ok else None
+            if document is not None and getattr(document, "file_id", None):
+                file_id = str(document.file_id)
+                verified = True
+                if cache_key:
+                    await asyncio.to_thread(save_report_file_id, cache_key, file_id, getattr(document, "file_unique_id", None))
+            continue
+        if not verified:
+            res = (await tg_delivery.fan_out([pending[0]], _send_by_file_id))[0]
+            if not res.ok and is_stale_file_id_error(res.error):
+                # file_id устарел (другой бот/токен): забываем его, этот получатель
+                # остаётся в очереди и получит PNG загрузкой, новый file_id сохраним
+                file_id = None
+                if cache_key:
+                    await asyncio.to_thread(delete_report_file_id, cache_key)
+                continue
+            pending.pop(0)
+            results.append(res)
+            verified = True
+            continue
+        results.extend(await tg_delivery.fan_out(pending, _send_by_file_id))
+        pending = []
+    _finish_fan_out(kind, results, raise_on_error)
 
 
 @router.message(Command("start"))
@@ -2892,9 +3689,6 @@ def build_sunday_report_text(today: dt.date) -> Tuple[str, Optional[InlineKeyboa
     m = get_or_create_month(s_date.year, s_date.month)
     month_id = int(m["id"])
 
-    recalc_services_for_month(month_id)
-    ensure_tithe_expense(month_id, user_id=None)
-
     service = db_fetchone(
         """
         SELECT * FROM services
@@ -2902,12 +3696,13 @@ def build_sunday_report_text(today: dt.date) -> Tuple[str, Optional[InlineKeyboa
         """,
         (month_id, s_date.isoformat()),
     )
+    derived = derive_service_fields(service, calc_weekly_min_needed(m)) if service else None
     cashless = float(service["cashless"]) if service else 0.0
     cash = float(service["cash"]) if service else 0.0
-    total = float(service["total"]) if service else 0.0
-    weekly_min = float(service["weekly_min_needed"]) if service else calc_weekly_min_needed(m)
-    status = str(service["mnsps_status"]) if service else ("Собрана" if (weekly_min and total >= weekly_min) else "Не собрана")
-    pvs = float(service["pvs_ratio"]) if service else ((total / weekly_min) if weekly_min else 0.0)
+    total = float(derived["total"]) if derived else 0.0
+    weekly_min = float(derived["weekly_min_needed"]) if derived else calc_weekly_min_needed(m)
+    status = str(derived["mnsps_status"]) if derived else ("Собрана" if (weekly_min and total >= weekly_min) else "Не собрана")
+    pvs = float(derived["pvs_ratio"]) if derived else ((total / weekly_min) if weekly_min else 0.0)
 
     summary = compute_month_summary(month_id, ensure_tithe=True)
 
@@ -2941,7 +3736,6 @@ def build_month_expenses_report_text(today: dt.date) -> Tuple[str, Optional[Inli
     m = get_or_create_month(today.year, today.month)
     month_id = int(m["id"])
 
-    ensure_tithe_expense(month_id, user_id=None)
     summary = compute_month_summary(month_id, ensure_tithe=True)
 
     rows = db_fetchall(
@@ -3121,7 +3915,9 @@ async def send_sunday_reports_bundle(
     await send_report_to_recipients(text, kb, recipients, raise_on_error=raise_on_error, kind="report")
 
     month_row = get_or_create_month(today.year, today.month)
-    png_data, filename, month_meta = build_month_report_png(int(month_row["id"]), preset="landscape", pixel_ratio=2, dpi=192)
+    png_data, filename, month_meta, cache_key = await render_month_report_png_keyed(
+        int(month_row["id"]), preset="landscape", pixel_ratio=2, dpi=192
+    )
     caption = f"PNG-отчёт за {RU_MONTHS[int(month_meta['month']) - 1]} {int(month_meta['year'])}"
     await send_report_png_to_recipients(
         png_data,
@@ -3130,6 +3926,7 @@ async def send_sunday_reports_bundle(
         recipients,
         raise_on_error=raise_on_error,
         kind="report_png",
+        cache_key=cache_key,
     )
 
 async def run_sunday_report_job() -> None:
@@ -3264,6 +4061,7 @@ def create_db_backup(tzinfo: ZoneInfo) -> Path:
     stamp = backup_timestamp(tzinfo)
     temp_path = BACKUPS_DIR / f".tmp_db_{stamp}.sqlite3"
     dest_path = BACKUPS_DIR / f"db_{stamp}.sqlite3"
+    db_checkpoint()
     shutil.copy2(CFG.DB_PATH, temp_path)
     os.replace(temp_path, dest_path)
     enforce_backup_retention(tzinfo)
@@ -3277,6 +4075,7 @@ def create_full_backup(tzinfo: ZoneInfo) -> Path:
     temp_zip = BACKUPS_DIR / f".tmp_full_{stamp}.zip"
     dest_zip = BACKUPS_DIR / f"full_{stamp}.zip"
 
+    db_checkpoint()
     shutil.copy2(CFG.DB_PATH, temp_db)
     with zipfile.ZipFile(temp_zip, "w", compression=zipfile.ZIP_DEFLATED) as zf:
         zf.write(temp_db, arcname="db.sqlite3")
@@ -3328,17 +4127,12 @@ async def run_backup_job() -> None:
 async def lifespan(app: FastAPI):
     # init DB
     init_db()
+    db_writer.start(CFG.DB_PATH, on_error=log_db_writer_error)
+    bootstrap_cashflow()
+    preload_fonts()
 
-    # load allowlist and sync to db
-    allow = load_allowlist()
-    sync_allowlist_to_db(allow)
-    app.state.allowlist = allow
-    global ALLOWLIST_CACHE, ALLOWLIST_MTIME
-    ALLOWLIST_CACHE = allow
-    try:
-        ALLOWLIST_MTIME = os.path.getmtime(CFG.USERS_JSON_PATH)
-    except FileNotFoundError:
-        ALLOWLIST_MTIME = None
+    # load allowlist and sync to db (дальше — при каждом изменении users.json)
+    app.state.allowlist = allowlist.reload().users
 
     # init bot + dp
     global bot, dp
@@ -3351,7 +4145,14 @@ async def lifespan(app: FastAPI):
     import cashflow_bot
 
     cashflow_bot.set_bot(bot)
-
+    outbox.configure(
+        CFG.DB_PATH,
+        lambda: bot,
+        on_delivered=log_message_deliveries,
+        format_error=format_telegram_exception,
+        on_error=log_outbox_error,
+    )
+    outbox.start_worker()
 
     dp = Dispatcher()
     dp.include_router(router)
@@ -3371,6 +4172,10 @@ async def lifespan(app: FastAPI):
             polling_task.cancel()
         except Exception:
             pass
+        try:
+            await outbox.stop_worker()
+        except Exception:
+            pass
         try:
             await bot.session.close()  # type: ignore[union-attr]
         except Exception:
@@ -3379,6 +4184,15 @@ async def lifespan(app: FastAPI):
             scheduler.shutdown(wait=False)
         except Exception:
             pass
+        try:
+            shutdown_render_pool()
+        except Exception:
+            pass
+        # последним: задачи выше ещё могут писать логи
+        try:
+            db_writer.stop()
+        except RuntimeError as exc:
+            print("db_writer stop failed:", exc)
 
 
 APP = FastAPI(title="Church Accounting Bot", version="1.0.0", lifespan=lifespan)
@@ -3478,7 +4292,7 @@ def cashapp():
 
 @APP.post("/api/auth/telegram", response_model=AuthOut)
 def auth_telegram(body: AuthTelegramIn, request: Request):
-    user_obj = validate_telegram_init_data(body.initData, CFG.BOT_TOKEN)
+    user_obj, repeat = verify_telegram_init_data_cached(body.initData, CFG.BOT_TOKEN)
     telegram_id = int(user_obj.get("id", 0))
     if not telegram_id:
         raise HTTPException(status_code=401, detail="Invalid Telegram user id")
@@ -3488,8 +4302,10 @@ def auth_telegram(body: AuthTelegramIn, request: Request):
     if not allow_user or not allow_user.get("active"):
         raise HTTPException(status_code=403, detail="User not in allowlist or inactive")
 
-    # sync single user from allowlist (in case file changed)
-    sync_allowlist_to_db({telegram_id: allow_user})
+    # sync single user from allowlist (in case file changed); при повторном входе
+    # с тем же initData users уже синхронизирован слушателем allowlist
+    if not repeat:
+        sync_allowlist_to_db({telegram_id: allow_user})
 
     u = db_fetchone("SELECT * FROM users WHERE telegram_id=?;", (telegram_id,))
     if not u or int(u["active"]) != 1:
@@ -3781,9 +4597,9 @@ def list_services(
     month_id: int,
     u: sqlite3.Row = Depends(require_role("admin", "accountant", "viewer")),
 ):
-    recalc_services_for_month(month_id)
-    rows = db_fetchall("SELECT * FROM services WHERE month_id=? ORDER BY service_date ASC;", (month_id,))
-    return {"items": [dict(r) for r in rows]}
+    m = get_month_by_id(month_id)
+    rows = db_fetchall("SELECT * FROM services WHERE month_id=? ORDER BY service_date ASC, id ASC;", (month_id,))
+    return {"items": derive_month_services(m, rows)}
 
 
 @APP.post("/api/months/{month_id}/services")
@@ -4222,7 +5038,6 @@ def list_expenses(
         mode: str = Query(default="any"),
         u: sqlite3.Row = Depends(require_role("admin", "accountant", "viewer")),
 ):
-    ensure_tithe_expense(month_id, user_id=None)
     tag_filters: List[str] = []
     if tags:
         tag_filters = normalize_tag_list(tags.split(","))
@@ -4337,6 +5152,188 @@ def create_expense(
     return {"id": new_id, "warnings": warnings}
 
 
+def parse_expense_batch_csv(raw: bytes) -> List[Dict[str, Any]]:
+    """
+    CSV с заголовком: expense_date, category, title, qty, unit_amount, comment, tags, account.
+    Разделитель , ; или табуляция; tags — через запятую внутри поля.
+    """
+    import csv
+
+    text = raw.decode("utf-8-sig", errors="replace")
+    if not text.strip():
+        return []
+    header = text.splitlines()[0]
+    try:
+        dialect: Any = csv.Sniffer().sniff(header, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    rows: List[Dict[str, Any]] = []
+    for rec in csv.DictReader(io.StringIO(text), dialect=dialect):
+        item = {str(k or "").strip().lower(): (v.strip() if isinstance(v, str) else v) for k, v in rec.items()}
+        item = {k: v for k, v in item.items() if k and v not in (None, "")}
+        if "tags" in item:
+            item["tags"] = [t for t in re.split(r"[,|]", str(item["tags"])) if t.strip()]
+        rows.append(item)
+    return rows
+
+
+def import_expenses_batch(month_id: int, raw_rows: List[Any], u: sqlite3.Row) -> Dict[str, Any]:
+    ensure_month_open(month_id)
+    get_month_by_id(month_id)
+    if len(raw_rows) > MAX_EXPENSE_BATCH_ROWS:
+        raise HTTPException(status_code=413, detail=f"Too many rows (max {MAX_EXPENSE_BATCH_ROWS})")
+
+    role = str(u["role"])
+    user_id = int(u["id"])
+    results: List[Dict[str, Any]] = [{"row": i + 1, "ok": False} for i in range(len(raw_rows))]
+    valid: List[Tuple[int, ExpenseIn, str]] = []
+    for i, raw in enumerate(raw_rows):
+        try:
+            if not isinstance(raw, dict):
+                raise ValueError("row must be an object")
+            body = ExpenseIn.model_validate(raw)
+            account = normalize_account(body.account)
+        except HTTPException as e:
+            results[i]["error"] = str(e.detail)
+            continue
+        except ValidationError as e:
+            results[i]["error"] = "; ".join(
+                f"{'.'.join(str(x) for x in err.get('loc', ()))}: {err.get('msg')}" for err in e.errors()
+            )
+            continue
+        except Exception as e:
+            results[i]["error"] = str(e).splitlines()[0] if str(e) else type(e).__name__
+            continue
+        valid.append((i, body, account))
+
+    now = iso_now(CFG.tzinfo())
+    created_ids: List[int] = []
+    if valid:
+        with db_connect() as conn:
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE;")
+            categories = resolve_categories_bulk(conn, [b.category for _, b, _ in valid], role, user_id)
+            all_tags = [t for _, b, _ in valid for t in (b.tags or [])]
+            tag_ids = resolve_tags_bulk(conn, all_tags, role, user_id)
+
+            max_id = int(conn.execute("SELECT COALESCE(MAX(id),0) AS m FROM expenses;").fetchone()["m"])
+            conn.executemany(
+                """
+                INSERT INTO expenses (
+                    month_id, expense_date, category, title, qty, unit_amount, total, comment,
+                    is_system, account, created_at, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?);
+                """,
+                [
+                    (
+                        month_id,
+                        b.expense_date.isoformat(),
+                        categories[b.category],
+                        b.title,
+                        float(b.qty),
+                        float(b.unit_amount),
+                        round(float(b.qty) * float(b.unit_amount), 2),
+                        b.comment,
+                        account,
+                        now,
+                        now,
+                    )
+                    for _, b, account in valid
+                ],
+            )
+            # Под BEGIN IMMEDIATE других писателей нет: новые id идут подряд в порядке вставки.
+            created_ids = [
+                int(r["id"])
+                for r in conn.execute("SELECT id FROM expenses WHERE id>? ORDER BY id ASC;", (max_id,))
+            ]
+            if len(created_ids) != len(valid):
+                raise HTTPException(status_code=500, detail="Batch insert id mismatch")
+
+            links: List[Tuple[int, int]] = []
+            tag_names_by_id: Dict[int, List[str]] = {}
+            for new_id, (_, b, _) in zip(created_ids, valid):
+                names = normalize_tag_list(b.tags)
+                tag_names_by_id[new_id] = names
+                for norm in dict.fromkeys(normalize_tag_name(n) for n in names):
+                    links.append((new_id, tag_ids[norm]))
+            if links:
+                conn.executemany("INSERT INTO expense_tags (expense_id, tag_id) VALUES (?, ?);", links)
+
+            placeholders = ",".join("?" for _ in created_ids)
+            after_rows = {
+                int(r["id"]): dict(r)
+                for r in conn.execute(f"SELECT * FROM expenses WHERE id IN ({placeholders});", tuple(created_ids))
+            }
+            audit: List[Tuple[Optional[int], str, str, Optional[int], Optional[Dict[str, Any]], Optional[Dict[str, Any]]]] = []
+            for new_id in created_ids:
+                payload = after_rows.get(new_id)
+                if payload is not None:
+                    payload["tags"] = tag_names_by_id.get(new_id, [])
+                audit.append((user_id, "CREATE", "expense", new_id, None, payload))
+            log_audit_many(audit)
+
+        for new_id, (i, b, account) in zip(created_ids, valid):
+            results[i].update({"ok": True, "id": new_id, "category": categories[b.category], "account": account})
+
+    # Один пересчёт на весь пакет.
+    ensure_tithe_expense(month_id, user_id=user_id)
+    warnings: List[Dict[str, Any]] = []
+    main_categories = sorted({categories[b.category] for _, b, account in valid if account == "main"}) if valid else []
+    for category in main_categories:
+        budget_warning = get_budget_warning_for_category(month_id, category)
+        if budget_warning:
+            warnings.append(budget_warning)
+
+    return {
+        "created": len(created_ids),
+        "failed": len(raw_rows) - len(created_ids),
+        "items": results,
+        "warnings": warnings,
+    }
+
+
+@APP.post("/api/months/{month_id}/expenses:batch")
+async def create_expenses_batch(
+    month_id: int,
+    request: Request,
+    u: sqlite3.Row = Depends(require_role("admin", "accountant")),
+):
+    """
+    Пакетный ввод расходов. Тело: JSON-массив строк ExpenseIn (или {"items": [...]}),
+    либо CSV (text/csv или multipart-поле file). Невалидные строки пропускаются,
+    валидные вставляются одной транзакцией; в ответе — результат по каждой строке.
+    """
+    content_type = (request.headers.get("content-type") or "").lower()
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Missing file")
+        raw = await upload.read(MAX_EXPENSE_BATCH_BYTES + 1)
+        if len(raw) > MAX_EXPENSE_BATCH_BYTES:
+            raise HTTPException(status_code=413, detail="Batch file is too large")
+        rows: List[Any] = parse_expense_batch_csv(raw)
+    else:
+        raw = await request.body()
+        if len(raw) > MAX_EXPENSE_BATCH_BYTES:
+            raise HTTPException(status_code=413, detail="Batch is too large")
+        if content_type.startswith("text/csv"):
+            rows = parse_expense_batch_csv(raw)
+        else:
+            try:
+                payload = json.loads(raw or b"[]")
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid JSON")
+            if isinstance(payload, dict):
+                payload = payload.get("items")
+            if not isinstance(payload, list):
+                raise HTTPException(status_code=400, detail="Expected a list of expenses")
+            rows = payload
+    if not rows:
+        raise HTTPException(status_code=400, detail="No rows")
+    return await asyncio.to_thread(import_expenses_batch, month_id, rows, u)
+
+
 @APP.put("/api/expenses/{expense_id}")
 def update_expense(
     expense_id: int,
@@ -4858,6 +5855,15 @@ def api_monitor_overview(
         "errors_24h": int(error_row["c"]) if error_row else 0,
         "failed_deliveries_24h": int(fail_row["c"]) if fail_row else 0,
         "jobs": [dict(r) for r in job_rows],
+        "png_cache": png_cache_stats(),
+        "fonts": font_registry_stats(),
+        "card_sprites": card_sprite_stats(),
+        "render": render_service_stats(),
+        "telegram": tg_delivery.delivery_stats(),
+        "allowlist": allowlist.allowlist_stats(),
+        "auth": principal_cache_stats(),
+        "init_data": init_data_cache_stats(),
+        "db_writer": db_writer.writer_stats(),
     }
 
 
@@ -4908,7 +5914,24 @@ def api_monitor_deliveries(
         f"SELECT * FROM message_deliveries {where} ORDER BY created_at DESC LIMIT ?;",
         tuple(params),
     )
-    return {"items": [dict(r) for r in rows]}
+    return {"items": [dict(r) for r in rows], "outbox": outbox.outbox_stats()}
+
+
+@APP.get("/api/admin/rollups/verify")
+def api_rollups_verify(
+    u: sqlite3.Row = Depends(require_role("admin")),
+):
+    return verify_month_rollups()
+
+
+@APP.post("/api/admin/rollups/rebuild")
+def api_rollups_rebuild(
+    u: sqlite3.Row = Depends(require_role("admin")),
+):
+    before = verify_month_rollups()
+    result = rebuild_month_rollups()
+    log_audit(int(u["id"]), "REBUILD", "month_rollups", None, {"drift": len(before["drift"])}, result)
+    return {**result, "drift_fixed": len(before["drift"])}
 
 
 # ---------------------------
@@ -4965,6 +5988,7 @@ def _ensure_diag_schema() -> None:
     ):
         if not table_has_column("diagnostic_runs", col):
             db_exec(f"ALTER TABLE diagnostic_runs ADD COLUMN {col} {ddl};")
+            invalidate_schema_capabilities("diagnostic_runs")
     for col, ddl in (
         ("title_ru", "TEXT NULL"),
         ("category", "TEXT NULL"),
@@ -4976,6 +6000,7 @@ def _ensure_diag_schema() -> None:
     ):
         if not table_has_column("diagnostic_steps", col):
             db_exec(f"ALTER TABLE diagnostic_steps ADD COLUMN {col} {ddl};")
+            invalidate_schema_capabilities("diagnostic_steps")
 
 
 class DiagnosticsRunOptions(BaseModel):
@@ -5193,7 +6218,7 @@ async def _diag_reports_png(ctx: DiagnosticsContext) -> Dict[str, Any]:
         month = conn.execute("SELECT id FROM months ORDER BY year DESC, month DESC LIMIT 1;").fetchone()
     if not month:
         return {"status": "warn", "message_ru": "Нет данных месяца для генерации PNG", "details": {}}
-    png, _, _ = build_month_report_png(int(month["id"]), preset="square", pixel_ratio=1, dpi=96)
+    png, _, _ = await render_month_report_png_async(int(month["id"]), preset="square", pixel_ratio=1, dpi=96)
     ok = png.startswith(b"\x89PNG\r\n\x1a\n") and len(png) > 100
     if not ok:
         return {"status": "fail", "message_ru": "PNG-файл имеет неверную сигнатуру", "details": {"size": len(png)}}
@@ -5232,6 +6257,8 @@ async def _diag_backup_db(ctx: DiagnosticsContext) -> Dict[str, Any]:
     backup_dir.mkdir(parents=True, exist_ok=True)
     stamp = dt.datetime.now(CFG.tzinfo()).strftime("%Y%m%d_%H%M%S")
     dst = backup_dir / f"diag_{ctx.run_id}_{stamp}.sqlite3"
+    if ctx.selected_db_path() == Path(CFG.DB_PATH):
+        db_checkpoint()
     shutil.copy2(ctx.selected_db_path(), dst)
     return {"status": "success", "message_ru": "Резервная копия БД создана", "details": {"file": str(dst), "size": dst.stat().st_size}}
 
@@ -5353,6 +6380,7 @@ async def _run_diagnostics(run_id: int, suite: str, mode: str, options: Diagnost
     if mode in ("sandbox", "live"):
         ctx.sandbox_dir = Path(tempfile.mkdtemp(prefix=f"diag_{run_id}_"))
         ctx.sandbox_db = ctx.sandbox_dir / "db.sqlite3"
+        db_checkpoint()
         shutil.copy2(CFG.DB_PATH, ctx.sandbox_db)
 
     try:
@@ -5669,11 +6697,54 @@ def api_download_backup(
     return FileResponse(path, media_type="application/octet-stream", filename=name)
 
 
-@APP.post("/api/backups/restore")
-async def api_restore_backup(
-    file: UploadFile = File(...),
-    u: sqlite3.Row = Depends(require_role("admin")),
-):
+def restore_backup_files(
+    candidate_db: Path,
+    uploads_dir: Optional[Path],
+    backup_db_path: Path,
+    stamp: str,
+) -> None:
+    """
+    Синхронная часть restore (вызывается через asyncio.to_thread): подмена
+    файла БД и uploads. Писатель db_writer на это время остановлен, чтобы его
+    очередь не стояла на exclusive() пула и не дописывалась уже в новый файл
+    (stop() дописывает её в старый).
+    """
+    current_db = Path(CFG.DB_PATH)
+    writer_was_running = db_writer.is_running()
+    db_writer.stop()
+    try:
+        if current_db.exists():
+            db_checkpoint()
+        temp_restore = current_db.with_name(f".restore_tmp_{stamp}.sqlite3")
+        shutil.copy2(candidate_db, temp_restore)
+        # Пул закрываем, дождавшись открытых единиц работы и читателей, и до
+        # замены файла никого в БД не пускаем: при закрытии последнего
+        # соединения SQLite удаляет -wal/-shm, и они не применятся к новому файлу.
+        with db_pool.exclusive():
+            if current_db.exists():
+                os.replace(current_db, backup_db_path)
+            os.replace(temp_restore, current_db)
+        init_db()
+        bootstrap_cashflow()
+        allowlist.reload()
+    finally:
+        if writer_was_running:
+            db_writer.start(CFG.DB_PATH)
+
+    if uploads_dir is not None and uploads_dir.exists() and uploads_dir.is_dir():
+        uploads_backup = UPLOADS_DIR.with_name(f"{UPLOADS_DIR.name}.before_restore.{stamp}")
+        if UPLOADS_DIR.exists():
+            if uploads_backup.exists():
+                shutil.rmtree(uploads_backup)
+            shutil.move(str(UPLOADS_DIR), str(uploads_backup))
+        shutil.copytree(uploads_dir, UPLOADS_DIR)
+
+
+@APP.post("/api/backups/restore")
+async def api_restore_backup(
+    file: UploadFile = File(...),
+    u: sqlite3.Row = Depends(require_role("admin")),
+):
     if not file:
         raise HTTPException(status_code=400, detail="Missing file")
     tzinfo = backups_tzinfo()
@@ -5713,21 +6784,15 @@ async def api_restore_backup(
         stamp = dt.datetime.now(tzinfo).strftime("%Y%m%d_%H%M%S")
         backup_db_path = current_db.with_name(f"{current_db.name}.before_restore.{stamp}")
 
-        if current_db.exists():
-            os.replace(current_db, backup_db_path)
-
-        temp_restore = current_db.with_name(f".restore_tmp_{stamp}.sqlite3")
-        shutil.copy2(candidate_db, temp_restore)
-        os.replace(temp_restore, current_db)
-        init_db()
-
-        if uploads_dir is not None and uploads_dir.exists() and uploads_dir.is_dir():
-            uploads_backup = UPLOADS_DIR.with_name(f"{UPLOADS_DIR.name}.before_restore.{stamp}")
-            if UPLOADS_DIR.exists():
-                if uploads_backup.exists():
-                    shutil.rmtree(uploads_backup)
-                shutil.move(str(UPLOADS_DIR), str(uploads_backup))
-            shutil.copytree(uploads_dir, UPLOADS_DIR)
+        # Воркер outbox живёт в event loop — его останавливаем здесь, всё
+        # блокирующее (db_writer, пул, копирование файлов) — в отдельном потоке.
+        outbox_was_running = outbox.is_worker_running()
+        await outbox.stop_worker()
+        try:
+            await asyncio.to_thread(restore_backup_files, candidate_db, uploads_dir, backup_db_path, stamp)
+        finally:
+            if outbox_was_running:
+                outbox.start_worker()
 
         return {"ok": True}
     except HTTPException:
@@ -5781,11 +6846,17 @@ def require_pillow() -> Tuple[Any, Any, Any]:
     return Image, ImageDraw, ImageFont
 
 
-def load_ttf_font(image_font: Any, size: int, bold: bool = False) -> Any:
-    """
-    Пытаемся грузить красивый UI-шрифт (Menlo/Inter, если положишь рядом),
-    иначе системные DejaVu/Liberation.
-    """
+FONT_CACHE_MAX = 128
+
+FONT_LOCK = threading.Lock()
+# bold -> путь к файлу шрифта (None = ни один не найден, берём load_default)
+FONT_PATHS: Dict[bool, Optional[str]] = {}
+# (path, size, bold) -> FreeTypeFont, порядок = LRU
+FONT_CACHE: "OrderedDict[Tuple[str, int, bool], Any]" = OrderedDict()
+FONT_CACHE_STATS: Dict[str, int] = {"hits": 0, "misses": 0}
+
+
+def _font_candidates(bold: bool) -> List[str]:
     base_dir = Path(__file__).resolve().parent
 
     local_candidates = [
@@ -5808,45 +6879,150 @@ def load_ttf_font(image_font: Any, size: int, bold: bool = False) -> Any:
         "/usr/share/fonts/truetype/freefont/FreeSansBold.ttf" if bold else "/usr/share/fonts/truetype/freefont/FreeSans.ttf",
         "DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf",
     ]
+    return [str(p) for p in [*local_candidates, *sys_candidates]]
+
+
+def resolve_font_path(image_font: Any, bold: bool) -> Optional[str]:
+    """Находит файл шрифта один раз на процесс (перебор путей только при первом вызове)."""
+    bold = bool(bold)
+    with FONT_LOCK:
+        if bold in FONT_PATHS:
+            return FONT_PATHS[bold]
 
-    for p in [*local_candidates, *sys_candidates]:
+    found: Optional[str] = None
+    for p_str in _font_candidates(bold):
         try:
-            p_str = str(p)
             if p_str.startswith("/") and not Path(p_str).exists():
                 continue
-            return image_font.truetype(p_str, size=size)
+            image_font.truetype(p_str, size=12)
+            found = p_str
+            break
         except Exception:
             continue
 
-    return image_font.load_default()
+    with FONT_LOCK:
+        FONT_PATHS[bold] = found
+    return found
+
+
+def load_ttf_font(image_font: Any, size: int, bold: bool = False) -> Any:
+    """
+    Пытаемся грузить красивый UI-шрифт (Menlo/Inter, если положишь рядом),
+    иначе системные DejaVu/Liberation.
+    Путь ищется один раз, сами FreeTypeFont кэшируются (LRU) по (path, size, bold).
+    """
+    bold = bool(bold)
+    size = int(size)
+    path = resolve_font_path(image_font, bold)
+    if path is None:
+        return image_font.load_default()
+
+    key = (path, size, bold)
+    with FONT_LOCK:
+        font = FONT_CACHE.get(key)
+        if font is not None:
+            FONT_CACHE.move_to_end(key)
+            FONT_CACHE_STATS["hits"] += 1
+            return font
+        FONT_CACHE_STATS["misses"] += 1
+
+    try:
+        font = image_font.truetype(path, size=size)
+    except Exception:
+        return image_font.load_default()
+
+    with FONT_LOCK:
+        FONT_CACHE[key] = font
+        FONT_CACHE.move_to_end(key)
+        while len(FONT_CACHE) > FONT_CACHE_MAX:
+            FONT_CACHE.popitem(last=False)
+    return font
+
+
+def preload_fonts() -> Dict[str, Any]:
+    """Разрешает пути шрифтов при старте, чтобы первый рендер не платил за поиск."""
+    if importlib.util.find_spec("PIL") is None:
+        return font_registry_stats()
+    from PIL import ImageFont
+
+    resolve_font_path(ImageFont, False)
+    resolve_font_path(ImageFont, True)
+    return font_registry_stats()
 
 
+def font_registry_stats() -> Dict[str, Any]:
+    with FONT_LOCK:
+        stats: Dict[str, Any] = dict(FONT_CACHE_STATS)
+        stats["size"] = len(FONT_CACHE)
+        stats["max_size"] = FONT_CACHE_MAX
+        stats["paths"] = {"regular": FONT_PATHS.get(False), "bold": FONT_PATHS.get(True)}
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+    return stats
+
 
 def text_bbox(draw: Any, text: str, font: Any) -> Tuple[int, int]:
     bbox = draw.textbbox((0, 0), text, font=font)
     return bbox[2] - bbox[0], bbox[3] - bbox[1]
 
 
+def _prefix_widths(draw: Any, text: str, font: Any) -> List[float]:
+    """prefix[i] ~ ширина text[:i]: сумма advance-ширин символов (кернинг не учитываем)."""
+    advances: Dict[str, float] = {}
+    prefix = [0.0]
+    total = 0.0
+    for ch in text:
+        w = advances.get(ch)
+        if w is None:
+            w = float(draw.textlength(ch, font=font))
+            advances[ch] = w
+        total += w
+        prefix.append(total)
+    return prefix
+
+
 def fit_text_ellipsis(draw: Any, text: str, font: Any, max_width: int) -> str:
     if max_width <= 0:
         return ""
     if text_bbox(draw, text, font)[0] <= max_width:
         return text
     ellipsis = "…"
-    if text_bbox(draw, ellipsis, font)[0] > max_width:
+    ellipsis_w = text_bbox(draw, ellipsis, font)[0]
+    if ellipsis_w > max_width:
         return ""
 
-    lo, hi = 0, len(text)
-    while lo < hi:
-        mid = (lo + hi + 1) // 2
-        candidate = text[:mid].rstrip() + ellipsis
-        if text_bbox(draw, candidate, font)[0] <= max_width:
-            lo = mid
-        else:
-            hi = mid - 1
+    # Оценка по префиксным ширинам, затем точная проверка только финального кандидата.
+    prefix = _prefix_widths(draw, text, font)
+    budget = max_width - ellipsis_w
+    lo = bisect.bisect_right(prefix, budget) - 1
+    lo = max(0, min(lo, len(text)))
+
+    def fits(n: int) -> bool:
+        return text_bbox(draw, text[:n].rstrip() + ellipsis, font)[0] <= max_width
+
+    while lo > 0 and not fits(lo):
+        lo -= 1
+    while lo < len(text) and fits(lo + 1):
+        lo += 1
     return text[:lo].rstrip() + ellipsis
 
 
+def _rows_fit(
+    draw: Any,
+    font: Any,
+    rows: List[Tuple[str, str]],
+    max_label_w: int,
+    max_value_w: int,
+    max_row_h: int,
+) -> bool:
+    for label, value in rows:
+        label_w, label_h = text_bbox(draw, label, font)
+        value_w, value_h = text_bbox(draw, value, font)
+        if max(label_h, value_h) > max_row_h or label_w > max_label_w or value_w > max_value_w:
+            return False
+    return True
+
+
 def find_max_font_size_for_rows(
     image_font: Any,
     draw: Any,
@@ -5857,23 +7033,172 @@ def find_max_font_size_for_rows(
     min_size: int,
     max_size: int,
 ) -> int:
-    for size in range(max_size, min_size - 1, -1):
+    """
+    Максимальный размер шрифта, при котором все строки влезают.
+    Каждая строка измеряется один раз на опорном размере (max_size), метрики
+    масштабируются линейно; бинарный поиск по размеру, точная проверка —
+    только для найденного кандидата (и соседей, если масштабирование ошиблось).
+    """
+    if max_size < min_size:
+        return min_size
+    ref_font = load_ttf_font(image_font, size=max_size, bold=False)
+    ref_label_w = ref_value_w = ref_h = 0
+    for label, value in rows:
+        label_w, label_h = text_bbox(draw, label, ref_font)
+        value_w, value_h = text_bbox(draw, value, ref_font)
+        ref_label_w = max(ref_label_w, label_w)
+        ref_value_w = max(ref_value_w, value_w)
+        ref_h = max(ref_h, label_h, value_h)
+
+    def estimated_fit(size: int) -> bool:
+        k = size / float(max_size)
+        return ref_h * k <= max_row_h and ref_label_w * k <= max_label_w and ref_value_w * k <= max_value_w
+
+    lo, hi = min_size, max_size
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimated_fit(mid):
+            lo = mid
+        else:
+            hi = mid - 1
+
+    def real_fit(size: int) -> bool:
         font = load_ttf_font(image_font, size=size, bold=False)
-        fits_height = True
-        fits_width = True
-        for label, value in rows:
-            _, label_h = text_bbox(draw, label, font)
-            _, value_h = text_bbox(draw, value, font)
-            if max(label_h, value_h) > max_row_h:
-                fits_height = False
-                break
-            if text_bbox(draw, label, font)[0] > max_label_w or text_bbox(draw, value, font)[0] > max_value_w:
-                fits_width = False
-        if fits_height and fits_width:
+        return _rows_fit(draw, font, rows, max_label_w, max_value_w, max_row_h)
+
+    size = lo
+    if real_fit(size):
+        while size < max_size and real_fit(size + 1):
+            size += 1
+        return size
+    while size > min_size:
+        size -= 1
+        if real_fit(size):
             return size
     return min_size
 
 
+CARD_SPRITE_CACHE_MAX = 64
+
+CARD_SPRITE_LOCK = threading.Lock()
+# ("shadow", radius, blur, alpha) / ("body", w, h, radius, fill, outline, width) -> RGBA Image, порядок = LRU
+CARD_SPRITE_CACHE: "OrderedDict[Tuple[Any, ...], Any]" = OrderedDict()
+CARD_SPRITE_STATS: Dict[str, int] = {"hits": 0, "misses": 0}
+
+
+def _card_sprite(key: Tuple[Any, ...], build: Callable[[], Any]) -> Any:
+    with CARD_SPRITE_LOCK:
+        sprite = CARD_SPRITE_CACHE.get(key)
+        if sprite is not None:
+            CARD_SPRITE_CACHE.move_to_end(key)
+            CARD_SPRITE_STATS["hits"] += 1
+            return sprite
+        CARD_SPRITE_STATS["misses"] += 1
+    sprite = build()
+    with CARD_SPRITE_LOCK:
+        CARD_SPRITE_CACHE[key] = sprite
+        CARD_SPRITE_CACHE.move_to_end(key)
+        while len(CARD_SPRITE_CACHE) > CARD_SPRITE_CACHE_MAX:
+            CARD_SPRITE_CACHE.popitem(last=False)
+    return sprite
+
+
+def _shadow_margin(radius: int, blur: int) -> int:
+    # Дальше этого расстояния от края прямоугольника тень однородна
+    # (скругление + фактический радиус размытия Pillow ~3σ).
+    return int(radius) + 3 * int(blur) + 2
+
+
+def _render_shadow_layer(w: int, h: int, radius: int, blur: int, alpha: int) -> Any:
+    from PIL import Image, ImageDraw, ImageFilter
+
+    pad = blur * 2
+    shadow = Image.new("RGBA", (w + pad * 2, h + pad * 2), (0, 0, 0, 0))
+    sd = ImageDraw.Draw(shadow)
+    sd.rounded_rectangle(
+        (pad, pad, pad + w, pad + h),
+        radius=radius,
+        fill=(0, 0, 0, max(0, min(255, alpha))),
+    )
+    return shadow.filter(ImageFilter.GaussianBlur(blur))
+
+
+def card_shadow_layer(w: int, h: int, radius: int, blur: int, alpha: int) -> Any:
+    """
+    Размытая тень карточки w×h (слой с полями pad=2*blur).
+    Один размытый спрайт минимального размера на (radius, blur, alpha) из кэша,
+    нужный размер собирается nine-slice: углы как есть, края растягиваются.
+    """
+    from PIL import Image
+
+    m = _shadow_margin(radius, blur)
+    core = 2 * m + 1
+    if w < core or h < core:
+        return _card_sprite(
+            ("shadow_exact", w, h, radius, blur, alpha),
+            lambda: _render_shadow_layer(w, h, radius, blur, alpha),
+        )
+
+    sprite = _card_sprite(
+        ("shadow", radius, blur, alpha),
+        lambda: _render_shadow_layer(core, core, radius, blur, alpha),
+    )
+    pad = blur * 2
+    c = pad + m  # размер угла от края слоя
+    sw, sh = sprite.size
+    lw, lh = w + pad * 2, h + pad * 2
+    mid_w, mid_h = lw - 2 * c, lh - 2 * c
+
+    layer = Image.new("RGBA", (lw, lh), (0, 0, 0, 0))
+    # углы
+    layer.paste(sprite.crop((0, 0, c, c)), (0, 0))
+    layer.paste(sprite.crop((sw - c, 0, sw, c)), (lw - c, 0))
+    layer.paste(sprite.crop((0, sh - c, c, sh)), (0, lh - c))
+    layer.paste(sprite.crop((sw - c, sh - c, sw, sh)), (lw - c, lh - c))
+    # края: однопиксельная центральная полоса спрайта, растянутая без интерполяции
+    layer.paste(sprite.crop((c, 0, c + 1, c)).resize((mid_w, c), Image.NEAREST), (c, 0))
+    layer.paste(sprite.crop((c, sh - c, c + 1, sh)).resize((mid_w, c), Image.NEAREST), (c, lh - c))
+    layer.paste(sprite.crop((0, c, c, c + 1)).resize((c, mid_h), Image.NEAREST), (0, c))
+    layer.paste(sprite.crop((sw - c, c, sw, c + 1)).resize((c, mid_h), Image.NEAREST), (lw - c, c))
+    # центр однородный
+    layer.paste(sprite.getpixel((c, c)), (c, c, lw - c, lh - c))
+    return layer
+
+
+def card_body_sprite(
+    w: int,
+    h: int,
+    radius: int,
+    fill: Tuple[int, int, int],
+    outline: Optional[Tuple[int, int, int]],
+    outline_width: int,
+) -> Any:
+    def build() -> Any:
+        from PIL import Image, ImageDraw
+
+        card = Image.new("RGBA", (w, h), (0, 0, 0, 0))
+        cd = ImageDraw.Draw(card)
+        cd.rounded_rectangle(
+            (0, 0, w, h),
+            radius=radius,
+            fill=(*fill, 255),
+            outline=(*outline, 255) if outline else None,
+            width=int(outline_width) if outline and outline_width else 0,
+        )
+        return card
+
+    key = ("body", w, h, radius, tuple(fill), tuple(outline) if outline else None, int(outline_width or 0))
+    return _card_sprite(key, build)
+
+
+def card_sprite_stats() -> Dict[str, Any]:
+    with CARD_SPRITE_LOCK:
+        stats: Dict[str, Any] = dict(CARD_SPRITE_STATS)
+        stats["size"] = len(CARD_SPRITE_CACHE)
+    stats["max_size"] = CARD_SPRITE_CACHE_MAX
+    return stats
+
+
 def draw_card(
     img: Any,
     xy: Tuple[int, int, int, int],
@@ -5887,52 +7212,23 @@ def draw_card(
 ) -> None:
     """
     Рисует карточку с мягкой тенью (GaussianBlur) на RGBA-канвасе.
-    img должен быть RGBA.
+    img должен быть RGBA. Тень и тело карточки берутся из кэша спрайтов.
     """
-    try:
-        from PIL import Image, ImageDraw, ImageFilter
-    except Exception:
-        # fallback на старое поведение без blur
-        draw = img  # если кто-то случайно передал draw
-        x0, y0, x1, y1 = xy
-        draw.rounded_rectangle((x0, y0, x1, y1), radius=radius, fill=fill)
-        return
-
     x0, y0, x1, y1 = map(int, xy)
     w = max(1, x1 - x0)
     h = max(1, y1 - y0)
+    radius = int(radius)
+    shadow_blur = int(shadow_blur)
 
     pad = shadow_blur * 2
-    layer_w = w + pad * 2
-    layer_h = h + pad * 2
-
-    # shadow layer (локальный — быстрее, чем на весь холст)
-    shadow = Image.new("RGBA", (layer_w, layer_h), (0, 0, 0, 0))
-    sd = ImageDraw.Draw(shadow)
-    sd.rounded_rectangle(
-        (pad, pad, pad + w, pad + h),
-        radius=radius,
-        fill=(0, 0, 0, max(0, min(255, shadow_alpha))),
-    )
-    shadow = shadow.filter(ImageFilter.GaussianBlur(shadow_blur))
-
+    shadow = card_shadow_layer(w, h, radius, shadow_blur, int(shadow_alpha))
     ox, oy = shadow_offset
     img.alpha_composite(shadow, dest=(x0 - pad + ox, y0 - pad + oy))
 
-    # card body
-    card = Image.new("RGBA", (w, h), (0, 0, 0, 0))
-    cd = ImageDraw.Draw(card)
-    cd.rounded_rectangle(
-        (0, 0, w, h),
-        radius=radius,
-        fill=(*fill, 255),
-        outline=(*outline, 255) if outline else None,
-        width=int(outline_width) if outline and outline_width else 0,
-    )
+    card = card_body_sprite(w, h, radius, fill, outline, outline_width)
     img.alpha_composite(card, dest=(x0, y0))
 
 
-
 def draw_pill(
     draw: Any,
     xy: Tuple[int, int],
@@ -5971,6 +7267,7 @@ def render_month_report_png(
     preset: str,
     pixel_ratio: int = 2,   # <-- плотность пикселей (1..4)
     dpi: int = 192,         # <-- DPI метаданные (72..600)
+    generated_on: Optional[str] = None,  # ISO-дата для подвала (входит в ключ кэша PNG)
 ) -> bytes:
     Image, ImageDraw, ImageFont = require_pillow()
 
@@ -6523,11 +7820,12 @@ def render_month_report_png(
                 text = truncate_text(expense_items[item_idx], int(column_w - int(16 * scale)), font_small)
                 draw.text((col_x + int(8 * scale), y), text, font=font_small, fill=color_text)
 
-    # footer
+    # footer: только дата — картинка кэшируется, время первого рендера в ней устарело бы
     tz = CFG.tzinfo()
     now = dt.datetime.now(tz)
     tz_name = now.tzname() or CFG.TZ
-    footer_text = f"Сформировано: {now.strftime('%d.%m.%Y %H:%M')} ({tz_name})"
+    day = dt.date.fromisoformat(generated_on) if generated_on else now.date()
+    footer_text = f"Сформировано: {day.strftime('%d.%m.%Y')} ({tz_name})"
     draw.text((margin, h - footer_h), footer_text, font=font_small, fill=color_muted2)
 
     out = io.BytesIO()
@@ -6537,15 +7835,179 @@ def render_month_report_png(
 
 
 
-def build_month_report_png(
-    month_id: int,
-    preset: str = "landscape",
-    pixel_ratio: int = 2,
-    dpi: int = 192,
-) -> Tuple[bytes, str, sqlite3.Row]:
-    if preset not in PNG_PRESETS:
-        raise HTTPException(status_code=400, detail="Invalid preset")
+# ---------------------------
+# PNG report cache
+# ---------------------------
+
+# Меняется при любых правках рендера, чтобы старые картинки не отдавались.
+PNG_RENDER_VERSION = 4
+
+PNG_CACHE_LOCK = threading.Lock()
+PNG_CACHE_STATS: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def _png_cache_json_default(value: Any) -> Any:
+    if isinstance(value, sqlite3.Row):
+        return tuple(value)
+    return str(value)
+
+
+def month_report_png_key(month_id: int, inputs: Dict[str, Any], preset: str, pixel_ratio: int, dpi: int) -> str:
+    """
+    Ключ кэша: (month_id, preset, pixel_ratio, dpi) + sha256 от всех входных данных рендера.
+    Любая правка служений/расходов месяца (или влияющих на сводку данных) меняет хэш.
+    """
+    payload = json.dumps(
+        [PNG_RENDER_VERSION, inputs],
+        sort_keys=True,
+        ensure_ascii=False,
+        default=_png_cache_json_default,
+    )
+    digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+    return f"{int(month_id)}_{preset}_{int(pixel_ratio)}x_{int(dpi)}_{digest}"
+
+
+def _png_cache_path(key: str) -> Path:
+    return PNG_CACHE_DIR / f"{key}.png"
+
+
+def png_cache_get(key: str) -> Optional[bytes]:
+    if PNG_CACHE_MAX_BYTES <= 0:
+        return None
+    path = _png_cache_path(key)
+    try:
+        data = path.read_bytes()
+    except OSError:
+        with PNG_CACHE_LOCK:
+            PNG_CACHE_STATS["misses"] += 1
+        return None
+    try:
+        os.utime(path, None)  # LRU по mtime
+    except OSError:
+        pass
+    with PNG_CACHE_LOCK:
+        PNG_CACHE_STATS["hits"] += 1
+    return data
+
+
+def png_cache_put(key: str, data: bytes) -> None:
+    if PNG_CACHE_MAX_BYTES <= 0 or len(data) > PNG_CACHE_MAX_BYTES:
+        return
+    try:
+        PNG_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        path = _png_cache_path(key)
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    except OSError as exc:
+        log_system_log("WARN", "png.cache", "Не удалось сохранить PNG в кэш", {"key": key, "error": str(exc)})
+        return
+    # Старые версии того же отчёта (другой хэш данных) больше не нужны.
+    prefix = key.rsplit("_", 1)[0] + "_"
+    with PNG_CACHE_LOCK:
+        for old in PNG_CACHE_DIR.glob(f"{prefix}*.png"):
+            if old.name != path.name:
+                try:
+                    old.unlink()
+                except OSError:
+                    pass
+        _png_cache_evict_locked()
+
+
+def _png_cache_evict_locked() -> None:
+    entries = []
+    total = 0
+    for path in PNG_CACHE_DIR.glob("*.png"):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    if total <= PNG_CACHE_MAX_BYTES:
+        return
+    entries.sort(key=lambda e: e[0])
+    for _, size, path in entries:
+        if total <= PNG_CACHE_MAX_BYTES:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total -= size
+        PNG_CACHE_STATS["evictions"] += 1
+
+
+def invalidate_png_cache(month_id: Optional[int] = None) -> int:
+    """Удаляет картинки месяца (или весь кэш). Возвращает число удалённых файлов."""
+    if not PNG_CACHE_DIR.exists():
+        return 0
+    pattern = f"{int(month_id)}_*.png" if month_id is not None else "*.png"
+    removed = 0
+    with PNG_CACHE_LOCK:
+        for path in PNG_CACHE_DIR.glob(pattern):
+            try:
+                path.unlink()
+                removed += 1
+            except OSError:
+                pass
+    return removed
 
+
+def png_cache_stats() -> Dict[str, Any]:
+    files = 0
+    size = 0
+    if PNG_CACHE_DIR.exists():
+        for path in PNG_CACHE_DIR.glob("*.png"):
+            try:
+                size += path.stat().st_size
+                files += 1
+            except OSError:
+                pass
+    with PNG_CACHE_LOCK:
+        stats = dict(PNG_CACHE_STATS)
+    lookups = stats["hits"] + stats["misses"]
+    stats.update({
+        "files": files,
+        "bytes": size,
+        "max_bytes": PNG_CACHE_MAX_BYTES,
+        "hit_ratio": round(stats["hits"] / lookups, 4) if lookups else 0.0,
+    })
+    return stats
+
+
+def get_report_file_id(cache_key: str) -> Optional[str]:
+    """Telegram file_id уже загруженного PNG с этим ключом кэша (повторная отправка без upload)."""
+    row = db_fetchone("SELECT file_id FROM report_file_ids WHERE cache_key=?;", (cache_key,))
+    return str(row["file_id"]) if row else None
+
+
+def save_report_file_id(cache_key: str, file_id: str, file_unique_id: Optional[str] = None) -> None:
+    # file_id старых версий того же отчёта (другой хэш данных) больше не понадобятся
+    prefix = cache_key.rsplit("_", 1)[0] + "_"
+    with db_connect() as conn:
+        conn.execute(
+            "DELETE FROM report_file_ids WHERE substr(cache_key, 1, ?) = ? AND cache_key != ?;",
+            (len(prefix), prefix, cache_key),
+        )
+        conn.execute(
+            """
+            INSERT INTO report_file_ids (cache_key, file_id, file_unique_id, created_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(cache_key) DO UPDATE SET
+                file_id=excluded.file_id,
+                file_unique_id=excluded.file_unique_id,
+                created_at=excluded.created_at;
+            """,
+            (cache_key, file_id, file_unique_id, iso_now(CFG.tzinfo())),
+        )
+
+
+def delete_report_file_id(cache_key: str) -> None:
+    db_exec("DELETE FROM report_file_ids WHERE cache_key=?;", (cache_key,))
+
+
+def collect_month_report_png_inputs(month_id: int) -> Dict[str, Any]:
     m = get_month_by_id(month_id)
     summary = compute_month_summary(month_id, ensure_tithe=True)
 
@@ -6557,8 +8019,8 @@ def build_month_report_png(
     rows = db_fetchall(
         """
         SELECT category, COALESCE(SUM(total),0) AS s
-        FROM expenses
-        WHERE month_id=? AND account='main'
+        FROM month_rollups
+        WHERE kind='expense' AND month_id=? AND account='main'
         GROUP BY category
         ORDER BY s DESC, category ASC;
         """,
@@ -6602,163 +8064,485 @@ def build_month_report_png(
         (month_id,),
     )
 
-    png_data = render_month_report_png(
-        m, summary, services, top_entries, expenses, sub_services, sub_expenses,
+    # Только словари/списки: входные данные уходят в процесс рендера (pickle) и в хэш кэша.
+    return {
+        "month": dict(m),
+        "summary": summary,
+        "services": [dict(r) for r in services],
+        "top_entries": top_entries,
+        "expenses": [dict(r) for r in expenses],
+        "sub_services": [dict(r) for r in sub_services],
+        "sub_expenses": [dict(r) for r in sub_expenses],
+        # дата в подвале: новый день — новый ключ кэша и новый file_id
+        "generated_on": dt.datetime.now(CFG.tzinfo()).date().isoformat(),
+    }
+
+
+def _month_report_png_filename(m: Dict[str, Any], preset: str, pixel_ratio: int) -> str:
+    return f"report_{m['year']}_{int(m['month']):02d}_{preset}@{int(pixel_ratio)}x.png"
+
+
+def _render_png_job(inputs: Dict[str, Any], preset: str, pixel_ratio: int, dpi: int) -> bytes:
+    """Точка входа процесса рендера: только входные данные, без БД."""
+    return render_month_report_png(
+        inputs["month"],
+        inputs["summary"],
+        inputs["services"],
+        inputs["top_entries"],
+        inputs["expenses"],
+        inputs["sub_services"],
+        inputs["sub_expenses"],
         preset,
         pixel_ratio=pixel_ratio,
         dpi=dpi,
+        generated_on=inputs.get("generated_on"),
     )
-    filename = f"report_{m['year']}_{int(m['month']):02d}_{preset}@{int(pixel_ratio)}x.png"
+
+
+def build_month_report_png(
+    month_id: int,
+    preset: str = "landscape",
+    pixel_ratio: int = 2,
+    dpi: int = 192,
+) -> Tuple[bytes, str, Dict[str, Any]]:
+    """Синхронный рендер в текущем потоке (с кэшем). Из async-кода — render_month_report_png_async."""
+    if preset not in PNG_PRESETS:
+        raise HTTPException(status_code=400, detail="Invalid preset")
+    pixel_ratio = int(max(1, min(4, pixel_ratio)))
+    dpi = int(max(72, min(600, dpi)))
+
+    inputs = collect_month_report_png_inputs(month_id)
+    m = inputs["month"]
+    filename = _month_report_png_filename(m, preset, pixel_ratio)
+
+    key = month_report_png_key(month_id, inputs, preset, pixel_ratio, dpi)
+    cached = png_cache_get(key)
+    if cached is not None:
+        return cached, filename, m
+
+    png_data = _render_png_job(inputs, preset, pixel_ratio, dpi)
+    png_cache_put(key, png_data)
     return png_data, filename, m
 
 
+# ---------------------------
+# PNG render service
+# ---------------------------
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "2") or 0)
+RENDER_QUEUE_MAX = int(os.getenv("RENDER_QUEUE_MAX", "8") or 8)
+RENDER_TIMEOUT_SEC = float(os.getenv("RENDER_TIMEOUT_SEC", "90") or 90)
+
+RENDER_POOL: Optional[ProcessPoolExecutor] = None
+RENDER_POOL_LOCK = threading.Lock()
+# ключ кэша PNG -> задача рендера (одинаковые запросы ждут одну задачу)
+RENDER_INFLIGHT: Dict[str, "asyncio.Task[bytes]"] = {}
+RENDER_STATS: Dict[str, int] = {"submitted": 0, "deduped": 0, "rejected": 0, "timeouts": 0, "failed": 0}
+
+
+def get_render_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    Пул процессов рендера (spawn: процессы не наследуют потоки бота/планировщика).
+    RENDER_WORKERS=0 — рендер в threadpool текущего процесса.
+    """
+    global RENDER_POOL
+    if RENDER_WORKERS <= 0:
+        return None
+    with RENDER_POOL_LOCK:
+        if RENDER_POOL is None:
+            try:
+                RENDER_POOL = ProcessPoolExecutor(
+                    max_workers=RENDER_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            except Exception as exc:
+                log_system_log("ERROR", "png.render", "Не удалось запустить пул рендера", {"error": str(exc)})
+                return None
+        return RENDER_POOL
+
+
+def shutdown_render_pool() -> None:
+    global RENDER_POOL
+    with RENDER_POOL_LOCK:
+        pool, RENDER_POOL = RENDER_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def _run_render_job(key: str, inputs: Dict[str, Any], preset: str, pixel_ratio: int, dpi: int) -> bytes:
+    pool = get_render_pool()
+    if pool is None:
+        job: Awaitable[bytes] = asyncio.to_thread(_render_png_job, inputs, preset, pixel_ratio, dpi)
+    else:
+        job = asyncio.get_running_loop().run_in_executor(pool, _render_png_job, inputs, preset, pixel_ratio, dpi)
+    RENDER_STATS["submitted"] += 1
+    try:
+        # По таймауту перестаём ждать; уже запущенный процесс досчитает и освободится сам.
+        png_data = await asyncio.wait_for(job, timeout=RENDER_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        RENDER_STATS["timeouts"] += 1
+        log_system_log("WARN", "png.render", "Превышено время рендера PNG", {"key": key, "timeout_sec": RENDER_TIMEOUT_SEC})
+        raise HTTPException(status_code=504, detail="PNG render timed out")
+    except BrokenProcessPool as exc:
+        RENDER_STATS["failed"] += 1
+        shutdown_render_pool()
+        log_system_log("ERROR", "png.render", "Пул рендера упал, будет пересоздан", {"key": key, "error": str(exc)})
+        raise HTTPException(status_code=503, detail="PNG renderer restarted, try again")
+    except HTTPException:
+        RENDER_STATS["failed"] += 1
+        raise
+    except Exception as exc:
+        RENDER_STATS["failed"] += 1
+        log_system_log("ERROR", "png.render", "Ошибка рендера PNG", {"key": key, "error": str(exc)})
+        raise HTTPException(status_code=500, detail="PNG render failed")
+    await asyncio.to_thread(png_cache_put, key, png_data)
+    return png_data
+
+
+async def render_month_report_png_async(
+    month_id: int,
+    preset: str = "landscape",
+    pixel_ratio: int = 2,
+    dpi: int = 192,
+) -> Tuple[bytes, str, Dict[str, Any]]:
+    """
+    PNG-отчёт месяца без блокировки event loop: чтение БД и кэш — в threadpool,
+    рендер — в пуле процессов. Одинаковые одновременные запросы рендерятся один раз;
+    при переполнении очереди — 503, по таймауту — 504.
+    """
+    png_data, filename, m, _ = await render_month_report_png_keyed(month_id, preset, pixel_ratio, dpi)
+    return png_data, filename, m
+
+
+async def render_month_report_png_keyed(
+    month_id: int,
+    preset: str = "landscape",
+    pixel_ratio: int = 2,
+    dpi: int = 192,
+) -> Tuple[bytes, str, Dict[str, Any], str]:
+    """То же, что render_month_report_png_async, плюс ключ кэша PNG (для file_id в Telegram)."""
+    if preset not in PNG_PRESETS:
+        raise HTTPException(status_code=400, detail="Invalid preset")
+    require_pillow()
+    pixel_ratio = int(max(1, min(4, pixel_ratio)))
+    dpi = int(max(72, min(600, dpi)))
+
+    inputs = await asyncio.to_thread(collect_month_report_png_inputs, month_id)
+    m = inputs["month"]
+    filename = _month_report_png_filename(m, preset, pixel_ratio)
+
+    key = month_report_png_key(month_id, inputs, preset, pixel_ratio, dpi)
+    cached = await asyncio.to_thread(png_cache_get, key)
+    if cached is not None:
+        return cached, filename, m, key
+
+    task = RENDER_INFLIGHT.get(key)
+    if task is None:
+        if len(RENDER_INFLIGHT) >= RENDER_QUEUE_MAX:
+            RENDER_STATS["rejected"] += 1
+            raise HTTPException(status_code=503, detail="PNG render queue is full, try again later")
+        task = asyncio.ensure_future(_run_render_job(key, inputs, preset, pixel_ratio, dpi))
+        RENDER_INFLIGHT[key] = task
+        task.add_done_callback(lambda _t: RENDER_INFLIGHT.pop(key, None))
+    else:
+        RENDER_STATS["deduped"] += 1
+
+    # shield: отмена одного ожидающего (обрыв HTTP) не отменяет общий рендер
+    png_data = await asyncio.shield(task)
+    return png_data, filename, m, key
+
+
+def render_service_stats() -> Dict[str, Any]:
+    stats: Dict[str, Any] = dict(RENDER_STATS)
+    stats.update({
+        "workers": RENDER_WORKERS,
+        "pool_running": RENDER_POOL is not None,
+        "in_flight": len(RENDER_INFLIGHT),
+        "queue_max": RENDER_QUEUE_MAX,
+        "timeout_sec": RENDER_TIMEOUT_SEC,
+    })
+    return stats
+
+
 @APP.get("/api/export/png")
-def export_png(
+async def export_png(
     month_id: int = Query(...),
     preset: str = Query("landscape"),
     pixel_ratio: int = Query(2, ge=1, le=4, description="Плотность пикселей (1..4). 2 = Retina"),
     dpi: int = Query(192, ge=72, le=600, description="DPI метаданные (72..600). На экране важнее pixel_ratio"),
     u: sqlite3.Row = Depends(require_role("admin", "accountant", "viewer")),
 ):
-    png_data, filename, _ = build_month_report_png(month_id, preset=preset, pixel_ratio=pixel_ratio, dpi=dpi)
+    png_data, filename, _ = await render_month_report_png_async(month_id, preset=preset, pixel_ratio=pixel_ratio, dpi=dpi)
     return Response(
         content=png_data,
         media_type="image/png",
         headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
-@APP.get("/api/export/csv")
-def export_csv(
-    month_id: int = Query(...),
-    u: sqlite3.Row = Depends(require_role("admin", "accountant")),
-):
-    ensure_tithe_expense(month_id, user_id=int(u["id"]))
-    m = get_month_by_id(month_id)
-    services = db_fetchall("SELECT * FROM services WHERE month_id=? ORDER BY service_date ASC;", (month_id,))
-    expenses = db_fetchall("SELECT * FROM expenses WHERE month_id=? ORDER BY expense_date ASC, id ASC;", (month_id,))
+CSV_SERVICE_COLUMNS = [
+    "date",
+    "idx",
+    "cashless",
+    "cash",
+    "total",
+    "weekly_min_needed",
+    "mnsps_status",
+    "pvs_ratio",
+    "income_type",
+    "account",
+]
+CSV_EXPENSE_COLUMNS = ["date", "category", "title", "qty", "unit_amount", "total", "comment", "is_system", "account"]
+CSV_FLUSH_ROWS = 500
+
 
-    import io
+def iter_export_csv(
+    header: List[Any],
+    where: str,
+    params: Tuple[Any, ...],
+    include_tags: bool,
+) -> Any:
+    """
+    Потоковая выгрузка CSV: строки идут прямо из курсора SQLite порциями,
+    память не зависит от объёма периода. Отдельное read-only соединение
+    (один снимок WAL на всю выгрузку). where — шаблон с {p} (префикс
+    таблицы) и {date_col}.
+    """
     import csv
 
     buf = io.StringIO()
     w = csv.writer(buf)
 
-    w.writerow(["MONTH", int(m["year"]), int(m["month"])])
-    w.writerow([])
-    w.writerow(["SERVICES"])
-    w.writerow(
-        [
-            "date",
-            "idx",
-            "cashless",
-            "cash",
-            "total",
-            "weekly_min_needed",
-            "mnsps_status",
-            "pvs_ratio",
-            "income_type",
-            "account",
-        ]
-    )
-    for s in services:
-        w.writerow([
-            s["service_date"], s["idx"], s["cashless"], s["cash"], s["total"],
-            s["weekly_min_needed"], s["mnsps_status"], s["pvs_ratio"], s["income_type"], s["account"]
-        ])
+    def drain() -> bytes:
+        data = buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate(0)
+        return data
+
+    with db_pool.open_reader(CFG.DB_PATH) as conn:
+        conn.execute("BEGIN;")
+        yield "\ufeff".encode("utf-8")
+        w.writerow(header)
+        w.writerow([])
+        w.writerow(["SERVICES"])
+        w.writerow(CSV_SERVICE_COLUMNS)
+        cur = conn.execute(
+            f"""
+            SELECT service_date, idx, cashless, cash, total, weekly_min_needed,
+                   mnsps_status, pvs_ratio, income_type, account
+            FROM services
+            WHERE {where.format(p="", date_col="service_date")}
+            ORDER BY service_date ASC, id ASC;
+            """,
+            params,
+        )
+        n = 0
+        for row in cur:
+            w.writerow(list(row))
+            n += 1
+            if n % CSV_FLUSH_ROWS == 0:
+                yield drain()
+
+        w.writerow([])
+        w.writerow(["EXPENSES"])
+        w.writerow(CSV_EXPENSE_COLUMNS + (["tags"] if include_tags else []))
+        tags_sql = (
+            """,
+                   (
+                       SELECT group_concat(name, ', ') FROM (
+                           SELECT t.name FROM expense_tags et JOIN tags t ON t.id=et.tag_id
+                           WHERE et.expense_id=e.id ORDER BY t.name COLLATE NOCASE
+                       )
+                   ) AS tags"""
+            if include_tags
+            else ""
+        )
+        cur = conn.execute(
+            f"""
+            SELECT e.expense_date, e.category, e.title, e.qty, e.unit_amount, e.total,
+                   e.comment, e.is_system, e.account{tags_sql}
+            FROM expenses e
+            WHERE {where.format(p="e.", date_col="expense_date")}
+            ORDER BY e.expense_date ASC, e.id ASC;
+            """,
+            params,
+        )
+        for row in cur:
+            w.writerow(list(row))
+            n += 1
+            if n % CSV_FLUSH_ROWS == 0:
+                yield drain()
+        yield drain()
 
-    w.writerow([])
-    w.writerow(["EXPENSES"])
-    w.writerow(["date", "category", "title", "qty", "unit_amount", "total", "comment", "is_system", "account"])
-    for e in expenses:
-        w.writerow([
-            e["expense_date"], e["category"], e["title"], e["qty"], e["unit_amount"],
-            e["total"], e["comment"], e["is_system"], e["account"]
-        ])
 
-    data = buf.getvalue().encode("utf-8-sig")
-    filename = f"month_{m['year']}_{m['month']:02d}.csv"
-    return Response(
-        content=data,
+@APP.get("/api/export/csv")
+def export_csv(
+    month_id: Optional[int] = Query(None),
+    date_from: Optional[dt.date] = Query(None),
+    date_to: Optional[dt.date] = Query(None),
+    account: Optional[str] = Query(None, description="main/praise/alpha; по умолчанию все счета"),
+    tags: bool = Query(False, description="Добавить колонку тегов к расходам"),
+    u: sqlite3.Row = Depends(require_role("admin", "accountant")),
+):
+    if month_id is None and (date_from is None or date_to is None):
+        raise HTTPException(status_code=400, detail="month_id or date_from/date_to is required")
+    if date_from and date_to and date_from > date_to:
+        raise HTTPException(status_code=400, detail="date_from must be <= date_to")
+
+    clauses: List[str] = []
+    params: List[Any] = []
+    if month_id is not None:
+        m = get_month_by_id(month_id)
+        clauses.append("{p}month_id=?")
+        params.append(int(month_id))
+        header: List[Any] = ["MONTH", int(m["year"]), int(m["month"])]
+        filename = f"month_{m['year']}_{int(m['month']):02d}.csv"
+    else:
+        header = ["PERIOD", iso_date(date_from), iso_date(date_to)]
+        filename = f"export_{iso_date(date_from)}_{iso_date(date_to)}.csv"
+    if date_from is not None:
+        clauses.append("{p}{date_col}>=?")
+        params.append(iso_date(date_from))
+    if date_to is not None:
+        clauses.append("{p}{date_col}<=?")
+        params.append(iso_date(date_to))
+    if account:
+        acc = normalize_account(account)
+        clauses.append("{p}account=?")
+        params.append(acc)
+        header.append(acc)
+
+    return StreamingResponse(
+        iter_export_csv(header, " AND ".join(clauses), tuple(params), tags),
         media_type="text/csv; charset=utf-8",
         headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
 
-@APP.get("/api/export/excel")
-def export_excel(
-    year: int = Query(...),
-    u: sqlite3.Row = Depends(require_role("admin", "accountant")),
-):
-    if openpyxl is None:
-        raise HTTPException(status_code=500, detail="openpyxl is not installed")
+EXCEL_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+EXCEL_MAX_YEARS = 20
 
-    months = db_fetchall("SELECT * FROM months WHERE year=? ORDER BY month ASC;", (year,))
-    wb = openpyxl.Workbook()
-    # remove default
-    wb.remove(wb.active)
 
-    for m in months:
-        month_id = int(m["id"])
-        ensure_tithe_expense(month_id, user_id=int(u["id"]))
-        recalc_services_for_month(month_id)
+def iter_spooled_file(f: Any, chunk_size: int = 256 * 1024) -> Any:
+    try:
+        f.seek(0)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
 
-        ws = wb.create_sheet(title=f"{int(m['month']):02d}-{int(m['year'])}")
-        ws.append(["Month", int(m["year"]), int(m["month"])])
-        ws.append(["monthly_min_needed", float(m["monthly_min_needed"]), "start_balance", float(m["start_balance"])])
-        ws.append([])
 
-        ws.append(["SERVICES"])
-        ws.append(
-            [
-                "date",
-                "idx",
-                "cashless",
-                "cash",
-                "total",
-                "weekly_min_needed",
-                "mnsps_status",
-                "pvs_ratio",
-                "income_type",
-                "account",
-            ]
+def build_excel_export(year_from: int, year_to: int) -> Any:
+    """
+    XLSX за годы year_from..year_to в write_only-режиме во временный spooled-файл.
+    Только чтение (одно read-only соединение, один снимок WAL): лист «Итоги» —
+    один GROUP BY по month_rollups, далее по листу на месяц.
+    """
+    with db_pool.open_reader(CFG.DB_PATH) as conn:
+        conn.execute("BEGIN;")
+        wb = openpyxl.Workbook(write_only=True)
+
+        ws = wb.create_sheet(title="Итоги")
+        for col, width in zip("ABCDEFGHI", (8, 8, 18, 18, 18, 18, 18, 18, 14)):
+            ws.column_dimensions[col].width = width
+        ws.append([
+            "year", "month", "monthly_min_needed", "start_balance",
+            "income_main", "expenses_main", "balance_main", "income_subaccounts", "completion",
+        ])
+        summary_rows = conn.execute(
+            """
+            SELECT
+                m.id, m.year, m.month, m.monthly_min_needed, m.start_balance,
+                COALESCE(SUM(CASE WHEN r.kind='income' AND r.account='main' THEN r.total END),0) AS income,
+                COALESCE(SUM(CASE WHEN r.kind='expense' AND r.account='main' THEN r.total END),0) AS expenses,
+                COALESCE(SUM(CASE WHEN r.kind='income' AND r.account!='main' THEN r.total END),0) AS sub_income
+            FROM months m
+            LEFT JOIN month_rollups r ON r.month_id=m.id
+            WHERE m.year BETWEEN ? AND ?
+            GROUP BY m.id
+            ORDER BY m.year ASC, m.month ASC;
+            """,
+            (year_from, year_to),
         )
-        services = db_fetchall("SELECT * FROM services WHERE month_id=? ORDER BY service_date ASC;", (month_id,))
-        for s in services:
+        months: List[Tuple[int, int, int, float, float]] = []
+        for r in summary_rows:
+            min_needed = float(r["monthly_min_needed"] or 0.0)
+            income = float(r["income"])
+            expenses = float(r["expenses"])
             ws.append([
-                s["service_date"], s["idx"], s["cashless"], s["cash"], s["total"],
-                s["weekly_min_needed"], s["mnsps_status"], s["pvs_ratio"], s["income_type"], s["account"]
+                int(r["year"]), int(r["month"]), round(min_needed, 2), round(float(r["start_balance"] or 0.0), 2),
+                round(income, 2), round(expenses, 2), round(income - expenses, 2), round(float(r["sub_income"]), 2),
+                round(min(income / min_needed, 1.0), 4) if min_needed > 0 else 0.0,
             ])
+            months.append((int(r["id"]), int(r["year"]), int(r["month"]), min_needed, float(r["start_balance"] or 0.0)))
+
+        for month_id, year, month, min_needed, start_balance in months:
+            ws = wb.create_sheet(title=f"{month:02d}-{year}")
+            for col in range(1, 10):
+                ws.column_dimensions[get_column_letter(col)].width = 18
+            ws.append(["Month", year, month])
+            ws.append(["monthly_min_needed", min_needed, "start_balance", start_balance])
+            ws.append([])
+
+            ws.append(["SERVICES"])
+            ws.append(CSV_SERVICE_COLUMNS)
+            for row in conn.execute(
+                """
+                SELECT service_date, idx, cashless, cash, total, weekly_min_needed,
+                       mnsps_status, pvs_ratio, income_type, account
+                FROM services WHERE month_id=? ORDER BY service_date ASC, id ASC;
+                """,
+                (month_id,),
+            ):
+                ws.append(list(row))
+
+            ws.append([])
+            ws.append(["EXPENSES"])
+            ws.append(CSV_EXPENSE_COLUMNS)
+            for row in conn.execute(
+                """
+                SELECT expense_date, category, title, qty, unit_amount, total, comment, is_system, account
+                FROM expenses WHERE month_id=? ORDER BY expense_date ASC, id ASC;
+                """,
+                (month_id,),
+            ):
+                ws.append(list(row))
 
-        ws.append([])
-        ws.append(["EXPENSES"])
-        ws.append(["date", "category", "title", "qty", "unit_amount", "total", "comment", "is_system", "account"])
-        expenses = db_fetchall("SELECT * FROM expenses WHERE month_id=? ORDER BY expense_date ASC, id ASC;", (month_id,))
-        for e in expenses:
-            ws.append([
-                e["expense_date"],
-                e["category"],
-                e["title"],
-                e["qty"],
-                e["unit_amount"],
-                e["total"],
-                e["comment"],
-                e["is_system"],
-                e["account"],
-            ])
+    out = tempfile.SpooledTemporaryFile(max_size=EXCEL_SPOOL_MAX_BYTES)
+    try:
+        wb.save(out)
+    except Exception:
+        out.close()
+        raise
+    return out
 
-        # simple width
-        for col in range(1, 10):
-            ws.column_dimensions[get_column_letter(col)].width = 18
 
-    import io
-    out = io.BytesIO()
-    wb.save(out)
-    out.seek(0)
-    filename = f"export_{year}.xlsx"
+@APP.get("/api/export/excel")
+def export_excel(
+    year: int = Query(...),
+    year_to: Optional[int] = Query(None, description="Последний год диапазона (по умолчанию = year)"),
+    u: sqlite3.Row = Depends(require_role("admin", "accountant")),
+):
+    if openpyxl is None:
+        raise HTTPException(status_code=500, detail="openpyxl is not installed")
+    last_year = int(year_to) if year_to is not None else int(year)
+    if last_year < int(year):
+        raise HTTPException(status_code=400, detail="year_to must be >= year")
+    if last_year - int(year) + 1 > EXCEL_MAX_YEARS:
+        raise HTTPException(status_code=400, detail=f"Too many years (max {EXCEL_MAX_YEARS})")
+
+    out = build_excel_export(int(year), last_year)
+    size = out.tell()
+    filename = f"export_{year}.xlsx" if last_year == int(year) else f"export_{year}_{last_year}.xlsx"
     return StreamingResponse(
-        out,
+        iter_spooled_file(out),
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Content-Length": str(size),
+        },
     )
 
 
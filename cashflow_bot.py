@@ -11,7 +11,8 @@
     import cashflow_bot
     cashflow_bot.set_bot(bot)
 
-    # в cashflow_routes.py можно звать notify_* через BackgroundTasks
+    # notify_* только ставят сообщения в outbox (см. outbox.py) — их можно
+    # звать прямо из роутов: отправку и повторы делает воркер outbox
 
 """
 
@@ -23,9 +24,10 @@ from dataclasses import dataclass
 from typing import Any, Dict, Iterable, Optional
 
 from aiogram import Bot
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
 
+import outbox
+
 
 _BOT: Optional[Bot] = None
 
@@ -111,18 +113,7 @@ def format_op(op_type: str) -> str:
     return {"collect": "Сбор наличных", "withdraw": "Изъятие наличных"}.get(t, op_type)
 
 
-async def safe_send_message(chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
-    bot = get_bot()
-    try:
-        await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-    except (TelegramBadRequest, TelegramForbiddenError):
-        # пользователь мог заблокировать бота / не стартанул чат
-        return
-    except Exception:
-        return
-
-
-async def notify_signers_new_request(
+def notify_signers_new_request(
     *,
     request_id: int,
     account: str,
@@ -144,14 +135,22 @@ async def notify_signers_new_request(
         text += f"Комментарий администратора: <i>{admin_comment}</i>\n"
 
     kb = _cashapp_kb(cfg, request_id)
-    for tid in signer_ids:
-        await safe_send_message(int(tid), text, kb)
+    # первичный запрос одному подписанту ставим один раз; повторные — на каждый resend
+    outbox.enqueue_many(
+        [
+            ("cash_sign", tid, text, kb, None if is_retry else f"cash_new:{int(request_id)}:{tid}")
+            for tid in dict.fromkeys(int(t) for t in signer_ids)
+        ],
+        priority=outbox.PRIORITY_CASH,
+    )
 
 
-async def notify_admin_about_decision(
+def notify_admin_about_decision(
     *,
     admin_id: int,
     request_id: int,
+    signer_telegram_id: int,
+    attempt: int,
     account: str,
     op_type: str,
     amount: float,
@@ -172,10 +171,18 @@ async def notify_admin_about_decision(
         text += f"Причина отказа: <i>{reason}</i>\n"
 
     kb = _cashapp_kb(cfg, request_id)
-    await safe_send_message(int(admin_id), text, kb)
+    # одно решение подписанта в одной попытке — одно уведомление (повтор запроса не дублирует)
+    outbox.enqueue(
+        "cash_decision",
+        int(admin_id),
+        text,
+        kb,
+        priority=outbox.PRIORITY_CASH,
+        dedupe_key=f"cash_decision:{int(request_id)}:{int(signer_telegram_id)}:{int(attempt)}:{decision}",
+    )
 
 
-async def notify_initiator_final(
+def notify_initiator_final(
     *,
     initiator_id: int,
     request_id: int,
@@ -193,4 +200,11 @@ async def notify_initiator_final(
         f"Сумма: <b>{amount:.2f}</b>\n"
     )
     kb = _cashapp_kb(cfg, request_id)
-    await safe_send_message(int(initiator_id), text, kb)
+    outbox.enqueue(
+        "cash_final",
+        int(initiator_id),
+        text,
+        kb,
+        priority=outbox.PRIORITY_CASH,
+        dedupe_key=f"cash_final:{int(request_id)}",
+    )
@@ -13,6 +13,9 @@
 
 Интеграция:
 - В app.py нужно вызвать init_cashflow_db() внутри init_db().
+- При старте приложения app.py вызывает bootstrap(cfg) один раз: таблицы,
+  каталог подписей и общий (frozen) CashflowConfig; дальше роуты берут
+  get_config() и не повторяют DDL/чтение env на каждый запрос.
 - В routes при создании/обновлении нужно звать функции этого модуля.
 """
 
@@ -21,13 +24,17 @@ from __future__ import annotations
 import base64
 import dataclasses
 import datetime as dt
+import hashlib
 import json
 import os
 import re
 import sqlite3
 import uuid
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from typing import Any, ContextManager, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+import allowlist
+import db_pool
 
 
 ACCOUNTS: Tuple[str, ...] = ("main", "praise", "alpha")
@@ -70,11 +77,33 @@ def load_cashflow_config(base_dir: Optional[Path] = None) -> CashflowConfig:
     )
 
 
-def db_connect(cfg: CashflowConfig) -> sqlite3.Connection:
-    conn = sqlite3.connect(str(cfg.db_path), check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys=ON;")
-    return conn
+# Общий конфиг модуля; None — bootstrap() ещё не выполнен (модуль не готов).
+_CONFIG: Optional[CashflowConfig] = None
+
+
+def bootstrap(cfg: CashflowConfig) -> CashflowConfig:
+    """Однократная инициализация при старте: каталог подписей, таблицы, общий конфиг."""
+    global _CONFIG
+    cfg.uploads_dir.mkdir(parents=True, exist_ok=True)
+    with db_connect(cfg) as conn:
+        init_cashflow_db(conn)
+    _CONFIG = cfg
+    return cfg
+
+
+def is_ready() -> bool:
+    return _CONFIG is not None
+
+
+def get_config() -> CashflowConfig:
+    if _CONFIG is None:
+        raise RuntimeError("Cashflow module is not bootstrapped. Call cashflow_models.bootstrap(cfg) from app.py")
+    return _CONFIG
+
+
+def db_connect(cfg: CashflowConfig) -> ContextManager[sqlite3.Connection]:
+    # Тот же пул соединений, что и в app.py (db_pool.unit_of_work).
+    return db_pool.unit_of_work(cfg.db_path)
 
 def _table_has_column(conn: sqlite3.Connection, table: str, column: str) -> bool:
     rows = conn.execute(f"PRAGMA table_info({table});").fetchall()
@@ -133,6 +162,10 @@ def init_cashflow_db(conn: sqlite3.Connection) -> None:
             refuse_reason TEXT NULL,
             signature_path TEXT NULL,
             signed_at TEXT NOT NULL,
+            thumb_path TEXT NULL,
+            thumb_sha256 TEXT NULL,
+            thumb_width INTEGER NULL,
+            thumb_height INTEGER NULL,
             UNIQUE(request_id, telegram_id, attempt),
             FOREIGN KEY (request_id) REFERENCES cash_requests(id) ON DELETE CASCADE
         );
@@ -144,34 +177,20 @@ def init_cashflow_db(conn: sqlite3.Connection) -> None:
     if not _table_has_column(conn, "cash_requests", "source_payload"):
         conn.execute("ALTER TABLE cash_requests ADD COLUMN source_payload TEXT NULL;")
         conn.commit()
+    for column, ddl in (
+        ("thumb_path", "TEXT NULL"),
+        ("thumb_sha256", "TEXT NULL"),
+        ("thumb_width", "INTEGER NULL"),
+        ("thumb_height", "INTEGER NULL"),
+    ):
+        if not _table_has_column(conn, "cash_signatures", column):
+            conn.execute(f"ALTER TABLE cash_signatures ADD COLUMN {column} {ddl};")
     conn.commit()
 
 
 def load_users_allowlist(users_json_path: Path) -> Dict[int, Dict[str, Any]]:
     """Читает users.json и возвращает mapping telegram_id -> user dict."""
-    raw = users_json_path.read_text("utf-8")
-    data = json.loads(raw)
-    if isinstance(data, dict):
-        # допускаем формат {"123": {...}}
-        out: Dict[int, Dict[str, Any]] = {}
-        for k, v in data.items():
-            try:
-                tid = int(k)
-            except Exception:
-                continue
-            if isinstance(v, dict):
-                out[tid] = v
-        return out
-    if not isinstance(data, list):
-        raise ValueError("users.json must be list or dict")
-    out2: Dict[int, Dict[str, Any]] = {}
-    for item in data:
-        if not isinstance(item, dict):
-            continue
-        tid = int(item.get("telegram_id") or item.get("id") or 0)
-        if tid:
-            out2[tid] = item
-    return out2
+    return allowlist.parse_users(json.loads(users_json_path.read_text("utf-8")))
 
 
 def _normalize_account(account: str) -> str:
@@ -188,18 +207,18 @@ def _normalize_op_type(op_type: str) -> str:
     return t
 
 
-def _is_active(u: Dict[str, Any]) -> bool:
+def _is_active(u: Mapping[str, Any]) -> bool:
     return bool(u.get("active") is True or u.get("active") == 1 or str(u.get("active")).lower() == "true")
 
 
-def pick_primary_admin(allow: Dict[int, Dict[str, Any]]) -> int:
+def pick_primary_admin(allow: Mapping[int, Mapping[str, Any]]) -> int:
     admins = [tid for tid, u in allow.items() if _is_active(u) and str(u.get("role")) == "admin"]
     if not admins:
         raise RuntimeError("No active admin in users.json")
     return int(sorted(admins)[0])
 
 
-def pick_cash_signers(allow: Dict[int, Dict[str, Any]], account: str, op_type: str) -> List[int]:
+def pick_cash_signers(allow: Mapping[int, Mapping[str, Any]], account: str, op_type: str) -> List[int]:
     """Возвращает список telegram_id подписантов.
 
     Для подписей наличных по суммам не ограничиваем по cash_scopes/cash_ops,
@@ -235,7 +254,8 @@ def create_cash_request(
     if amount is None or float(amount) <= 0:
         raise ValueError("amount must be > 0")
 
-    allow = load_users_allowlist(cfg.users_json_path)
+    # общий снимок users.json (allowlist.py), без чтения файла на каждую заявку
+    allow = allowlist.current().raw
     admin_tid = pick_primary_admin(allow)
     signers = pick_cash_signers(allow, account_n, op_type_n)
     # admin обязан подписывать, но может быть и в signers — дедуп.
@@ -458,6 +478,101 @@ def _save_signature_png(cfg: CashflowConfig, request_id: int, telegram_id: int,
     return rel
 
 
+SIGNATURE_THUMB_SIZE: Tuple[int, int] = (120, 32)
+
+
+def make_signature_thumbnail(png_bytes: bytes) -> Optional[bytes]:
+    """
+    Уменьшенная копия нормализованной подписи ровно SIGNATURE_THUMB_SIZE
+    (пропорции сохраняются, поля белые) — для вставки в акт без повторной обработки.
+    None, если Pillow недоступен или PNG битый.
+    """
+    try:
+        import io as _io
+        from PIL import Image
+    except Exception:
+        return None
+    try:
+        im = Image.open(_io.BytesIO(png_bytes))
+        im.load()
+        im = im.convert("RGB")
+        tw, th = SIGNATURE_THUMB_SIZE
+        scale = min(tw / im.width, th / im.height)
+        size = (max(1, round(im.width * scale)), max(1, round(im.height * scale)))
+        im = im.resize(size, Image.LANCZOS)
+        canvas = Image.new("RGB", (tw, th), (255, 255, 255))
+        canvas.paste(im, ((tw - size[0]) // 2, (th - size[1]) // 2))
+        out = _io.BytesIO()
+        canvas.save(out, format="PNG", optimize=True)
+        return out.getvalue()
+    except Exception:
+        return None
+
+
+def _save_signature_thumbnail(cfg: CashflowConfig, signature_path: str, png_bytes: bytes) -> Optional[Dict[str, Any]]:
+    """Сохраняет миниатюру рядом с оригиналом (<имя>_thumb.png); возвращает поля для cash_signatures."""
+    thumb = make_signature_thumbnail(png_bytes)
+    if thumb is None:
+        return None
+    src = cfg.uploads_dir / signature_path
+    path = src.with_name(f"{src.stem}_thumb.png")
+    path.write_bytes(thumb)
+    return {
+        "path": str(path.relative_to(cfg.uploads_dir)),
+        "sha256": hashlib.sha256(thumb).hexdigest(),
+        "width": SIGNATURE_THUMB_SIZE[0],
+        "height": SIGNATURE_THUMB_SIZE[1],
+    }
+
+
+def ensure_signature_thumbnail(conn: sqlite3.Connection, cfg: CashflowConfig, signature_id: int) -> Optional[bytes]:
+    """
+    Байты миниатюры подписи. Для подписей, сохранённых до появления миниатюр,
+    строит её из оригинала (с нормализацией) и записывает в cash_signatures.
+    """
+    row = _fetchone(
+        conn,
+        "SELECT id, signature_path, thumb_path FROM cash_signatures WHERE id=?;",
+        (int(signature_id),),
+    )
+    if not row or not row["signature_path"]:
+        return None
+    if row["thumb_path"]:
+        try:
+            return get_signature_file_path(cfg, str(row["thumb_path"])).read_bytes()
+        except (ValueError, OSError):
+            pass
+    try:
+        src = get_signature_file_path(cfg, str(row["signature_path"]))
+        png = normalize_signature_png_bytes(src.read_bytes())
+        thumb = _save_signature_thumbnail(cfg, str(row["signature_path"]), png)
+    except (ValueError, OSError):
+        return None
+    if thumb is None:
+        return None
+    conn.execute(
+        "UPDATE cash_signatures SET thumb_path=?, thumb_sha256=?, thumb_width=?, thumb_height=? WHERE id=?;",
+        (thumb["path"], thumb["sha256"], thumb["width"], thumb["height"], int(signature_id)),
+    )
+    return get_signature_file_path(cfg, thumb["path"]).read_bytes()
+
+
+def backfill_signature_thumbnails(conn: sqlite3.Connection, cfg: CashflowConfig) -> int:
+    """Строит миниатюры для всех подписей без них. Возвращает число созданных."""
+    ids = [
+        int(r["id"])
+        for r in _fetchall(
+            conn,
+            "SELECT id FROM cash_signatures WHERE decision='SIGNED' AND signature_path IS NOT NULL AND thumb_path IS NULL;",
+        )
+    ]
+    created = 0
+    for signature_id in ids:
+        if ensure_signature_thumbnail(conn, cfg, signature_id) is not None:
+            created += 1
+    return created
+
+
 def record_signature(
     conn: sqlite3.Connection,
     cfg: CashflowConfig,
@@ -488,13 +603,23 @@ def record_signature(
     png = _decode_data_url_png(signature_data_url)
     png = normalize_signature_png_bytes(png)
     rel_path = _save_signature_png(cfg, request_id, telegram_id, attempt, png)
+    thumb = _save_signature_thumbnail(cfg, rel_path, png)
     now = iso_now()
     conn.execute(
         """
-        INSERT INTO cash_signatures (request_id, telegram_id, attempt, decision, refuse_reason, signature_path, signed_at)
-        VALUES (?, ?, ?, 'SIGNED', NULL, ?, ?);
+        INSERT INTO cash_signatures (
+            request_id, telegram_id, attempt, decision, refuse_reason, signature_path, signed_at,
+            thumb_path, thumb_sha256, thumb_width, thumb_height
+        )
+        VALUES (?, ?, ?, 'SIGNED', NULL, ?, ?, ?, ?, ?, ?);
         """,
-        (int(request_id), int(telegram_id), int(attempt), rel_path, now),
+        (
+            int(request_id), int(telegram_id), int(attempt), rel_path, now,
+            thumb["path"] if thumb else None,
+            thumb["sha256"] if thumb else None,
+            thumb["width"] if thumb else None,
+            thumb["height"] if thumb else None,
+        ),
     )
     conn.execute(
         "UPDATE cash_requests SET updated_at=? WHERE id=?;",
@@ -661,65 +786,67 @@ def get_signature_file_path(cfg: CashflowConfig, signature_path: str) -> Path:
     return p
 
 
-def list_withdraw_act_rows(
-    conn: sqlite3.Connection,
-    *,
-    account: Optional[str] = None,
-    date_from: Optional[str] = None,
-    date_to: Optional[str] = None,
-) -> List[Dict[str, Any]]:
-    """Возвращает строки акта изъятия/сбора наличных (по участникам) + статус подписи.
+_ISO_DAY_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
 
-    signature_value:
-      - "SIGNED" -> есть подпись (signature_path может быть None, если файл потерян)
-      - "ОТКАЗ: причина"
-      - "Ожидает подписи"
-    signature_path:
-      - относительный путь PNG (attempt=2 если есть, иначе attempt=1)
-    participant_telegram_id:
-      - telegram_id участника (нужно для загрузки PNG подписи через API)
 
-    ВАЖНО:
-      - date возвращаем ТОЛЬКО дату YYYY-MM-DD (без времени)
-      - amount возвращаем числом, округлённым до 2 знаков
-    """
+def _act_lower_bound(v: str) -> str:
+    """YYYY-MM-DD -> YYYY-MM-DDT00:00:00Z, ISO оставляем как есть."""
+    s = (v or "").strip()
+    if s and _ISO_DAY_RE.match(s):
+        return f"{s}T00:00:00Z"
+    return s
+
+
+def _act_upper_bound(v: str) -> str:
+    """YYYY-MM-DD -> YYYY-MM-DDT23:59:59Z, ISO оставляем как есть."""
+    s = (v or "").strip()
+    if s and _ISO_DAY_RE.match(s):
+        return f"{s}T23:59:59Z"
+    return s
 
-    def _to_iso_lower_bound(v: str) -> str:
-        """YYYY-MM-DD -> YYYY-MM-DDT00:00:00Z, ISO оставляем как есть (подправляем Z при необходимости)."""
-        s = (v or "").strip()
-        if not s:
-            return s
-        if re.fullmatch(r"\d{4}-\d{2}-\d{2}", s):
-            return f"{s}T00:00:00Z"
-        # если вдруг без Z, но ISO — оставим как есть
-        return s
-
-    def _to_iso_upper_bound(v: str) -> str:
-        """YYYY-MM-DD -> YYYY-MM-DDT23:59:59Z, ISO оставляем как есть."""
-        s = (v or "").strip()
-        if not s:
-            return s
-        if re.fullmatch(r"\d{4}-\d{2}-\d{2}", s):
-            return f"{s}T23:59:59Z"
-        return s
-
-    def _date_only(created_at: Any) -> str:
-        """Из created_at (ISO) делаем YYYY-MM-DD."""
-        raw = str(created_at or "").strip()
-        if not raw:
-            return ""
-        # быстрый путь
-        if len(raw) >= 10:
-            d10 = raw[:10]
-            if re.fullmatch(r"\d{4}-\d{2}-\d{2}", d10):
-                return d10
-        # попытка распарсить
-        try:
-            s = raw.replace("Z", "+00:00")
-            return dt.datetime.fromisoformat(s).date().isoformat()
-        except Exception:
-            return raw[:10] if len(raw) >= 10 else raw
 
+def _act_date_only(created_at: Any) -> str:
+    """Из created_at (ISO) делаем YYYY-MM-DD."""
+    raw = str(created_at or "").strip()
+    if not raw:
+        return ""
+    # быстрый путь без regex: created_at у нас всегда ISO
+    if len(raw) >= 10 and raw[4] == "-" and raw[7] == "-" and raw[:4].isdigit() and raw[5:7].isdigit() and raw[8:10].isdigit():
+        return raw[:10]
+    try:
+        return dt.datetime.fromisoformat(raw.replace("Z", "+00:00")).date().isoformat()
+    except Exception:
+        return raw[:10] if len(raw) >= 10 else raw
+
+
+def encode_act_cursor(created_at: str, request_id: int) -> str:
+    raw = json.dumps([str(created_at), int(request_id)], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_act_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, request_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return str(created_at), int(request_id)
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def _withdraw_act_cursor(
+    conn: sqlite3.Connection,
+    *,
+    account: Optional[str],
+    date_from: Optional[str],
+    date_to: Optional[str],
+    after: Optional[Tuple[str, int]],
+    limit_requests: Optional[int],
+) -> sqlite3.Cursor:
+    """
+    Курсор по заявкам страницы x участникам. LEFT JOIN: заявка без участников
+    даёт одну строку с participant_telegram_id IS NULL — по ней пагинация
+    видит, что заявка на странице была (в сам акт такие строки не попадают).
+    """
     params: List[Any] = []
     where = "WHERE 1=1 "
 
@@ -729,14 +856,30 @@ def list_withdraw_act_rows(
 
     if date_from:
         where += " AND r.created_at >= ?"
-        params.append(_to_iso_lower_bound(str(date_from)))
+        params.append(_act_lower_bound(str(date_from)))
 
     if date_to:
         where += " AND r.created_at <= ?"
-        params.append(_to_iso_upper_bound(str(date_to)))
+        params.append(_act_upper_bound(str(date_to)))
+
+    if after is not None:
+        where += " AND (r.created_at < ? OR (r.created_at = ? AND r.id < ?))"
+        params.extend([after[0], after[0], int(after[1])])
+
+    limit_sql = ""
+    if limit_requests is not None:
+        limit_sql = "LIMIT ?"
+        params.append(int(limit_requests))
 
-    rows = conn.execute(
+    return conn.execute(
         f"""
+        WITH page AS (
+            SELECT r.id, r.account, r.op_type, r.amount, r.created_at
+            FROM cash_requests r
+            {where}
+            ORDER BY r.created_at DESC, r.id DESC
+            {limit_sql}
+        )
         SELECT
             r.id AS request_id,
             r.account,
@@ -750,52 +893,156 @@ def list_withdraw_act_rows(
             s1.decision AS sig1_decision,
             s1.refuse_reason AS sig1_reason,
             s1.signature_path AS sig1_path,
+            s1.id AS sig1_id,
+            s1.thumb_path AS sig1_thumb,
             s2.decision AS sig2_decision,
             s2.refuse_reason AS sig2_reason,
-            s2.signature_path AS sig2_path
-        FROM cash_requests r
-        JOIN cash_request_participants p ON p.request_id = r.id
+            s2.signature_path AS sig2_path,
+            s2.id AS sig2_id,
+            s2.thumb_path AS sig2_thumb
+        FROM page r
+        LEFT JOIN cash_request_participants p ON p.request_id = r.id
         LEFT JOIN cash_signatures s1
           ON s1.request_id = r.id AND s1.telegram_id = p.telegram_id AND s1.attempt = 1
         LEFT JOIN cash_signatures s2
           ON s2.request_id = r.id AND s2.telegram_id = p.telegram_id AND s2.attempt = 2
-        {where}
         ORDER BY r.created_at DESC, r.id DESC, p.is_admin ASC, p.id ASC
         """,
         params,
-    ).fetchall()
-
-    out: List[Dict[str, Any]] = []
-    for row in rows:
-        # attempt=2 важнее, если есть
-        sig_dec = row["sig2_decision"] or row["sig1_decision"]
-        sig_reason = row["sig2_reason"] or row["sig1_reason"]
-        sig_path = row["sig2_path"] or row["sig1_path"]
-
-        if sig_dec == "REFUSED":
-            signature_value = f"ОТКАЗ: {sig_reason or 'без причины'}"
-        elif sig_dec == "SIGNED":
-            signature_value = "SIGNED"
-        else:
-            signature_value = "Ожидает подписи"
+    )
 
-        amount_val = round(float(row["amount"] or 0), 2)
 
-        out.append(
-            {
-                "request_id": int(row["request_id"]),
-                "participant_telegram_id": int(row["participant_telegram_id"]),
-                "account": row["account"],
-                "op_type": row["op_type"],
-                "amount": amount_val,                 # число, округлено до 2 знаков
-                "date": _date_only(row["created_at"]),# ТОЛЬКО YYYY-MM-DD
-                "fio": row["name_snapshot"],
-                "user_type": row["role_snapshot"],
-                "signature_value": signature_value,
-                "signature_path": sig_path,
-            }
-        )
-    return out
+def iter_withdraw_act_rows(
+    conn: sqlite3.Connection,
+    *,
+    account: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    after: Optional[Tuple[str, int]] = None,
+    limit_requests: Optional[int] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Строки акта по одной (порядок: created_at DESC, id DESC, админ последним).
+
+    Фильтр и keyset-пагинация — по заявкам: after=(created_at, id) последней
+    заявки предыдущей страницы, limit_requests — сколько заявок взять
+    (у заявки все участники всегда на одной странице). Диапазон по
+    cash_requests(account, created_at, id) / (created_at, id).
+    """
+    cur = _withdraw_act_cursor(
+        conn,
+        account=account,
+        date_from=date_from,
+        date_to=date_to,
+        after=after,
+        limit_requests=limit_requests,
+    )
+    for row in cur:
+        if row["participant_telegram_id"] is not None:
+            yield _act_row(row)
+
+
+def _act_row(row: sqlite3.Row) -> Dict[str, Any]:
+    # attempt=2 важнее, если есть
+    sig_dec = row["sig2_decision"] or row["sig1_decision"]
+    sig_reason = row["sig2_reason"] or row["sig1_reason"]
+    sig_path = row["sig2_path"] or row["sig1_path"]
+    # id/миниатюра — той же записи, откуда взят signature_path
+    sig_id = row["sig2_id"] if row["sig2_path"] else (row["sig1_id"] if row["sig1_path"] else None)
+    sig_thumb = row["sig2_thumb"] if row["sig2_path"] else row["sig1_thumb"]
+
+    if sig_dec == "REFUSED":
+        signature_value = f"ОТКАЗ: {sig_reason or 'без причины'}"
+    elif sig_dec == "SIGNED":
+        signature_value = "SIGNED"
+    else:
+        signature_value = "Ожидает подписи"
+
+    return {
+        "request_id": int(row["request_id"]),
+        "participant_telegram_id": int(row["participant_telegram_id"]),
+        "account": row["account"],
+        "op_type": row["op_type"],
+        "amount": round(float(row["amount"] or 0), 2),  # число, округлено до 2 знаков
+        "date": _act_date_only(row["created_at"]),        # ТОЛЬКО YYYY-MM-DD
+        "created_at": row["created_at"],
+        "fio": row["name_snapshot"],
+        "user_type": row["role_snapshot"],
+        "signature_value": signature_value,
+        "signature_path": sig_path,
+        "signature_id": int(sig_id) if sig_id is not None else None,
+        "signature_thumb_path": sig_thumb,
+    }
+
+
+def list_withdraw_act_rows(
+    conn: sqlite3.Connection,
+    *,
+    account: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Возвращает строки акта изъятия/сбора наличных (по участникам) + статус подписи.
+
+    signature_value:
+      - "SIGNED" -> есть подпись (signature_path может быть None, если файл потерян)
+      - "ОТКАЗ: причина"
+      - "Ожидает подписи"
+    signature_path:
+      - относительный путь PNG (attempt=2 если есть, иначе attempt=1)
+    participant_telegram_id:
+      - telegram_id участника (нужно для загрузки PNG подписи через API)
+
+    ВАЖНО:
+      - date возвращаем ТОЛЬКО дату YYYY-MM-DD (без времени)
+      - amount возвращаем числом, округлённым до 2 знаков
+    """
+    return list(iter_withdraw_act_rows(conn, account=account, date_from=date_from, date_to=date_to))
+
+
+def list_withdraw_act_page(
+    conn: sqlite3.Connection,
+    *,
+    account: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit_requests: int = 50,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Страница акта (keyset по заявкам) + курсор следующей страницы (None — конец)."""
+    after = decode_act_cursor(cursor) if cursor else None
+    limit = int(limit_requests)
+    # берём на одну заявку больше, чтобы понять, есть ли продолжение;
+    # has_more и курсор считаем по заявкам страницы, а не по строкам акта —
+    # заявка без участников не должна обрывать пагинацию
+    cur = _withdraw_act_cursor(
+        conn,
+        account=account,
+        date_from=date_from,
+        date_to=date_to,
+        after=after,
+        limit_requests=limit + 1,
+    )
+    items: List[Dict[str, Any]] = []
+    page_ids: List[int] = []
+    last: Optional[Tuple[str, int]] = None
+    for row in cur:
+        rid = int(row["request_id"])
+        if not page_ids or page_ids[-1] != rid:
+            if len(page_ids) == limit:
+                # (limit+1)-я заявка: продолжение есть
+                assert last is not None
+                return items, encode_act_cursor(last[0], last[1])
+            page_ids.append(rid)
+            last = (str(row["created_at"]), rid)
+        if row["participant_telegram_id"] is not None:
+            items.append(_act_row(row))
+    return items, None
+
+
+# Пиксель считается "чернилами", если хоть один канал темнее порога.
+_SIGNATURE_INK_LUT = [255 if v < 250 else 0 for v in range(256)]
+_SIGNATURE_INK_RGB = (0, 74, 173)
+_SIGNATURE_PAD = 8
 
 
 def normalize_signature_png_bytes(png_bytes: bytes) -> bytes:
@@ -804,11 +1051,12 @@ def normalize_signature_png_bytes(png_bytes: bytes) -> bytes:
     - убирает прозрачные поля (crop по альфе)
     - добавляет небольшой padding
     - композитит на белый фон (Excel иногда капризничает с прозрачностью)
+    Все операции — покадровые операции Pillow (point/ImageChops), без циклов по пикселям.
     Если Pillow недоступен/PNG битый — возвращает исходные bytes.
     """
     try:
         import io as _io
-        from PIL import Image  # pip install pillow
+        from PIL import Image, ImageChops, ImageOps  # pip install pillow
     except Exception:
         return png_bytes
 
@@ -822,46 +1070,23 @@ def normalize_signature_png_bytes(png_bytes: bytes) -> bytes:
         if im.mode != "RGBA":
             im = im.convert("RGBA")
 
+        r, g, b, alpha = im.split()
+        if alpha.getextrema() == (255, 255):
+            # Канвас без прозрачности: маска по "небелым" пикселям
+            alpha = ImageChops.lighter(
+                ImageChops.lighter(r.point(_SIGNATURE_INK_LUT), g.point(_SIGNATURE_INK_LUT)),
+                b.point(_SIGNATURE_INK_LUT),
+            )
 
-        alpha = im.split()[-1]
-        alpha_extrema = alpha.getextrema()
-        if alpha_extrema == (255, 255):
-            # Канвас без прозрачности: строим маску по "небелым" пикселям
-            rgb = im.convert("RGB")
-            mask = Image.new("L", im.size, 0)
-            px = rgb.load()
-            mask_px = mask.load()
-            for y in range(im.size[1]):
-                for x in range(im.size[0]):
-                    r, g, b = px[x, y]
-                    if r < 250 or g < 250 or b < 250:
-                        mask_px[x, y] = 255
-            alpha = mask
-
-        # crop по альфе/маске (убираем пустые поля)
+        # crop по альфе/маске (убираем пустые поля) + padding
         bbox = alpha.getbbox()
         if bbox:
-            im = im.crop(bbox)
             alpha = alpha.crop(bbox)
+        alpha = ImageOps.expand(alpha, border=_SIGNATURE_PAD, fill=0)
 
-        # padding
-        pad = 8
-        w, h = im.size
-        canvas = Image.new("RGBA", (w + pad * 2, h + pad * 2), (255, 255, 255, 0))
-        canvas.paste(im, (pad, pad), im)
-        im = canvas
-        alpha = alpha.crop((0, 0, w, h))
-        padded_alpha = Image.new("L", (w + pad * 2, h + pad * 2), 0)
-        padded_alpha.paste(alpha, (pad, pad))
-        alpha = padded_alpha
-
-        # нормализуем цвет штрихов в синий для контраста
-        blue = Image.new("RGBA", im.size, (0, 74, 173, 0))
-        blue.putalpha(alpha)
-
-        # композит на белый фон (RGB)
-        bg = Image.new("RGB", im.size, (255, 255, 255))
-        bg.paste(blue, mask=alpha)
+        # штрихи в синий для контраста, композит на белый фон (RGB)
+        bg = Image.new("RGB", alpha.size, (255, 255, 255))
+        bg.paste(_SIGNATURE_INK_RGB, (0, 0, *alpha.size), mask=alpha)
 
         out = _io.BytesIO()
         bg.save(out, format="PNG", optimize=True)
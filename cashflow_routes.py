@@ -9,8 +9,7 @@ FastAPI роуты для модуля подтверждения наличны
     from cashflow_routes import router as cashflow_router
     APP.include_router(cashflow_router)
 
-    import cashflow_models
-    # внутри init_db(): cashflow_models.init_cashflow_db(conn)
+    # в lifespan после init_db(): bootstrap_cashflow() -> cashflow_models.bootstrap(cfg)
 
     import cashflow_bot
     # внутри lifespan после создания bot: cashflow_bot.set_bot(bot)
@@ -19,16 +18,16 @@ FastAPI роуты для модуля подтверждения наличны
 from __future__ import annotations
 
 import io
-import os
-import tempfile
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
-from fastapi import APIRouter, BackgroundTasks, Body, Depends, HTTPException, Query, Request
-from fastapi.responses import FileResponse, Response, StreamingResponse
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel, Field
 
+import allowlist
 import cashflow_models as m
+import db_pool
 import cashflow_bot as b
 
 import datetime as dt
@@ -42,7 +41,7 @@ router = APIRouter()
 
 
 def _app_db_connect():
-    from app import db_connect  # lazy
+    from app import db_connect  # lazy; общий пул соединений (db_pool)
     return db_connect
 
 
@@ -67,32 +66,15 @@ def _app_finalize_cashflow_collect_request():
     return finalize_cashflow_collect_request
 
 
-def _get_cfg_paths() -> Dict[str, Any]:
-    from app import CFG  # lazy
-    return {
-        "base_dir": Path(__file__).resolve().parent,
-        "users_json": Path(CFG.USERS_JSON_PATH),
-        "db_path": Path(CFG.DB_PATH),
-    }
-
-
-def _ensure_cashflow_tables() -> None:
-    db_connect = _app_db_connect()
-    with db_connect() as conn:
-        m.init_cashflow_db(conn)
+def _require_cashflow_ready() -> None:
+    # таблицы и конфиг готовит app.bootstrap_cashflow() один раз в lifespan
+    if not m.is_ready():
+        raise HTTPException(status_code=503, detail="Cashflow module is not ready")
 
 
 def _cash_cfg() -> m.CashflowConfig:
-    paths = _get_cfg_paths()
-    # переопределяем paths, чтобы совпадало с app.py
-    cfg = m.load_cashflow_config(paths["base_dir"])
-    return m.CashflowConfig(
-        base_dir=cfg.base_dir,
-        db_path=paths["db_path"],
-        users_json_path=paths["users_json"],
-        uploads_dir=cfg.uploads_dir,
-        timezone=cfg.timezone,
-    )
+    _require_cashflow_ready()
+    return m.get_config()
 
 
 # ---------------------------
@@ -143,10 +125,8 @@ def cashapp_html():
 @router.post("/api/cashflow/requests")
 def create_request(
     body: CashRequestCreateIn,
-    bg: BackgroundTasks,
     u=Depends(_app_require_role("admin", "accountant")),
 ):
-    _ensure_cashflow_tables()
     cfg = _cash_cfg()
     db_connect = _app_db_connect()
 
@@ -166,8 +146,7 @@ def create_request(
         signers = [p["telegram_id"] for p in view["participants"] if not p["is_admin"]]
 
     # уведомляем подписантов
-    bg.add_task(
-        b.notify_signers_new_request,
+    b.notify_signers_new_request(
         request_id=request_id,
         account=req["account"],
         op_type=req["op_type"],
@@ -187,7 +166,7 @@ def my_requests(
     offset: int = Query(0, ge=0),
     u=Depends(_app_require_role("admin", "accountant", "viewer", "cash_signer")),
 ):
-    _ensure_cashflow_tables()
+    _require_cashflow_ready()
     db_connect = _app_db_connect()
     with db_connect() as conn:
         items = m.list_my_cash_requests(
@@ -209,7 +188,7 @@ def list_requests(
     offset: int = Query(0, ge=0),
     u=Depends(_app_require_role("admin")),
 ):
-    _ensure_cashflow_tables()
+    _require_cashflow_ready()
     db_connect = _app_db_connect()
     with db_connect() as conn:
         items = m.list_cash_requests(conn, account=account, status=status, limit=limit, offset=offset)
@@ -221,7 +200,7 @@ def request_detail(
     request_id: int,
     u=Depends(_app_require_role("admin", "accountant", "viewer", "cash_signer")),
 ):
-    _ensure_cashflow_tables()
+    _require_cashflow_ready()
     db_connect = _app_db_connect()
     with db_connect() as conn:
         view = m.build_request_view(conn, int(request_id))
@@ -242,10 +221,8 @@ def request_detail(
 def sign_request(
     request_id: int,
     body: CashSignIn,
-    bg: BackgroundTasks,
     u=Depends(_app_require_role("cash_signer", "admin")),
 ):
-    _ensure_cashflow_tables()
     cfg = _cash_cfg()
     db_connect = _app_db_connect()
     with db_connect() as conn:
@@ -274,10 +251,11 @@ def sign_request(
 
 
     # уведомить ответственного админа
-    bg.add_task(
-        b.notify_admin_about_decision,
+    b.notify_admin_about_decision(
         admin_id=int(req["admin_telegram_id"]),
         request_id=int(request_id),
+        signer_telegram_id=int(u["telegram_id"]),
+        attempt=int(req.get("attempt") or 1),
         account=req["account"],
         op_type=req["op_type"],
         amount=float(req["amount"]),
@@ -287,8 +265,7 @@ def sign_request(
     )
     # если финализировано — уведомить инициатора
     if req.get("created_by_telegram_id") and req.get("status") == "FINAL":
-        bg.add_task(
-            b.notify_initiator_final,
+        b.notify_initiator_final(
             initiator_id=int(req["created_by_telegram_id"]),
             request_id=int(request_id),
             account=req["account"],
@@ -304,10 +281,9 @@ def sign_request(
 def refuse_request(
     request_id: int,
     body: CashRefuseIn,
-    bg: BackgroundTasks,
     u=Depends(_app_require_role("cash_signer")),
 ):
-    _ensure_cashflow_tables()
+    _require_cashflow_ready()
     db_connect = _app_db_connect()
     with db_connect() as conn:
         try:
@@ -326,10 +302,11 @@ def refuse_request(
         req = view["request"]
         signer_name = str(u["name"])
 
-    bg.add_task(
-        b.notify_admin_about_decision,
+    b.notify_admin_about_decision(
         admin_id=int(req["admin_telegram_id"]),
         request_id=int(request_id),
+        signer_telegram_id=int(u["telegram_id"]),
+        attempt=int(req.get("attempt") or 1),
         account=req["account"],
         op_type=req["op_type"],
         amount=float(req["amount"]),
@@ -349,12 +326,10 @@ def refuse_request(
 def admin_resend(
     request_id: int,
     body: CashResendIn = Body(default_factory=CashResendIn),
-    bg: BackgroundTasks = None,  # type: ignore[assignment]
     u=Depends(_app_require_role("admin")),
 ):
-    _ensure_cashflow_tables()
+    _require_cashflow_ready()
     db_connect = _app_db_connect()
-    cfg = _cash_cfg()
     with db_connect() as conn:
         try:
             targets = m.resend_for_refusals(
@@ -371,17 +346,15 @@ def admin_resend(
         except Exception as e:
             raise HTTPException(status_code=400, detail=str(e))
 
-    if bg is not None:
-        bg.add_task(
-            b.notify_signers_new_request,
-            request_id=int(request_id),
-            account=req["account"],
-            op_type=req["op_type"],
-            amount=float(req["amount"]),
-            signer_ids=targets,
-            is_retry=True,
-            admin_comment=req.get("admin_comment"),
-        )
+    b.notify_signers_new_request(
+        request_id=int(request_id),
+        account=req["account"],
+        op_type=req["op_type"],
+        amount=float(req["amount"]),
+        signer_ids=targets,
+        is_retry=True,
+        admin_comment=req.get("admin_comment"),
+    )
     return {"ok": True, "targets": targets, "item": view}
 
 
@@ -389,7 +362,6 @@ def admin_resend(
 def admin_sign(
     request_id: int,
     body: CashSignIn,
-    bg: BackgroundTasks,
     u=Depends(_app_require_role("admin")),
 ):
     raise HTTPException(status_code=403, detail="Admin sign is disabled, use /sign")
@@ -401,7 +373,7 @@ def admin_cancel(
     comment: Optional[str] = Body(None),
     u=Depends(_app_require_role("admin")),
 ):
-    _ensure_cashflow_tables()
+    _require_cashflow_ready()
     db_connect = _app_db_connect()
     with db_connect() as conn:
         try:
@@ -426,7 +398,6 @@ def get_signature_png(
     u=Depends(_app_require_role("admin", "accountant", "viewer", "cash_signer")),
 ):
     """Возвращает эффективную подпись участника: attempt=2 если есть, иначе attempt=1."""
-    _ensure_cashflow_tables()
     cfg = _cash_cfg()
     db_connect = _app_db_connect()
 
@@ -481,9 +452,7 @@ def get_signature_png(
 def _user_can_view_withdraw_act(telegram_id: int, role: str) -> bool:
     if role in ("admin", "accountant"):
         return True
-    cfg = _cash_cfg()
-    allow = m.load_users_allowlist(cfg.users_json_path)
-    u = allow.get(int(telegram_id))
+    u = allowlist.current().raw.get(int(telegram_id))
     if not u or not (u.get("active") is True or u.get("active") == 1):
         return False
     ops = u.get("cash_ops") or []
@@ -499,15 +468,36 @@ def withdraw_act(
     account: Optional[str] = Query(None, description="main|praise|alpha (опционально)"),
     date_from: Optional[str] = Query(None),
     date_to: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None, description="next_cursor предыдущей страницы"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Заявок на страницу; без limit — весь период"),
     u=Depends(_app_require_role("admin", "accountant", "cash_signer")),
 ):
     if not _user_can_view_withdraw_act(int(u["telegram_id"]), str(u["role"])):
         raise HTTPException(status_code=403, detail="No access to withdraw act")
-    _ensure_cashflow_tables()
+    _require_cashflow_ready()
     db_connect = _app_db_connect()
     with db_connect() as conn:
-        rows = m.list_withdraw_act_rows(conn, account=account, date_from=date_from, date_to=date_to)
-    return {"items": rows}
+        if limit is None and not cursor:
+            rows = m.list_withdraw_act_rows(conn, account=account, date_from=date_from, date_to=date_to)
+            return {"items": rows, "next_cursor": None}
+        try:
+            rows, next_cursor = m.list_withdraw_act_page(
+                conn,
+                account=account,
+                date_from=date_from,
+                date_to=date_to,
+                cursor=cursor,
+                limit_requests=int(limit or 50),
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return {"items": rows, "next_cursor": next_cursor}
+
+
+def _app_iter_spooled_file():
+    from app import iter_spooled_file  # lazy
+    return iter_spooled_file
+
 
 @router.get("/api/cashflow/withdraw-act.xlsx")
 def withdraw_act_xlsx(
@@ -516,8 +506,11 @@ def withdraw_act_xlsx(
     date_to: Optional[str] = Query(None),
     u=Depends(_app_require_role("admin", "accountant")),
 ):
-    """Экспорт акта наличных (сбор/изъятие) в Excel с PNG подписями."""
-    _ensure_cashflow_tables()
+    """Экспорт акта наличных (сбор/изъятие) в Excel с PNG подписями.
+
+    Один проход по строкам акта: write_only-книга, каждая строка сразу уходит
+    в лист своего счёта; файл собирается во временном spooled-файле.
+    """
     cfg = _cash_cfg()
     db_connect = _app_db_connect()
 
@@ -535,181 +528,159 @@ def withdraw_act_xlsx(
             detail="Pillow (PIL) is required to embed signature images into Excel",
         )
 
+    import tempfile
+
     import openpyxl
+    from openpyxl.cell import WriteOnlyCell
     from openpyxl.utils.units import points_to_pixels, pixels_to_EMU
     from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
     from openpyxl.drawing.image import Image as XLImage
     from openpyxl.drawing.spreadsheet_drawing import AnchorMarker, OneCellAnchor, XDRPositiveSize2D
 
-
-
-    with db_connect() as conn:
-        rows_all = m.list_withdraw_act_rows(conn, account=account, date_from=date_from, date_to=date_to)
-
-    wb = openpyxl.Workbook()
-    wb.remove(wb.active)
-    temp_paths: list[str] = []
-
-    def make_sheet(account_code: str, title: str):
+    if account:
+        acc = account.strip().lower()
+        if acc not in m.ACCOUNTS:
+            raise HTTPException(status_code=400, detail="Invalid account")
+        sheet_specs = [(acc, acc.upper())]
+    else:
+        sheet_specs = [("main", "MAIN"), ("praise", "PRAISE"), ("alpha", "ALPHA")]
+
+    # стили
+    thin = Side(style="thin", color="D0D0D0")
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    header_fill = PatternFill("solid", fgColor="F3F4F6")
+    header_font = Font(bold=True)
+    center = Alignment(vertical="center", horizontal="center", wrap_text=True)
+    left = Alignment(vertical="center", horizontal="left", wrap_text=True)
+
+    sig_col_width = 24  # подпись
+    row_height = 36     # место под картинку
+    thumb_w, thumb_h = m.SIGNATURE_THUMB_SIZE
+    cell_width_px = int(sig_col_width * 7 + 5)
+    cell_height_px = points_to_pixels(row_height)
+    x_off = max((cell_width_px - thumb_w) / 2, 0)
+    y_off = max((cell_height_px - thumb_h) / 2, 0)
+
+    wb = openpyxl.Workbook(write_only=True)
+    sheets: Dict[str, Any] = {}
+    next_row: Dict[str, int] = {}
+
+    def styled(ws: Any, value: Any, alignment: Any, number_format: Optional[str] = None) -> Any:
+        c = WriteOnlyCell(ws, value=value)
+        c.alignment = alignment
+        c.border = border
+        if number_format:
+            c.number_format = number_format
+        return c
+
+    for account_code, title in sheet_specs:
         ws = wb.create_sheet(title)
-        ws.append(["Дата", "Операция", "Сумма", "ФИО", "Тип пользователя", "Подпись"])
         ws.freeze_panes = "A2"
-
         ws.column_dimensions["A"].width = 14
         ws.column_dimensions["B"].width = 18
         ws.column_dimensions["C"].width = 16
         ws.column_dimensions["D"].width = 32
         ws.column_dimensions["E"].width = 18
-        ws.column_dimensions["F"].width = 24  # подпись
-
-        # стили
-        thin = Side(style="thin", color="D0D0D0")
-        border = Border(left=thin, right=thin, top=thin, bottom=thin)
-        header_fill = PatternFill("solid", fgColor="F3F4F6")
-        header_font = Font(bold=True)
-        center = Alignment(vertical="center", horizontal="center", wrap_text=True)
-        left = Alignment(vertical="center", horizontal="left", wrap_text=True)
-
-        # header style
-        for col in range(1, 7):
-            c = ws.cell(row=1, column=col)
+        ws.column_dimensions["F"].width = sig_col_width
+
+        header = []
+        for title_text in ["Дата", "Операция", "Сумма", "ФИО", "Тип пользователя", "Подпись"]:
+            c = styled(ws, title_text, center)
             c.fill = header_fill
             c.font = header_font
-            c.alignment = center
-            c.border = border
-
-        rnum = 2
-        for r in rows_all:
-            if r.get("account") != account_code:
+            header.append(c)
+        ws.append(header)
+        sheets[account_code] = ws
+        next_row[account_code] = 2
+
+    thumbs: Dict[int, Optional[bytes]] = {}
+
+    # строки читаем отдельным read-only соединением (курсор живёт весь проход),
+    # а недостающие миниатюры записываем через обычную единицу работы пула
+    with db_pool.open_reader(cfg.db_path) as reader:
+        for r in m.iter_withdraw_act_rows(reader, account=account, date_from=date_from, date_to=date_to):
+            account_code = str(r.get("account") or "")
+            ws = sheets.get(account_code)
+            if ws is None:
                 continue
+            rnum = next_row[account_code]
+            next_row[account_code] = rnum + 1
 
             # --- ДАТА: только дата ---
-            date_cell = ws.cell(row=rnum, column=1)
             raw_date = r.get("date")  # ожидаем YYYY-MM-DD
+            date_value: Any = ""
             if raw_date:
-                s = str(raw_date)[:10]
+                d10 = str(raw_date)[:10]
                 try:
-                    date_cell.value = dt.date.fromisoformat(s)
+                    date_value = dt.date.fromisoformat(d10)
                 except Exception:
-                    date_cell.value = s
-            else:
-                date_cell.value = ""
-            date_cell.number_format = "DD.MM.YYYY"
-            date_cell.alignment = center
-            date_cell.border = border
+                    date_value = d10
 
             # --- ОПЕРАЦИЯ ---
             op = str(r.get("op_type") or "")
             op_disp = {"collect": "Сбор наличных", "withdraw": "Изъятие наличных"}.get(op, op)
-            c2 = ws.cell(row=rnum, column=2, value=op_disp)
-            c2.alignment = left
-            c2.border = border
-
-            # --- СУММА: всегда .00 ---
-            amt = float(r.get("amount") or 0)
-            c3 = ws.cell(row=rnum, column=3, value=amt)
-            c3.number_format = "#,##0.00"
-            c3.alignment = center
-            c3.border = border
-
-            # --- ФИО / ТИП ---
-            c4 = ws.cell(row=rnum, column=4, value=r.get("fio"))
-            c4.alignment = left
-            c4.border = border
-
-            c5 = ws.cell(row=rnum, column=5, value=r.get("user_type"))
-            c5.alignment = center
-            c5.border = border
 
             # --- ПОДПИСЬ ---
-            sig_cell = ws.cell(row=rnum, column=6)
-            sig_cell.border = border
-            sig_cell.alignment = center
-
             signature_path = r.get("signature_path")
-            signature_value = r.get("signature_value") or ""
-
-            # место под картинку
-            ws.row_dimensions[rnum].height = 36
-
-            # подписано -> вставляем PNG (ЖИВАЯ подпись)
-            if signature_path:
+            signature_value = str(r.get("signature_value") or "")
+            sig_id = r.get("signature_id")
+
+            raw = None
+            if signature_path and sig_id is not None:
+                sig_id = int(sig_id)
+                if sig_id not in thumbs:
+                    # миниатюра 120x32 уже нормализована; строим только для старых подписей
+                    with db_connect() as conn:
+                        thumbs[sig_id] = m.ensure_signature_thumbnail(conn, cfg, sig_id)
+                raw = thumbs[sig_id]
+
+            sig_text = signature_value
+            if raw is not None:
+                # подписано -> вставляем PNG (ЖИВАЯ подпись)
                 try:
-                    img_path = m.get_signature_file_path(cfg, str(signature_path))
-                except ValueError:
-                    img_path = None
-                if img_path and img_path.exists():
-                    raw = m.normalize_signature_png_bytes(img_path.read_bytes())
-
-                    # чтобы в ячейке не было текста
-                    sig_cell.value = ""
-
-
-                    try:
-                        # openpyxl.Image надёжнее работает с путём к файлу, чем с BytesIO (зависит от версии)
-                        with tempfile.NamedTemporaryFile(prefix="sig_", suffix=".png", delete=False) as tmp:
-                            tmp.write(raw)
-                            temp_paths.append(tmp.name)
-
-                        img = XLImage(temp_paths[-1])
-                        img.width = 120
-                        img.height = 32
-                        col_width = ws.column_dimensions["F"].width or 8.43
-                        row_height = ws.row_dimensions[rnum].height or 15
-                        cell_width_px = int(col_width * 7 + 5)
-                        cell_height_px = points_to_pixels(row_height)
-                        x_off = max((cell_width_px - img.width) / 2, 0)
-                        y_off = max((cell_height_px - img.height) / 2, 0)
-                        marker = AnchorMarker(
-                            col=5,
-                            colOff=pixels_to_EMU(int(x_off)),
-                            row=rnum - 1,
-                            rowOff=pixels_to_EMU(int(y_off)),
-                        )
-                        size = XDRPositiveSize2D(
-                            cx=pixels_to_EMU(img.width),
-                            cy=pixels_to_EMU(img.height),
-                        )
-                        img.anchor = OneCellAnchor(_from=marker, ext=size)
-                        ws.add_image(img)  # встраивает подпись в XLSX
-                    except Exception:
-                        # если по какой-то причине вставка изображения не удалась — хотя бы покажем статус
-                        sig_cell.value = str(signature_value or "SIGNED")
-
-                else:
-                    sig_cell.value = str(signature_value)
-            else:
-                # нет файла подписи (например, ещё не подписано/отказ) — показываем статус текстом
-                sig_cell.value = str(signature_value)
-
-            rnum += 1
-
-    if account:
-        acc = account.strip().lower()
-        if acc not in m.ACCOUNTS:
-            raise HTTPException(status_code=400, detail="Invalid account")
-        make_sheet(acc, acc.upper())
-    else:
-        make_sheet("main", "MAIN")
-        make_sheet("praise", "PRAISE")
-        make_sheet("alpha", "ALPHA")
-
-    bio = io.BytesIO()
-    wb.save(bio)
-    for tmp_path in temp_paths:
-        try:
-            os.unlink(tmp_path)
-        except Exception:
-            pass
-    data = bio.getvalue()
+                    img = XLImage(io.BytesIO(raw))
+                    img.width, img.height = thumb_w, thumb_h
+                    marker = AnchorMarker(
+                        col=5,
+                        colOff=pixels_to_EMU(int(x_off)),
+                        row=rnum - 1,
+                        rowOff=pixels_to_EMU(int(y_off)),
+                    )
+                    size = XDRPositiveSize2D(cx=pixels_to_EMU(thumb_w), cy=pixels_to_EMU(thumb_h))
+                    img.anchor = OneCellAnchor(_from=marker, ext=size)
+                    ws.add_image(img)  # встраивает подпись в XLSX
+                    sig_text = ""  # чтобы в ячейке не было текста
+                except Exception:
+                    # если по какой-то причине вставка изображения не удалась — хотя бы покажем статус
+                    sig_text = signature_value or "SIGNED"
+
+            ws.row_dimensions[rnum].height = row_height
+            ws.append([
+                styled(ws, date_value, center, "DD.MM.YYYY"),
+                styled(ws, op_disp, left),
+                # --- СУММА: всегда .00 ---
+                styled(ws, float(r.get("amount") or 0), center, "#,##0.00"),
+                # --- ФИО / ТИП ---
+                styled(ws, r.get("fio"), left),
+                styled(ws, r.get("user_type"), center),
+                styled(ws, sig_text, center),
+            ])
+
+    out = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    try:
+        wb.save(out)
+    except Exception:
+        out.close()
+        raise
+    size_bytes = out.tell()
 
     filename = "withdraw_act.xlsx"
     headers = {
         "Content-Disposition": f'attachment; filename="{filename}"',
-        "Content-Length": str(len(data)),
+        "Content-Length": str(size_bytes),
     }
-    return Response(
-        content=data,
+    return StreamingResponse(
+        _app_iter_spooled_file()(out),
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         headers=headers,
     )
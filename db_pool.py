@@ -0,0 +1,253 @@
+"""db_pool.py
+
+Общий пул соединений SQLite для app.py и cashflow_*.
+
+Дизайн:
+- Одно соединение на (поток, путь к БД): FastAPI threadpool, event loop и
+  фоновые потоки переиспользуют своё соединение вместо sqlite3.connect на
+  каждый запрос.
+- При открытии соединение переводится в WAL (читатели не блокируются
+  писателем), synchronous=NORMAL, увеличенный cache_size и mmap_size.
+- unit_of_work() — единица работы: вложенные блоки используют одну
+  транзакцию, commit/rollback делает только самый внешний блок.
+- in_unit_of_work() — есть ли у потока открытая единица работы (db_writer
+  пишет такие строки сразу в её транзакцию, а не в очередь).
+- open_reader() — отдельное read-only соединение для потоковых выгрузок
+  (контекстный менеджер: close_all/exclusive ждут открытых читателей).
+- close_all() закрывает все соединения: свободные сразу, а занятые
+  незавершённой единицей работы — когда она закончится (close_all ждёт);
+  потоки откроют новые при следующем обращении. exclusive() вдобавок не
+  даёт открывать новые единицы работы до конца блока — под ним restore
+  подменяет файл БД, и никто не успевает переоткрыть старый файл.
+
+Интеграция:
+- app.db_connect() и cashflow_models.db_connect() возвращают unit_of_work().
+- cashflow_routes получает app.db_connect через ленивый импорт.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+
+SQLITE_CACHE_SIZE_KIB = int(os.getenv("SQLITE_CACHE_SIZE_KIB", "20000") or 20000)
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)) or 0)
+SQLITE_BUSY_TIMEOUT_SEC = 5.0
+CLOSE_ALL_TIMEOUT_SEC = 30.0
+
+PathLike = Union[str, "os.PathLike[str]"]
+
+
+class _Slot:
+    __slots__ = ("conn", "generation", "depth", "closed")
+
+    def __init__(self, conn: sqlite3.Connection, generation: int) -> None:
+        self.conn = conn
+        self.generation = generation
+        self.depth = 0
+        self.closed = False
+
+
+_LOCAL = threading.local()
+_LOCK = threading.Lock()
+# ждут: close_all — завершения занятых единиц работы, новые единицы работы —
+# конца exclusive()
+_IDLE = threading.Condition(_LOCK)
+_GENERATION = 0
+_EXCLUSIVE_OWNER: Optional[threading.Thread] = None
+# открытые open_reader(): в реестр не входят, но close_all ждёт и их
+_READERS = 0
+# Все открытые соединения: нужны, чтобы закрыть их при restore и
+# подчистить соединения завершившихся потоков.
+_REGISTRY: List[Tuple[threading.Thread, _Slot]] = []
+
+
+def _open(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT_SEC)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute(f"PRAGMA cache_size=-{int(SQLITE_CACHE_SIZE_KIB)};")
+    conn.execute(f"PRAGMA mmap_size={int(SQLITE_MMAP_SIZE)};")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA foreign_keys=ON;")
+    return conn
+
+
+def _close_slot(slot: _Slot) -> None:
+    slot.closed = True
+    try:
+        slot.conn.close()
+    except Exception:
+        pass
+
+
+def _register(slot: _Slot) -> None:
+    me = threading.current_thread()
+    with _LOCK:
+        stale = [s for t, s in _REGISTRY if not t.is_alive()]
+        _REGISTRY[:] = [(t, s) for t, s in _REGISTRY if t.is_alive() and not s.closed]
+        _REGISTRY.append((me, slot))
+    for s in stale:
+        _close_slot(s)
+
+
+def _acquire(db_path: PathLike) -> _Slot:
+    key = os.fspath(db_path)
+    slots: Dict[str, _Slot] = getattr(_LOCAL, "slots", None)
+    if slots is None:
+        slots = {}
+        _LOCAL.slots = slots
+
+    slot = slots.get(key)
+    if slot is not None and slot.depth > 0:
+        # Вложенный блок: та же транзакция, соединение не меняем.
+        slot.depth += 1
+        return slot
+
+    me = threading.current_thread()
+    while True:
+        with _IDLE:
+            while _EXCLUSIVE_OWNER is not None and _EXCLUSIVE_OWNER is not me:
+                _IDLE.wait()
+            if slot is not None and not slot.closed and slot.generation == _GENERATION:
+                # depth меняем под _LOCK: close_all решает по нему, закрывать
+                # соединение сразу или ждать конца единицы работы
+                slot.depth = 1
+                return slot
+            generation = _GENERATION
+        if slot is not None:
+            _close_slot(slot)
+        # открываем вне блокировки; если за это время был close_all,
+        # следующий круг цикла откроет соединение заново
+        slot = _Slot(_open(key), generation)
+        slots[key] = slot
+        _register(slot)
+
+
+def _release(slot: _Slot, ok: bool) -> None:
+    if slot.depth > 1:
+        slot.depth -= 1
+        return
+    try:
+        if not slot.closed and slot.conn.in_transaction:
+            if ok:
+                slot.conn.commit()
+            else:
+                slot.conn.rollback()
+    finally:
+        with _IDLE:
+            slot.depth = 0
+            if slot.generation != _GENERATION:
+                # close_all ждёт это соединение
+                _close_slot(slot)
+                _IDLE.notify_all()
+
+
+@contextlib.contextmanager
+def unit_of_work(db_path: PathLike) -> Iterator[sqlite3.Connection]:
+    """Транзакция на соединении потока; вложенные блоки её разделяют."""
+    slot = _acquire(db_path)
+    try:
+        yield slot.conn
+    except BaseException:
+        _release(slot, ok=False)
+        raise
+    else:
+        _release(slot, ok=True)
+
+
+def in_unit_of_work(db_path: PathLike) -> bool:
+    """True, если текущий поток внутри unit_of_work() для db_path."""
+    slots: Optional[Dict[str, _Slot]] = getattr(_LOCAL, "slots", None)
+    slot = slots.get(os.fspath(db_path)) if slots else None
+    return bool(slot is not None and slot.depth > 0 and not slot.closed)
+
+
+@contextlib.contextmanager
+def open_reader(db_path: PathLike) -> Iterator[sqlite3.Connection]:
+    """
+    Отдельное (не пуловое) соединение только для чтения — для долгих
+    потоковых выгрузок: курсор может жить между потоками threadpool и не
+    мешает единицам работы пула. Закрывается на выходе из блока; пока
+    блок открыт, close_all() его ждёт (читатель держит -wal/-shm файла).
+    """
+    global _READERS
+    me = threading.current_thread()
+    with _IDLE:
+        while _EXCLUSIVE_OWNER is not None and _EXCLUSIVE_OWNER is not me:
+            _IDLE.wait()
+        _READERS += 1
+    try:
+        conn = _open(os.fspath(db_path))
+        try:
+            conn.execute("PRAGMA query_only=ON;")
+            yield conn
+        finally:
+            conn.close()
+    finally:
+        with _IDLE:
+            _READERS -= 1
+            _IDLE.notify_all()
+
+
+def checkpoint(db_path: PathLike) -> None:
+    """Переносит WAL в основной файл (перед копированием БД)."""
+    with unit_of_work(db_path) as conn:
+        if conn.in_transaction:
+            return
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+
+
+def close_all(timeout: float = CLOSE_ALL_TIMEOUT_SEC) -> None:
+    """
+    Закрывает все соединения пула; потоки переоткроют их при обращении.
+    Соединения внутри незавершённой единицы работы закрываются, когда она
+    закончится (commit/rollback на старом файле), — close_all ждёт их и
+    открытые open_reader() до timeout и иначе бросает RuntimeError. Единицы работы самого вызывающего
+    потока не ждём: они закроются при выходе из них.
+    """
+    global _GENERATION
+    me = threading.current_thread()
+    deadline = time.monotonic() + timeout
+    with _IDLE:
+        _GENERATION += 1
+        slots = list(_REGISTRY)
+        _REGISTRY.clear()
+        busy: List[_Slot] = []
+        for owner, slot in slots:
+            if slot.depth == 0:
+                _close_slot(slot)
+            elif owner is not me and owner.is_alive():
+                busy.append(slot)
+        while _READERS or any(not s.closed for s in busy):
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise RuntimeError("db_pool.close_all: units of work or readers did not finish in time")
+            _IDLE.wait(left)
+
+
+@contextlib.contextmanager
+def exclusive(timeout: float = CLOSE_ALL_TIMEOUT_SEC) -> Iterator[None]:
+    """
+    Закрыть все соединения и до конца блока не пускать другие потоки в
+    unit_of_work() (они ждут). Для замены файла БД при restore.
+    """
+    global _EXCLUSIVE_OWNER
+    me = threading.current_thread()
+    with _IDLE:
+        while _EXCLUSIVE_OWNER is not None:
+            _IDLE.wait()
+        _EXCLUSIVE_OWNER = me
+    try:
+        close_all(timeout)
+        yield
+    finally:
+        with _IDLE:
+            _EXCLUSIVE_OWNER = None
+            _IDLE.notify_all()
@@ -0,0 +1,242 @@
+"""db_writer.py
+
+Фоновый писатель append-only строк (аудит, system_logs, job_runs,
+message_deliveries) с групповым коммитом.
+
+Дизайн:
+- submit() кладёт (sql, params) в ограниченную очередь и сразу возвращается:
+  запросы, хендлеры бота и задачи в event loop не ждут INSERT + commit.
+- Один поток-писатель забирает строки пачкой — до DB_WRITER_BATCH_ROWS строк
+  или DB_WRITER_FLUSH_MS мс с первой — и пишет их executemany (по одному на
+  SQL) в одной транзакции: один commit на пачку вместо commit на строку.
+- Если вызывающий уже внутри unit_of_work() — строка пишется сразу в его
+  транзакцию (аудит остаётся атомарным с изменением и откатывается с ним).
+- Писатель не запущен (скрипты, тесты) или очередь полна — синхронная запись,
+  как раньше; строки не теряются.
+- stop() дописывает очередь и останавливает поток (shutdown; restore
+  останавливает писатель на время замены файла БД и запускает снова);
+  flush() ждёт, пока очередь опустеет.
+- Строки, которые не удалось записать, считаются в stats (errors) и
+  сводкой уходят в on_error не чаще раза в DB_WRITER_REPORT_SEC: сама
+  сводка тоже пишется через очередь и при сбое не должна зацикливаться.
+
+Интеграция:
+- app.lifespan: db_writer.start(CFG.DB_PATH, on_error=...); в finally — db_writer.stop().
+- app.log_audit*, log_system_log, log_job_run, log_message_deliver*.
+"""
+
+from __future__ import annotations
+
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import db_pool
+
+
+DB_WRITER_BATCH_ROWS = int(os.getenv("DB_WRITER_BATCH_ROWS", "200") or 200)
+DB_WRITER_FLUSH_MS = int(os.getenv("DB_WRITER_FLUSH_MS", "50") or 50)
+DB_WRITER_QUEUE_MAX = int(os.getenv("DB_WRITER_QUEUE_MAX", "10000") or 10000)
+DB_WRITER_REPORT_SEC = 60.0
+
+Row = Tuple[str, Sequence[Any]]
+
+_STOP = object()
+_QUEUE: "queue.Queue[Any]" = queue.Queue(maxsize=DB_WRITER_QUEUE_MAX)
+_DB_PATH: Optional[str] = None
+_THREAD: Optional[threading.Thread] = None
+_LOCK = threading.Lock()
+_STATS: Dict[str, int] = {
+    "queued": 0, "written": 0, "batches": 0, "inline": 0, "overflow": 0, "retried_batches": 0, "errors": 0,
+}
+# (message, details) — app пишет в system_logs
+ErrorCallback = Callable[[str, Dict[str, Any]], None]
+_ON_ERROR: Optional[ErrorCallback] = None
+_UNREPORTED = 0
+_LAST_ERROR = ""
+_NEXT_REPORT = 0.0
+
+
+def _bump(name: str, n: int = 1) -> None:
+    with _LOCK:
+        _STATS[name] += n
+
+
+def _write_now(db_path: str, rows: List[Row]) -> None:
+    # порядок строк сохраняем, соседние строки с одним SQL — одним executemany
+    with db_pool.unit_of_work(db_path) as conn:
+        i = 0
+        while i < len(rows):
+            sql = rows[i][0]
+            j = i
+            while j < len(rows) and rows[j][0] == sql:
+                j += 1
+            conn.executemany(sql, [params for _, params in rows[i:j]])
+            i = j
+
+
+def submit_many(db_path: Any, sql: str, params_list: Sequence[Sequence[Any]]) -> None:
+    """Поставить строки на запись; не блокирует (кроме переполнения очереди)."""
+    if not params_list:
+        return
+    path = os.fspath(db_path)
+    rows: List[Row] = [(sql, tuple(p)) for p in params_list]
+    thread = _THREAD
+    if (
+        thread is None
+        or not thread.is_alive()
+        or path != _DB_PATH
+        or db_pool.in_unit_of_work(path)
+    ):
+        _write_now(path, rows)
+        _bump("inline", len(rows))
+        return
+    try:
+        _QUEUE.put_nowait(rows)
+    except queue.Full:
+        # писатель не успевает — пишем сами (естественное торможение источника)
+        _write_now(path, rows)
+        _bump("overflow", len(rows))
+        return
+    _bump("queued", len(rows))
+
+
+def submit(db_path: Any, sql: str, params: Sequence[Any]) -> None:
+    submit_many(db_path, sql, [params])
+
+
+def _commit_batch(rows: List[Row]) -> None:
+    assert _DB_PATH is not None
+    written = len(rows)
+    try:
+        _write_now(_DB_PATH, rows)
+    except Exception:
+        _bump("retried_batches")
+        written = 0
+        for row in rows:
+            try:
+                _write_now(_DB_PATH, [row])
+            except Exception as row_exc:
+                _dropped(row_exc)
+            else:
+                written += 1
+    _bump("written", written)
+    _bump("batches")
+    _report()
+
+
+def _dropped(exc: BaseException) -> None:
+    global _UNREPORTED, _LAST_ERROR
+    with _LOCK:
+        _STATS["errors"] += 1
+        _UNREPORTED += 1
+        _LAST_ERROR = str(exc)
+
+
+def _report() -> None:
+    global _UNREPORTED, _NEXT_REPORT
+    with _LOCK:
+        now = time.monotonic()
+        if not _UNREPORTED or _ON_ERROR is None or now < _NEXT_REPORT:
+            return
+        dropped, last_error = _UNREPORTED, _LAST_ERROR
+        _UNREPORTED = 0
+        _NEXT_REPORT = now + DB_WRITER_REPORT_SEC
+    try:
+        _ON_ERROR(
+            f"db_writer: не записано строк: {dropped}",
+            {"dropped": dropped, "last_error": last_error},
+        )
+    except Exception:
+        pass
+
+
+def _run() -> None:
+    stopping = False
+    while not stopping:
+        item = _QUEUE.get()
+        if item is _STOP:
+            _QUEUE.task_done()
+            break
+        batch: List[Row] = list(item)
+        taken = 1
+        deadline = time.monotonic() + DB_WRITER_FLUSH_MS / 1000.0
+        while len(batch) < DB_WRITER_BATCH_ROWS:
+            timeout = deadline - time.monotonic()
+            try:
+                item = _QUEUE.get(timeout=timeout) if timeout > 0 else _QUEUE.get_nowait()
+            except queue.Empty:
+                break
+            taken += 1
+            if item is _STOP:
+                stopping = True
+                break
+            batch.extend(item)
+        _commit_batch(batch)
+        for _ in range(taken):
+            _QUEUE.task_done()
+
+
+def start(db_path: Any, on_error: Optional[ErrorCallback] = None) -> None:
+    global _THREAD, _DB_PATH, _ON_ERROR
+    if on_error is not None:
+        _ON_ERROR = on_error
+    if _THREAD is not None and _THREAD.is_alive():
+        return
+    _DB_PATH = os.fspath(db_path)
+    _THREAD = threading.Thread(target=_run, name="db-writer", daemon=True)
+    _THREAD.start()
+
+
+def is_running() -> bool:
+    return _THREAD is not None and _THREAD.is_alive()
+
+
+def flush() -> None:
+    """Дождаться записи всего, что уже в очереди."""
+    if _THREAD is not None and _THREAD.is_alive():
+        _QUEUE.join()
+
+
+def stop(timeout: float = 10.0) -> None:
+    """
+    Дописать очередь и остановить поток (shutdown приложения, restore).
+    Если поток не успел за timeout, он остаётся текущим (второй start() его
+    не продублирует), а stop() бросает RuntimeError.
+    """
+    global _THREAD
+    thread = _THREAD
+    if thread is None:
+        return
+    if thread.is_alive():
+        _QUEUE.put(_STOP)
+        thread.join(timeout)
+        if thread.is_alive():
+            raise RuntimeError(f"db_writer did not stop in {timeout} s, pending rows: {_QUEUE.qsize()}")
+    _THREAD = None
+    # то, что успели поставить после _STOP, дописываем здесь
+    rest: List[Row] = []
+    while True:
+        try:
+            item = _QUEUE.get_nowait()
+        except queue.Empty:
+            break
+        if item is not _STOP:
+            rest.extend(item)
+        _QUEUE.task_done()
+    if rest and _DB_PATH is not None:
+        _commit_batch(rest)
+
+
+def writer_stats() -> Dict[str, Any]:
+    with _LOCK:
+        stats: Dict[str, Any] = dict(_STATS)
+    stats.update({
+        "running": is_running(),
+        "pending": _QUEUE.qsize(),
+        "batch_rows": DB_WRITER_BATCH_ROWS,
+        "flush_ms": DB_WRITER_FLUSH_MS,
+    })
+    return stats
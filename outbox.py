@@ -0,0 +1,378 @@
+"""outbox.py
+
+Надёжная очередь исходящих сообщений бота (таблица outbox в той же SQLite).
+
+Дизайн:
+- enqueue() пишет сообщение в outbox в рамках обычной единицы работы
+  db_pool — уведомление не теряется при рестарте процесса.
+- dedupe_key (UNIQUE): повторная постановка того же уведомления игнорируется.
+- priority: больше — раньше (подписи наличных впереди отчётов).
+- Один async-воркер (run_worker) забирает пачку готовых сообщений, шлёт их
+  через tg_delivery (лимиты Telegram, 429) и фиксирует результат:
+  временные ошибки — повтор с экспоненциальной задержкой,
+  постоянные (бот заблокирован, чат не найден) и исчерпанные попытки — failed.
+- Забранные сообщения (sending) держатся в аренде OUTBOX_LEASE_SEC: если
+  результат не записан (сбой после _claim_batch), по истечении аренды они
+  снова pending — как после рестарта, доставка «хотя бы раз».
+- Ошибки воркера и записи доставок уходят в колбэк on_error (app пишет их
+  в system_logs) и считаются в stats.
+- Итоговые доставки отдаются колбэку on_delivered (app пишет message_deliveries).
+
+Интеграция:
+- app.lifespan: outbox.configure(...); outbox.start_worker(); при выходе stop_worker().
+- app.send_report_to_recipients (плановые отчёты), cashflow_bot.notify_*.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+
+import db_pool
+import tg_delivery
+
+
+PRIORITY_CASH = 100
+PRIORITY_NOTIFY = 50
+PRIORITY_REPORT = 10
+
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "20") or 20)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8") or 8)
+OUTBOX_BACKOFF_BASE_SEC = 5.0
+OUTBOX_BACKOFF_MAX_SEC = 3600.0
+OUTBOX_POLL_SEC = 5.0
+OUTBOX_LEASE_SEC = float(os.getenv("OUTBOX_LEASE_SEC", "300") or 300)
+
+# (kind, chat_id, status 'success'|'fail', error)
+DeliveredCallback = Callable[[List[Tuple[str, int, str, Optional[str]]]], None]
+# (message, details)
+ErrorCallback = Callable[[str, Dict[str, Any]], None]
+
+_DB_PATH: Optional[str] = None
+_GET_BOT: Optional[Callable[[], Any]] = None
+_ON_DELIVERED: Optional[DeliveredCallback] = None
+_FORMAT_ERROR: Callable[[BaseException], str] = lambda exc: str(exc)
+_ON_ERROR: Optional[ErrorCallback] = None
+
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_WAKE: Optional[asyncio.Event] = None
+_WORKER: Optional["asyncio.Task[None]"] = None
+_STATS_LOCK = threading.Lock()
+_STATS: Dict[str, int] = {
+    "enqueued": 0, "deduped": 0, "sent": 0, "retried": 0, "failed": 0,
+    "reclaimed": 0, "worker_errors": 0, "delivery_log_errors": 0,
+}
+
+
+def init_outbox_db(conn: sqlite3.Connection) -> None:
+    """Создаёт таблицу outbox, если её нет."""
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            dedupe_key TEXT NULL UNIQUE,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            sent_at REAL NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_outbox_due
+            ON outbox(status, priority DESC, next_attempt_at, id);
+        CREATE INDEX IF NOT EXISTS idx_outbox_kind_status
+            ON outbox(kind, status);
+        """
+    )
+
+
+def configure(
+    db_path: Any,
+    get_bot: Callable[[], Any],
+    on_delivered: Optional[DeliveredCallback] = None,
+    format_error: Optional[Callable[[BaseException], str]] = None,
+    on_error: Optional[ErrorCallback] = None,
+) -> None:
+    global _DB_PATH, _GET_BOT, _ON_DELIVERED, _FORMAT_ERROR, _ON_ERROR
+    _DB_PATH = os.fspath(db_path)
+    _GET_BOT = get_bot
+    _ON_DELIVERED = on_delivered
+    if format_error is not None:
+        _FORMAT_ERROR = format_error
+    _ON_ERROR = on_error
+
+
+def _db_path() -> str:
+    if _DB_PATH is None:
+        raise RuntimeError("Outbox is not configured. Call outbox.configure(...) from app.py")
+    return _DB_PATH
+
+
+def _bump(name: str, n: int = 1) -> None:
+    with _STATS_LOCK:
+        _STATS[name] += n
+
+
+def _report(stat: str, message: str, exc: BaseException) -> None:
+    _bump(stat)
+    if _ON_ERROR is None:
+        return
+    try:
+        _ON_ERROR(message, {"error": _FORMAT_ERROR(exc)})
+    except Exception:
+        pass
+
+
+def _wake() -> None:
+    loop, wake = _LOOP, _WAKE
+    if loop is None or wake is None or loop.is_closed():
+        return
+    try:
+        loop.call_soon_threadsafe(wake.set)
+    except RuntimeError:
+        pass
+
+
+def enqueue(
+    kind: str,
+    chat_id: int,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+    *,
+    priority: int = PRIORITY_NOTIFY,
+    dedupe_key: Optional[str] = None,
+) -> Optional[int]:
+    """Ставит сообщение в очередь. Возвращает id или None, если dedupe_key уже был."""
+    return enqueue_many(
+        [(kind, chat_id, text, reply_markup, dedupe_key)],
+        priority=priority,
+    )[0]
+
+
+def enqueue_many(
+    items: Iterable[Tuple[str, int, str, Optional[InlineKeyboardMarkup], Optional[str]]],
+    *,
+    priority: int = PRIORITY_NOTIFY,
+) -> List[Optional[int]]:
+    """Пакетная постановка (kind, chat_id, text, reply_markup, dedupe_key) одной транзакцией."""
+    now = time.time()
+    ids: List[Optional[int]] = []
+    with db_pool.unit_of_work(_db_path()) as conn:
+        for kind, chat_id, text, reply_markup, dedupe_key in items:
+            payload = json.dumps(
+                {
+                    "text": text,
+                    "reply_markup": reply_markup.model_dump(mode="json", exclude_none=True) if reply_markup else None,
+                },
+                ensure_ascii=False,
+            )
+            cur = conn.execute(
+                """
+                INSERT INTO outbox (kind, chat_id, payload, priority, dedupe_key, status, attempts,
+                                    next_attempt_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, 'pending', 0, ?, ?, ?)
+                ON CONFLICT(dedupe_key) DO NOTHING;
+                """,
+                (str(kind), int(chat_id), payload, int(priority), dedupe_key, now, now, now),
+            )
+            if cur.rowcount:
+                ids.append(int(cur.lastrowid))
+            else:
+                ids.append(None)
+    _bump("enqueued", sum(1 for i in ids if i is not None))
+    _bump("deduped", sum(1 for i in ids if i is None))
+    _wake()
+    return ids
+
+
+def _claim_batch() -> Tuple[List[sqlite3.Row], Optional[float]]:
+    """Забирает готовые сообщения (status -> sending). Второе значение — когда следующее."""
+    now = time.time()
+    with db_pool.unit_of_work(_db_path()) as conn:
+        conn.execute("BEGIN IMMEDIATE;")
+        # аренда истекла — результат так и не записали, отправляем снова
+        reclaimed = conn.execute(
+            "UPDATE outbox SET status='pending', updated_at=? WHERE status='sending' AND updated_at <= ?;",
+            (now, now - OUTBOX_LEASE_SEC),
+        ).rowcount
+        if reclaimed:
+            _bump("reclaimed", reclaimed)
+        rows = conn.execute(
+            """
+            SELECT * FROM outbox
+            WHERE status='pending' AND next_attempt_at <= ?
+            ORDER BY priority DESC, next_attempt_at ASC, id ASC
+            LIMIT ?;
+            """,
+            (now, OUTBOX_BATCH),
+        ).fetchall()
+        if rows:
+            conn.executemany(
+                "UPDATE outbox SET status='sending', updated_at=? WHERE id=?;",
+                [(now, int(r["id"])) for r in rows],
+            )
+            return rows, None
+        nxt = conn.execute("SELECT MIN(next_attempt_at) AS t FROM outbox WHERE status='pending';").fetchone()
+    return [], (float(nxt["t"]) if nxt and nxt["t"] is not None else None)
+
+
+def _is_permanent(exc: BaseException) -> bool:
+    return isinstance(exc, (TelegramForbiddenError, TelegramBadRequest))
+
+
+def _backoff(attempts: int, exc: BaseException) -> float:
+    if isinstance(exc, TelegramRetryAfter):
+        return float(exc.retry_after or 1)
+    delay = min(OUTBOX_BACKOFF_BASE_SEC * (2 ** max(0, attempts - 1)), OUTBOX_BACKOFF_MAX_SEC)
+    return delay * random.uniform(0.8, 1.2)
+
+
+async def _send(row: sqlite3.Row) -> Optional[BaseException]:
+    bot = _GET_BOT() if _GET_BOT else None
+    if bot is None:
+        return RuntimeError("Bot is not initialized")
+    payload = json.loads(row["payload"])
+    markup = payload.get("reply_markup")
+    reply_markup = InlineKeyboardMarkup.model_validate(markup) if markup else None
+    chat_id = int(row["chat_id"])
+    try:
+        await tg_delivery.send_with_limits(
+            chat_id,
+            lambda: bot.send_message(chat_id=chat_id, text=payload["text"], reply_markup=reply_markup),
+        )
+    except Exception as exc:
+        return exc
+    return None
+
+
+def _record(rows: List[sqlite3.Row], errors: List[Optional[BaseException]]) -> None:
+    now = time.time()
+    updates: List[Tuple[Any, ...]] = []
+    delivered: List[Tuple[str, int, str, Optional[str]]] = []
+    for row, exc in zip(rows, errors):
+        attempts = int(row["attempts"]) + 1
+        if exc is None:
+            updates.append(("sent", attempts, row["next_attempt_at"], None, now, now, int(row["id"])))
+            delivered.append((str(row["kind"]), int(row["chat_id"]), "success", None))
+            _bump("sent")
+            continue
+        msg = _FORMAT_ERROR(exc)
+        if _is_permanent(exc) or attempts >= OUTBOX_MAX_ATTEMPTS:
+            updates.append(("failed", attempts, row["next_attempt_at"], msg, None, now, int(row["id"])))
+            delivered.append((str(row["kind"]), int(row["chat_id"]), "fail", msg))
+            _bump("failed")
+        else:
+            updates.append(("pending", attempts, now + _backoff(attempts, exc), msg, None, now, int(row["id"])))
+            _bump("retried")
+    with db_pool.unit_of_work(_db_path()) as conn:
+        conn.executemany(
+            """
+            UPDATE outbox
+            SET status=?, attempts=?, next_attempt_at=?, last_error=?, sent_at=?, updated_at=?
+            WHERE id=?;
+            """,
+            updates,
+        )
+    if delivered and _ON_DELIVERED is not None:
+        try:
+            _ON_DELIVERED(delivered)
+        except Exception as exc:
+            _report("delivery_log_errors", "Outbox: не удалось записать message_deliveries", exc)
+
+
+def _recover_inflight() -> None:
+    # после рестарта "sending" значит "не знаем, ушло ли" — отправляем ещё раз
+    with db_pool.unit_of_work(_db_path()) as conn:
+        conn.execute("UPDATE outbox SET status='pending' WHERE status='sending';")
+
+
+async def run_worker() -> None:
+    """Единственный воркер очереди; работает до отмены задачи."""
+    global _LOOP, _WAKE
+    _LOOP = asyncio.get_running_loop()
+    _WAKE = asyncio.Event()
+    await asyncio.to_thread(_recover_inflight)
+    while True:
+        try:
+            rows, next_at = await asyncio.to_thread(_claim_batch)
+            if rows:
+                errors = await asyncio.gather(*(_send(r) for r in rows))
+                await asyncio.to_thread(_record, rows, list(errors))
+                continue
+            timeout = OUTBOX_POLL_SEC
+            if next_at is not None:
+                timeout = min(timeout, max(0.05, next_at - time.time()))
+            _WAKE.clear()
+            try:
+                await asyncio.wait_for(_WAKE.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            await asyncio.to_thread(_report, "worker_errors", "Outbox worker error", exc)
+            await asyncio.sleep(OUTBOX_POLL_SEC)
+
+
+def start_worker() -> "asyncio.Task[None]":
+    global _WORKER
+    if _WORKER is None or _WORKER.done():
+        _WORKER = asyncio.create_task(run_worker())
+    return _WORKER
+
+
+async def stop_worker() -> None:
+    global _WORKER, _LOOP, _WAKE
+    task, _WORKER = _WORKER, None
+    _LOOP, _WAKE = None, None
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, Exception):
+        pass
+
+
+def is_worker_running() -> bool:
+    return _WORKER is not None and not _WORKER.done()
+
+
+def outbox_stats() -> Dict[str, Any]:
+    with _STATS_LOCK:
+        stats: Dict[str, Any] = dict(_STATS)
+    stats["worker_running"] = is_worker_running()
+    if _DB_PATH is None:
+        return stats
+    now = time.time()
+    with db_pool.unit_of_work(_DB_PATH) as conn:
+        by_status = {
+            str(r["status"]): int(r["c"])
+            for r in conn.execute("SELECT status, COUNT(*) AS c FROM outbox GROUP BY status;")
+        }
+        pending_by_kind = {
+            str(r["kind"]): int(r["c"])
+            for r in conn.execute("SELECT kind, COUNT(*) AS c FROM outbox WHERE status IN ('pending','sending') GROUP BY kind;")
+        }
+        oldest = conn.execute("SELECT MIN(created_at) AS t FROM outbox WHERE status IN ('pending','sending');").fetchone()
+    stats.update({
+        "by_status": by_status,
+        "pending_by_kind": pending_by_kind,
+        "oldest_pending_age_sec": round(now - float(oldest["t"]), 1) if oldest and oldest["t"] is not None else None,
+    })
+    return stats
@@ -0,0 +1,78 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import db_pool
+
+
+def _init(path: str) -> None:
+    with db_pool.unit_of_work(path) as conn:
+        conn.execute("CREATE TABLE t (v INTEGER);")
+
+
+def _count(path: str) -> int:
+    with db_pool.unit_of_work(path) as conn:
+        return int(conn.execute("SELECT COUNT(*) FROM t;").fetchone()[0])
+
+
+def test_close_all_waits_for_open_unit_of_work(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+    _init(path)
+    inside = threading.Event()
+    release = threading.Event()
+
+    def writer():
+        with db_pool.unit_of_work(path) as conn:
+            conn.execute("INSERT INTO t (v) VALUES (1);")
+            inside.set()
+            release.wait(5)
+            conn.execute("INSERT INTO t (v) VALUES (2);")
+
+    t = threading.Thread(target=writer)
+    t.start()
+    assert inside.wait(5)
+    closer = threading.Thread(target=db_pool.close_all)
+    closer.start()
+    time.sleep(0.1)
+    # пока единица работы открыта, close_all её не рвёт
+    assert closer.is_alive()
+    release.set()
+    closer.join(5)
+    t.join(5)
+    assert not closer.is_alive()
+    assert _count(path) == 2
+
+
+def test_exclusive_blocks_new_units_of_work(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+    _init(path)
+    entered = threading.Event()
+
+    def writer():
+        with db_pool.unit_of_work(path) as conn:
+            conn.execute("INSERT INTO t (v) VALUES (1);")
+        entered.set()
+
+    with db_pool.exclusive():
+        t = threading.Thread(target=writer)
+        t.start()
+        assert not entered.wait(0.2)
+    t.join(5)
+    assert entered.is_set()
+    assert _count(path) == 1
+
+
+def test_close_all_waits_for_open_reader(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+    _init(path)
+    with db_pool.open_reader(path) as conn:
+        conn.execute("BEGIN;")
+        conn.execute("SELECT COUNT(*) FROM t;").fetchone()
+        with pytest.raises(RuntimeError):
+            db_pool.close_all(timeout=0.1)
+    db_pool.close_all(timeout=1)
@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import db_pool
+import db_writer
+
+
+def test_dropped_rows_are_counted_and_reported(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+    with db_pool.unit_of_work(path) as conn:
+        conn.execute("CREATE TABLE t (v INTEGER NOT NULL);")
+    reports = []
+    before = db_writer.writer_stats()
+    db_writer.start(path, on_error=lambda message, details: reports.append(details))
+    try:
+        db_writer.submit_many(path, "INSERT INTO t (v) VALUES (?);", [(1,), (None,), (3,)])
+        db_writer.flush()
+    finally:
+        db_writer.stop()
+    after = db_writer.writer_stats()
+    assert after["written"] - before["written"] == 2
+    assert after["errors"] - before["errors"] == 1
+    assert reports and reports[0]["dropped"] == 1
+    with db_pool.unit_of_work(path) as conn:
+        assert [r[0] for r in conn.execute("SELECT v FROM t ORDER BY v;")] == [1, 3]
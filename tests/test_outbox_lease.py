@@ -0,0 +1,46 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import db_pool
+import outbox
+
+
+def _configure(tmp_path, **kwargs):
+    path = str(tmp_path / "db.sqlite3")
+    with db_pool.unit_of_work(path) as conn:
+        outbox.init_outbox_db(conn)
+    outbox.configure(path, lambda: None, **kwargs)
+    return path
+
+
+def test_expired_claim_is_reclaimed(tmp_path, monkeypatch):
+    _configure(tmp_path)
+    outbox.enqueue("test", 1, "hello")
+    rows, _ = outbox._claim_batch()
+    assert len(rows) == 1
+    # аренда ещё действует — повторно не забираем
+    assert outbox._claim_batch()[0] == []
+    monkeypatch.setattr(outbox, "OUTBOX_LEASE_SEC", -1.0)
+    rows2, _ = outbox._claim_batch()
+    assert [int(r["id"]) for r in rows2] == [int(rows[0]["id"])]
+
+
+def test_delivery_log_failure_is_reported(tmp_path):
+    reports = []
+
+    def on_delivered(entries):
+        raise RuntimeError("disk full")
+
+    _configure(
+        tmp_path,
+        on_delivered=on_delivered,
+        on_error=lambda message, details: reports.append(details),
+    )
+    before = outbox.outbox_stats()["delivery_log_errors"]
+    outbox.enqueue("test", 1, "hello")
+    rows, _ = outbox._claim_batch()
+    outbox._record(rows, [None])
+    assert outbox.outbox_stats()["delivery_log_errors"] == before + 1
+    assert reports == [{"error": "disk full"}]
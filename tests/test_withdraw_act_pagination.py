@@ -0,0 +1,76 @@
+import sqlite3
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import cashflow_models as m
+
+
+def _conn() -> sqlite3.Connection:
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    m.init_cashflow_db(conn)
+    return conn
+
+
+def _add_request(conn: sqlite3.Connection, day: int, participants: int) -> int:
+    ts = f"2026-01-{day:02d}T10:00:00Z"
+    cur = conn.execute(
+        """
+        INSERT INTO cash_requests (account, op_type, amount, status, admin_telegram_id, created_at, updated_at)
+        VALUES ('main', 'withdraw', 100, 'PENDING_SIGNERS', 1, ?, ?);
+        """,
+        (ts, ts),
+    )
+    rid = int(cur.lastrowid)
+    for i in range(participants):
+        conn.execute(
+            """
+            INSERT INTO cash_request_participants (request_id, telegram_id, name_snapshot, role_snapshot, is_admin, created_at)
+            VALUES (?, ?, ?, 'cash_signer', 0, ?);
+            """,
+            (rid, 100 + i, f"Signer {i}", ts),
+        )
+    return rid
+
+
+def _all_pages(conn: sqlite3.Connection, limit: int):
+    ids, cursor, pages = [], None, 0
+    while True:
+        items, cursor = m.list_withdraw_act_page(conn, account="main", cursor=cursor, limit_requests=limit)
+        pages += 1
+        ids.extend(dict.fromkeys(r["request_id"] for r in items))
+        if cursor is None:
+            return ids, pages
+
+
+def test_request_without_participants_does_not_stop_pagination():
+    conn = _conn()
+    r1 = _add_request(conn, 1, 2)
+    r2 = _add_request(conn, 2, 1)
+    _add_request(conn, 3, 0)  # без участников — посередине диапазона
+    r4 = _add_request(conn, 4, 2)
+    r5 = _add_request(conn, 5, 1)
+
+    ids, pages = _all_pages(conn, limit=2)
+
+    assert ids == [r5, r4, r2, r1]
+    assert pages == 3
+
+
+def test_page_matches_full_listing():
+    conn = _conn()
+    for day in range(1, 8):
+        _add_request(conn, day, day % 3)
+
+    full = m.list_withdraw_act_rows(conn, account="main")
+    paged = []
+    cursor = None
+    while True:
+        items, cursor = m.list_withdraw_act_page(conn, account="main", cursor=cursor, limit_requests=3)
+        paged.extend(items)
+        if cursor is None:
+            break
+
+    assert paged == full
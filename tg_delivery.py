@@ -0,0 +1,180 @@
+"""tg_delivery.py
+
+Отправка сообщений Telegram с учётом лимитов Bot API.
+
+Дизайн:
+- Token bucket на весь бот (Telegram: ~30 сообщений/сек) и на каждый чат
+  (личный чат ~1/сек, группа ~20/мин). Ожидание — asyncio.sleep, без блокировок:
+  всё работает в одном event loop, поэтому резервирование токена атомарно.
+- 429 (TelegramRetryAfter): ждём retry_after, чат "замораживается" на это
+  время, попытка повторяется (не больше TG_RETRY_AFTER_ATTEMPTS раз). Если
+  retry_after больше интервала чата, это общий flood-лимит бота — тогда
+  замораживается и общий bucket, чтобы параллельные отправки не ловили 429.
+- Bucket замороженного чата из LRU не вытесняется, пока пауза не кончилась.
+- fan_out() — рассылка списку получателей с ограниченной параллельностью;
+  исключения не пробрасываются, а возвращаются в DeliveryResult по каждому
+  получателю (логирование доставок — одним пакетом у вызывающего).
+
+Интеграция:
+- app.send_report_to_recipients / send_report_png_to_recipients, bot_send_or_http_error.
+- outbox (воркер очереди уведомлений, в т.ч. cashflow_bot.notify_*).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, TypeVar
+
+from aiogram.exceptions import TelegramRetryAfter
+
+
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25") or 25)          # сообщений/сек на бота
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1") or 1)                # сообщений/сек в личный чат
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", str(20 / 60)) or 20 / 60)  # сообщений/сек в группу
+TG_FANOUT_CONCURRENCY = int(os.getenv("TG_FANOUT_CONCURRENCY", "8") or 8)
+TG_RETRY_AFTER_ATTEMPTS = 3
+TG_RETRY_AFTER_MAX_SEC = 120.0
+TG_CHAT_BUCKETS_MAX = 2048
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """Классический token bucket; acquire() ждёт, пока не появится токен."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = max(float(rate), 1e-6)
+        self.capacity = max(float(capacity), 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _reserve(self) -> float:
+        """Забирает токен (возможно, в долг) и возвращает, сколько секунд ждать."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1.0
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.paused_until - now)
+
+    async def acquire(self) -> None:
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + float(seconds))
+
+
+_GLOBAL_BUCKET = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+_CHAT_BUCKETS: "OrderedDict[int, TokenBucket]" = OrderedDict()
+_STATS: Dict[str, int] = {"sent": 0, "failed": 0, "retry_after": 0}
+
+
+def _chat_bucket(chat_id: int) -> TokenBucket:
+    bucket = _CHAT_BUCKETS.get(chat_id)
+    if bucket is None:
+        # отрицательный chat_id — группа/канал, у них лимит строже
+        rate = TG_GROUP_RATE if chat_id < 0 else TG_CHAT_RATE
+        bucket = TokenBucket(rate, 1.0 if chat_id < 0 else 3.0)
+        _CHAT_BUCKETS[chat_id] = bucket
+        if len(_CHAT_BUCKETS) > TG_CHAT_BUCKETS_MAX:
+            _evict_chat_buckets()
+    else:
+        _CHAT_BUCKETS.move_to_end(chat_id)
+    return bucket
+
+
+def _evict_chat_buckets() -> None:
+    # самые давние сначала; замороженные после 429 не трогаем, иначе новый
+    # bucket забудет паузу
+    now = time.monotonic()
+    extra = len(_CHAT_BUCKETS) - TG_CHAT_BUCKETS_MAX
+    victims = []
+    for cid, bucket in _CHAT_BUCKETS.items():
+        if len(victims) >= extra:
+            break
+        if bucket.paused_until <= now:
+            victims.append(cid)
+    for cid in victims:
+        del _CHAT_BUCKETS[cid]
+
+
+async def send_with_limits(chat_id: int, send: Callable[[], Awaitable[T]]) -> T:
+    """Один вызов Bot API в чат chat_id с учётом лимитов и повтором после 429."""
+    chat_id = int(chat_id)
+    attempt = 0
+    while True:
+        attempt += 1
+        await _GLOBAL_BUCKET.acquire()
+        await _chat_bucket(chat_id).acquire()
+        try:
+            result = await send()
+        except TelegramRetryAfter as exc:
+            _STATS["retry_after"] += 1
+            if attempt >= TG_RETRY_AFTER_ATTEMPTS:
+                _STATS["failed"] += 1
+                raise
+            delay = min(float(exc.retry_after or 1), TG_RETRY_AFTER_MAX_SEC)
+            bucket = _chat_bucket(chat_id)
+            bucket.pause(delay)
+            if delay > 1.0 / bucket.rate:
+                _GLOBAL_BUCKET.pause(delay)
+            continue
+        except Exception:
+            _STATS["failed"] += 1
+            raise
+        _STATS["sent"] += 1
+        return result
+
+
+@dataclass
+class DeliveryResult:
+    chat_id: int
+    ok: bool
+    error: Optional[BaseException] = None
+    value: Any = None
+
+
+async def fan_out(
+    chat_ids: Iterable[int],
+    send_one: Callable[[int], Awaitable[Any]],
+    concurrency: Optional[int] = None,
+) -> List[DeliveryResult]:
+    """
+    Отправка каждому получателю (дубликаты chat_id убираются) не более чем
+    в `concurrency` параллельных запросов. Результаты — в порядке chat_ids.
+    """
+    ids = list(dict.fromkeys(int(c) for c in chat_ids))
+    if not ids:
+        return []
+    sem = asyncio.Semaphore(max(1, int(concurrency or TG_FANOUT_CONCURRENCY)))
+
+    async def _one(chat_id: int) -> DeliveryResult:
+        async with sem:
+            try:
+                value = await send_with_limits(chat_id, lambda: send_one(chat_id))
+            except Exception as exc:
+                return DeliveryResult(chat_id=chat_id, ok=False, error=exc)
+            return DeliveryResult(chat_id=chat_id, ok=True, value=value)
+
+    return list(await asyncio.gather(*(_one(c) for c in ids)))
+
+
+def delivery_stats() -> Dict[str, Any]:
+    stats: Dict[str, Any] = dict(_STATS)
+    stats.update({
+        "global_rate": TG_GLOBAL_RATE,
+        "chat_rate": TG_CHAT_RATE,
+        "group_rate": round(TG_GROUP_RATE, 4),
+        "concurrency": TG_FANOUT_CONCURRENCY,
+        "tracked_chats": len(_CHAT_BUCKETS),
+    })
+    return stats